@@ -0,0 +1,108 @@
+import time
+import threading
+
+import botlog
+
+log = botlog.get_logger("batcher")
+
+
+class Batcher(object):
+    """
+    Collects items that come in close together and hands them off as one batch.
+    A batch goes out once the window after its first item closes, or as soon as it's full,
+    so a night's worth of reductions finishing together turns into a handful of batches.
+    """
+    def __init__(self, callback, window=60., max_items=16):
+        """
+        Runs on creation
+
+        Args:
+            callback: function to call with the list of items in each batch
+            window: seconds to keep collecting after the first item of a batch comes in
+            max_items: hand off a batch right away once it has this many items
+        """
+        self.callback = callback
+        self.window = window
+        self.max_items = max_items
+        self.items = []
+        self.deadline = None
+        self.cond = threading.Condition()
+        self.items_received = 0
+        self.batches_dispatched = 0
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        """
+        Start the dispatch thread
+        """
+        self.running = True
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop the dispatch thread, handing off whatever has been collected so far
+        """
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        if self.thread is not None:
+            self.thread.join()
+
+    def add(self, item):
+        """
+        Add an item to the current batch
+
+        Args:
+            item: anything, it gets passed to the callback as is
+        """
+        with self.cond:
+            self.items_received += 1
+            if len(self.items) == 0:
+                self.deadline = time.time() + self.window
+            self.items.append(item)
+            if len(self.items) >= self.max_items:
+                self.deadline = time.time()
+            self.cond.notify()
+
+    def stats(self):
+        """
+        Return:
+            stats: dict of items received, batches dispatched and items still waiting
+        """
+        with self.cond:
+            return {"items_received": self.items_received,
+                    "batches_dispatched": self.batches_dispatched,
+                    "pending": len(self.items)}
+
+    def _run(self):
+        """
+        Dispatch thread. Sleeps until the current batch is due, then hands it off
+        """
+        while True:
+            with self.cond:
+                while self.running:
+                    if len(self.items) > 0:
+                        now = time.time()
+                        if self.deadline <= now:
+                            break
+                        self.cond.wait(self.deadline - now)
+                    else:
+                        self.cond.wait()
+                batch = self.items[:self.max_items]
+                self.items = self.items[self.max_items:]
+                # anything left over starts the next batch
+                self.deadline = time.time() + self.window if len(self.items) > 0 else None
+                if len(batch) > 0:
+                    self.batches_dispatched += 1
+                finished = not self.running and len(self.items) == 0
+
+            if len(batch) > 0:
+                try:
+                    self.callback(batch)
+                except Exception as e:
+                    log.exception("Error handling batch of %d", len(batch))
+            if finished:
+                return
@@ -0,0 +1,80 @@
+"""
+Micro-benchmark of matching chat messages to commands.
+
+Times commands.CommandRouter.match against a linear if/elif style scan (what
+ChatResponder.craft_response used to do) as more and more commands are registered.
+The router should stay flat while the scan grows with the number of commands.
+
+    $ python benchmarks/bench_dispatch.py --ncommands 5 50 500
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import commands
+
+messages = ["show me c Eri, 20141218, H, Spec", "tell me a joke", "time CLT", "when is sunrise?",
+            "what is the moon phase", "help", "are you there?", "HD 95086 looks great tonight"]
+
+
+def make_commands(ncommands):
+    """
+    The real commands plus ncommands made up ones, alternating prefix and keyword commands
+
+    Return:
+        specs: list of (name, prefixes, keywords, exact, requires)
+    """
+    specs = [("show", ["SHOW ME", "SHOW"], [], [], []),
+             ("joke", ["TELL"], [], [], ["JOKE"]),
+             ("time", ["TIME"], [], [], []),
+             ("sunrise", [], ["SUNRISE"], [], []),
+             ("sunset", [], ["SUNSET"], [], []),
+             ("moon", [], ["MOON PHASE"], ["MOON"], []),
+             ("help", [], [], ["HELP"], [])]
+    for i in range(ncommands):
+        if i % 2 == 0:
+            specs.append(("prefix{0}".format(i), ["CMD{0}".format(i)], [], [], []))
+        else:
+            specs.append(("keyword{0}".format(i), [], ["WORD{0}".format(i)], [], []))
+    return specs
+
+
+def linear_match(specs, msg):
+    # one check per command, in order, like the old if/elif chain
+    upper = msg.upper()
+    for name, prefixes, keywords, exact, requires in specs:
+        if upper in exact:
+            return name
+        if any(upper.startswith(prefix) for prefix in prefixes) and all(word in upper for word in requires):
+            return name
+        if any(keyword in upper for keyword in keywords):
+            return name
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--ncommands", type=int, nargs="+", default=[0, 10, 100, 1000], help="numbers of extra commands to register")
+    parser.add_argument("--repeats", type=int, default=2000, help="number of passes over the messages")
+    args = parser.parse_args()
+
+    for ncommands in args.ncommands:
+        specs = make_commands(ncommands)
+        router = commands.CommandRouter()
+        for name, prefixes, keywords, exact, requires in specs:
+            router.register(name, None, prefixes=prefixes, keywords=keywords, exact=exact, requires=requires)
+
+        for label, match in [("if/elif scan", lambda msg: linear_match(specs, msg)), ("router", router.match)]:
+            start = time.perf_counter()
+            for i in range(args.repeats):
+                for msg in messages:
+                    match(msg)
+            elapsed = time.perf_counter() - start
+            print("{0:5d} commands {1:>13}: {2:8.2f} us/message".format(
+                len(specs), label, elapsed / (args.repeats * len(messages)) * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+"""
+Micro-benchmark of deciding whether a file system event is a new PSF subtraction.
+
+Generates a synthetic stream of paths like the ones the GPIDATA observer sees while
+Dropbox churns (mostly raw data, logs and intermediate products, a few KL mode cubes)
+and times reductions.match_path against the per-event regex NewImagePoster used to run.
+
+    $ python benchmarks/bench_filter.py --npaths 100000
+"""
+import os
+import re
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import reductions
+from synthetic import synthetic_paths
+
+
+def old_filter(filepath):
+    # what NewImagePoster.process_new_file_event used to do
+    if "_Pol" in filepath:
+        matches = re.findall(r".*m1-(ADI-)?KLmodes-all\.fits", filepath)
+    else:
+        matches = re.findall(r".*m1-KLmodes-all\.fits", filepath)
+    return len(matches) > 0
+
+
+def new_filter(filepath):
+    return reductions.match_path(filepath) is not None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--npaths", type=int, default=100000, help="number of synthetic paths")
+    parser.add_argument("--repeats", type=int, default=5, help="number of passes over the paths (best is reported)")
+    args = parser.parse_args()
+
+    paths = synthetic_paths(args.npaths)
+    for label, event_filter in [("per-event regex", old_filter), ("registry", new_filter)]:
+        best = None
+        for i in range(args.repeats):
+            start = time.perf_counter()
+            nmatched = sum(1 for path in paths if event_filter(path))
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        print("{0:>16}: {1:8.1f} ms for {2} paths, {3:6.0f} ns/path, {4} matched".format(
+            label, best*1e3, len(paths), best/len(paths)*1e9, nmatched))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""
+Compare ways of getting one KL mode out of a KL mode cube: loading the whole cube into
+memory, what save_klcube_image used to do, and the memory mapped single plane read that
+display_image.read_klmode_frame does now.
+
+Writes a synthetic KL mode cube to a temporary directory and reports the latency and
+peak memory of each approach. Every approach runs in its own process so that the peak
+resident set size of one doesn't hide the other.
+
+    $ python benchmarks/bench_fits_read.py --nmodes 50 --size 281
+"""
+import os
+import sys
+import time
+import argparse
+import resource
+import tempfile
+import tracemalloc
+import multiprocessing
+
+import numpy as np
+import astropy.io.fits as fits
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import display_image
+
+
+def read_full_cube(filename, klmode_index):
+    hdulist = fits.open(filename, memmap=False)
+    frame = hdulist[1].data[klmode_index]
+    hdulist.close()
+    return frame
+
+
+def read_old_way(filename, klmode_index):
+    # what save_klcube_image used to do
+    hdulist = fits.open(filename)
+    klcube = hdulist[1].data
+    frame = klcube[klmode_index]
+    hdulist.close()
+    frame /= 0.65
+    return frame
+
+
+def read_single_plane(filename, klmode_index):
+    return display_image.read_klmode_frame(filename, klmode_index)
+
+
+def measure(reader, filename, klmode_index, repeats, results):
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    tracemalloc.start()
+    latencies = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        reader(filename, klmode_index)
+        latencies.append(time.perf_counter() - start)
+    traced_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results.put((latencies, traced_peak, (rss_after - rss_before) * 1024))
+
+
+def run(reader, filename, klmode_index, repeats):
+    results = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=measure, args=(reader, filename, klmode_index, repeats, results))
+    proc.start()
+    proc.join()
+    if proc.exitcode != 0:
+        raise RuntimeError("{0} failed".format(reader.__name__))
+    latencies, traced_peak, rss_growth = results.get()
+    return np.array(latencies), traced_peak, rss_growth
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--nmodes", type=int, default=50, help="number of KL modes in the cube")
+    parser.add_argument("--size", type=int, default=281, help="width and height of each frame in pixels")
+    parser.add_argument("--klmode", type=int, default=3, help="KL mode index to read")
+    parser.add_argument("--repeats", type=int, default=20, help="number of reads to time")
+    parser.add_argument("--scaled", action="store_true", help="store the cube as scaled integers (BSCALE/BZERO)")
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    filename = os.path.join(tmpdir, "pyklip-S20141218-H-k150a9s4m1-KLmodes-all.fits")
+    cube = np.random.normal(0, 1e-6, (args.nmodes, args.size, args.size)).astype(np.float32)
+    hdu = fits.ImageHDU(cube)
+    if args.scaled:
+        hdu.scale('int16', bscale=1e-10)
+    fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(filename)
+    del cube
+    print("KL mode cube: {0} x {1} x {1}, {2:.1f} MB on disk".format(args.nmodes, args.size, os.path.getsize(filename)/1e6))
+
+    try:
+        for label, reader in [("full cube", read_full_cube), ("old way", read_old_way), ("memmap plane", read_single_plane)]:
+            latencies, traced_peak, rss_growth = run(reader, filename, args.klmode, args.repeats)
+            print("{0:>13}: median {1:7.2f} ms, max {2:7.2f} ms, peak allocated {3:7.2f} MB, peak RSS growth {4:7.2f} MB".format(
+                label, np.median(latencies)*1e3, np.max(latencies)*1e3, traced_peak/1e6, rss_growth/1e6))
+    finally:
+        os.remove(filename)
+        os.rmdir(tmpdir)
+
+
+if __name__ == "__main__":
+    main()
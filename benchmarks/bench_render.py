@@ -0,0 +1,81 @@
+"""
+Time rendering KL mode frames to PNG and track the memory of the process while doing it.
+
+Renders the same synthetic frame over and over with display_image's reusable renderer,
+or with a new pyplot figure per image the way save_klcube_image used to (--pyplot),
+and prints the per-image render time and resident memory as it goes.
+
+    $ python benchmarks/bench_render.py --nrenders 2000
+"""
+import os
+import io
+import sys
+import time
+import argparse
+import resource
+
+import numpy as np
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import display_image
+
+
+def render_pyplot(frame, outputname, title=None):
+    # what save_klcube_image used to do: a brand new figure every time, never closed
+    minval = np.nanmin(frame) - 1
+    log_frame = np.log(frame - minval)
+    limits = [-3.e-7, np.min([np.nanpercentile(frame, 99.6), 8.e-5])]
+    fig = plt.figure()
+    ax = fig.add_subplot(111)
+    im = ax.imshow(log_frame, cmap=matplotlib.cm.viridis, vmin=np.log(limits[0]-minval), vmax=np.log(limits[1]-minval))
+    ax.invert_yaxis()
+    plt.colorbar(im, orientation='vertical', shrink=0.9, pad=0.015)
+    ax.set_title(title)
+    plt.savefig(outputname, format='png')
+
+
+def current_rss():
+    """
+    Return:
+        rss: resident set size of this process in MB (Linux only, falls back to the peak elsewhere)
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1e6
+    except (IOError, OSError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--nrenders", type=int, default=2000, help="number of images to render")
+    parser.add_argument("--size", type=int, default=281, help="width and height of the frame in pixels")
+    parser.add_argument("--every", type=int, default=250, help="report every this many renders")
+    parser.add_argument("--pyplot", action="store_true", help="use a new pyplot figure per image instead")
+    args = parser.parse_args()
+
+    frame = np.random.normal(0, 1e-6, (args.size, args.size))
+    frame[:10, :10] = np.nan
+    if args.pyplot:
+        plt.rcParams['figure.max_open_warning'] = 0
+        render = render_pyplot
+    else:
+        render = display_image.get_renderer().render
+
+    latencies = []
+    print("{0:>8} {1:>12} {2:>12} {3:>10}".format("renders", "median ms", "p95 ms", "RSS MB"))
+    for i in range(1, args.nrenders + 1):
+        buf = io.BytesIO()
+        start = time.perf_counter()
+        render(frame, buf, title="HD 95086 2016-02-29 H-Spec #{0}".format(i))
+        latencies.append(time.perf_counter() - start)
+        if i % args.every == 0 or i == args.nrenders:
+            recent = np.array(latencies[-args.every:]) * 1e3
+            print("{0:8d} {1:12.2f} {2:12.2f} {3:10.1f}".format(i, np.median(recent), np.percentile(recent, 95), current_rss()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Benchmark of how long the bot takes to start up.
+
+Times `import bot` in a fresh interpreter (so nothing is already imported or cached),
+from a temporary directory with a throwaway config.ini. Point --repo at another
+checkout (e.g. a git worktree of an older commit) to compare before and after.
+
+    $ python benchmarks/bench_startup.py --runs 10
+    $ git worktree add /tmp/before HEAD~1 && python benchmarks/bench_startup.py --repo /tmp/before
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+default_repo = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+config = """[DEFAULT]
+username = data_cruncher
+token = xoxb-benchmark
+id = U1234ASDF
+dropboxdir = {dropboxdir}
+"""
+
+# what the child runs: time the import, then the first time zone lookup, which is where
+# the work moved to once the abbreviation index stopped being built at import
+child = """
+import time
+start = time.perf_counter()
+import bot
+imported = time.perf_counter()
+bot.timezone.get_time_now('PDT')
+print(imported - start, time.perf_counter() - imported)
+"""
+
+
+def time_startup(repo, workdir):
+    """
+    Start a fresh interpreter and import the bot in it
+
+    Return:
+        import_time: seconds spent in `import bot`
+        lookup_time: seconds spent on the first time zone lookup after that
+        wall_time: seconds from starting the interpreter to it exiting
+    """
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.path.abspath(repo)
+    env["PYTHONDONTWRITEBYTECODE"] = "1"
+    start = time.perf_counter()
+    output = subprocess.check_output([sys.executable, "-c", child], cwd=workdir, env=env)
+    wall_time = time.perf_counter() - start
+    import_time, lookup_time = [float(value) for value in output.split()[-2:]]
+    return import_time, lookup_time, wall_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--repo", default=default_repo, help="checkout of the bot to time (default: this one)")
+    parser.add_argument("--runs", type=int, default=10, help="number of fresh interpreters to start")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_startup")
+    try:
+        os.makedirs(os.path.join(workdir, "dropbox", "GPIDATA"))
+        with open(os.path.join(workdir, "config.ini"), "w") as f:
+            f.write(config.format(dropboxdir=os.path.join(workdir, "dropbox")))
+
+        # one throwaway run so the OS file cache is warm for all the timed ones
+        time_startup(args.repo, workdir)
+        results = sorted(time_startup(args.repo, workdir) for i in range(args.runs))
+    finally:
+        shutil.rmtree(workdir)
+
+    for i, label in enumerate(["import bot", "first tz lookup", "interpreter wall"]):
+        times = sorted(result[i] for result in results)
+        print("{0:>16}: median {1:7.1f} ms, min {2:7.1f} ms, max {3:7.1f} ms".format(
+            label, times[len(times)//2]*1e3, times[0]*1e3, times[-1]*1e3))
+
+
+if __name__ == "__main__":
+    main()
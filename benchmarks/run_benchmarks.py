@@ -0,0 +1,276 @@
+"""
+Benchmark suite for the bot's hot paths, to catch performance regressions before deploying.
+
+Builds a synthetic GPIDATA tree and synthetic KL mode cubes in a temporary directory, then
+runs each benchmark in a fresh process (so one can't inflate the memory of another) and
+reports its throughput, latency percentiles and peak memory:
+
+    render   display_image.save_klcube_image of a KL mode cube to an in memory PNG
+    title    display_image.get_title_from_filename
+    lookup   ChatResponder.get_klipped_img_info, i.e. finding the cube for a "show me" request
+    filter   NewImagePoster.process_new_file_event on a stream of GPIDATA file system events
+
+Calls that take well under a millisecond are timed in batches, and the latency of a call
+is the mean over its batch. Save the results with --save and compare a later run to them
+with --baseline: the suite exits with status 1 if any benchmark got slower (median latency)
+or bigger (peak allocated memory) than the baseline by more than --tolerance.
+
+    $ python benchmarks/run_benchmarks.py --save baseline.json
+    $ python benchmarks/run_benchmarks.py --baseline baseline.json --only render lookup
+"""
+import io
+import os
+import sys
+import json
+import time
+import queue
+import random
+import shutil
+import argparse
+import resource
+import tempfile
+import tracemalloc
+import multiprocessing
+from collections import namedtuple
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import synthetic
+
+repo = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+config = """[DEFAULT]
+username = data_cruncher
+token = xoxb-benchmark
+id = U1234ASDF
+dropboxdir = {dropboxdir}
+indexdb = {workdir}/reductions.sqlite
+metrics_port = 0
+"""
+
+# what watchdog hands process_new_file_event
+FileEvent = namedtuple("FileEvent", ["src_path"])
+
+
+def setup_render(workdir, args):
+    import display_image
+    cubes = sorted(os.path.join(workdir, "cubes", fname) for fname in os.listdir(os.path.join(workdir, "cubes")))
+
+    def render(filename):
+        display_image.save_klcube_image(filename, io.BytesIO(), title="HD 95086 2016-02-29 H-Spec")
+    return render, [cubes[i % len(cubes)] for i in range(args.renders)], 1
+
+
+def setup_title(workdir, args):
+    import display_image
+    with open(os.path.join(workdir, "datasets.json")) as f:
+        paths = [dataset[-1] for dataset in json.load(f)]
+    return display_image.get_title_from_filename, [paths[i % len(paths)] for i in range(args.calls)], 1000
+
+
+def setup_lookup(workdir, args):
+    import bot
+    import catalog
+    reductions = catalog.ReductionCatalog(os.path.join(workdir, "dropbox", "GPIDATA"))
+    reductions.build()
+    responder = bot.ChatResponder(os.path.join(workdir, "dropbox"), None, None, reductions)
+
+    # mostly requests that name a dataset in full, some that leave the rest up to the bot,
+    # and some for things that aren't there
+    with open(os.path.join(workdir, "datasets.json")) as f:
+        datasets = json.load(f)
+    rng = random.Random(0)
+    requests = []
+    for i in range(args.calls // 10):
+        objname, date, band, mode, path = rng.choice(datasets)
+        kind = rng.random()
+        if kind < 0.6:
+            requests.append("{0}, {1}, {2}, {3}".format(objname.replace("_", " "), date, band, mode))
+        elif kind < 0.9:
+            requests.append(objname.replace("_", " "))
+        else:
+            requests.append("{0}, 20991231".format(objname.replace("_", " ")))
+    return responder.get_klipped_img_info, requests, 100
+
+
+def setup_filter(workdir, args):
+    import bot
+    import workqueue
+    dropboxdir = os.path.join(workdir, "dropbox")
+    # a quiet period longer than the benchmark, so matching files are only ever queued up
+    poster = bot.NewImagePoster(dropboxdir, None, None, workqueue.PostedLedger(os.path.join(workdir, "posted.sqlite")),
+                                quiet_period=3600.)
+    events = [FileEvent(path) for path in synthetic.synthetic_paths(args.calls, root=os.path.join(dropboxdir, "GPIDATA"))]
+    return poster.process_new_file_event, events, 1000
+
+
+benchmarks = {
+    "render": setup_render,
+    "title": setup_title,
+    "lookup": setup_lookup,
+    "filter": setup_filter,
+}
+
+
+def measure(name, workdir, args, results):
+    """
+    Run one benchmark. Runs in a process of its own, from the work directory so the bot
+    finds its config.ini and jokes.txt there
+    """
+    os.chdir(workdir)
+    func, items, batch = benchmarks[name](workdir, args)
+
+    # warm up caches, lazily built tables, etc.
+    for item in items[:batch]:
+        func(item)
+
+    latencies = []
+    start = time.perf_counter()
+    for i in range(0, len(items), batch):
+        chunk = items[i:i + batch]
+        chunk_start = time.perf_counter()
+        for item in chunk:
+            func(item)
+        latencies.append((time.perf_counter() - chunk_start) / len(chunk))
+    elapsed = time.perf_counter() - start
+
+    # tracing allocations slows everything down, so measure memory in a separate pass
+    tracemalloc.start()
+    for item in items[:max(batch, min(len(items), 20))]:
+        func(item)
+    traced_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    latencies = np.array(latencies)
+    results.put({"calls": len(items),
+                 "throughput": len(items) / elapsed,
+                 "p50": float(np.percentile(latencies, 50)),
+                 "p90": float(np.percentile(latencies, 90)),
+                 "p99": float(np.percentile(latencies, 99)),
+                 "max": float(np.max(latencies)),
+                 "peak_alloc": traced_peak,
+                 "peak_rss": peak_rss()})
+
+
+def peak_rss():
+    """
+    Return:
+        rss: peak resident set size of this process in bytes
+    """
+    # ru_maxrss survives exec, so a spawned process would report at least our parent's peak.
+    # VmHWM starts over
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    # ru_maxrss is in kB on Linux and bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+
+
+def run(name, workdir, args):
+    # spawn rather than fork, so the child doesn't start with our memory
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    proc = context.Process(target=measure, args=(name, workdir, args, results))
+    proc.start()
+    while True:
+        try:
+            result = results.get(timeout=1.)
+            break
+        except queue.Empty:
+            if not proc.is_alive():
+                raise RuntimeError("{0} benchmark failed".format(name))
+    proc.join()
+    return result
+
+
+def make_workdir(args):
+    """
+    Make the synthetic data, a config.ini and a jokes.txt in a temporary directory
+
+    Return:
+        workdir: path to it
+    """
+    workdir = tempfile.mkdtemp(prefix="bench_suite")
+    gpidata = os.path.join(workdir, "dropbox", "GPIDATA")
+    datasets = synthetic.make_gpidata_tree(gpidata, nobjects=args.objects, ndatasets=args.datasets)
+    with open(os.path.join(workdir, "datasets.json"), "w") as f:
+        json.dump(datasets, f)
+
+    os.makedirs(os.path.join(workdir, "cubes"))
+    for i in range(args.cubes):
+        # every other one as scaled integers, which takes a different path through read_klmode_frame
+        synthetic.write_klcube(os.path.join(workdir, "cubes", "klmodes_{0}.fits".format(i)),
+                               nmodes=args.nmodes, size=args.size, scaled=(i % 2 == 1), seed=i)
+
+    with open(os.path.join(workdir, "config.ini"), "w") as f:
+        f.write(config.format(dropboxdir=os.path.join(workdir, "dropbox"), workdir=workdir))
+    shutil.copy(os.path.join(repo, "jokes.txt"), workdir)
+    return workdir
+
+
+def compare(results, baseline, tolerance):
+    """
+    Return:
+        regressions: list of descriptions of what got worse than the baseline by more than tolerance
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        for key, label in [("p50", "median latency"), ("peak_alloc", "peak allocated memory")]:
+            before, after = baseline[name][key], result[key]
+            if before > 0 and after > before * (1 + tolerance):
+                regressions.append("{0}: {1} went from {2:.4g} to {3:.4g} ({4:+.0%})".format(
+                    name, label, before, after, after / before - 1))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--only", nargs="+", choices=sorted(benchmarks), default=sorted(benchmarks), help="benchmarks to run")
+    parser.add_argument("--renders", type=int, default=40, help="number of images to render")
+    parser.add_argument("--calls", type=int, default=100000, help="number of calls of the fast benchmarks")
+    parser.add_argument("--cubes", type=int, default=4, help="number of KL mode cubes to render from")
+    parser.add_argument("--nmodes", type=int, default=50, help="number of KL modes in each cube")
+    parser.add_argument("--size", type=int, default=281, help="width and height of each frame in pixels")
+    parser.add_argument("--objects", type=int, default=200, help="number of objects in the GPIDATA tree")
+    parser.add_argument("--datasets", type=int, default=5, help="number of dataset folders per object")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="JSON file of earlier results to compare to")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="how much worse than the baseline is a regression")
+    args = parser.parse_args()
+
+    workdir = make_workdir(args)
+    results = {}
+    try:
+        print("{0:>8} {1:>8} {2:>12} {3:>10} {4:>10} {5:>10} {6:>10} {7:>10} {8:>9}".format(
+            "", "calls", "calls/s", "p50 ms", "p90 ms", "p99 ms", "max ms", "alloc MB", "RSS MB"))
+        for name in args.only:
+            result = results[name] = run(name, workdir, args)
+            print("{0:>8} {1:8d} {2:12.1f} {3:10.4f} {4:10.4f} {5:10.4f} {6:10.4f} {7:10.2f} {8:9.1f}".format(
+                name, result["calls"], result["throughput"], result["p50"]*1e3, result["p90"]*1e3, result["p99"]*1e3,
+                result["max"]*1e3, result["peak_alloc"]/1e6, result["peak_rss"]/1e6))
+    finally:
+        shutil.rmtree(workdir)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        if len(regressions) > 0:
+            sys.exit(1)
+        print("No regressions against {0}".format(args.baseline))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+Synthetic data for the benchmarks: KL mode cubes, GPIDATA trees and streams of
+file system event paths that look like what the bot sees during a night of observing.
+"""
+import os
+import random
+
+import numpy as np
+import astropy.io.fits as fits
+
+objects = ["c_Eri", "HD_95086", "beta_Pic", "HR_8799", "HD_206893"] + ["HIP_{0}".format(i) for i in range(200)]
+bands = ["Y", "J", "H", "K1", "K2"]
+# things in an autoreduced folder that aren't KL mode cubes
+others = ["S{date}S{n:04d}_spdc.fits", "S{date}S{n:04d}_podc.fits", "pyklip-S{date}-{band}-k150a9s4m1-speccube.fits",
+          "S{date}S{n:04d}_spdc_distorcorr.fits", "recipe_{n}.xml", "pipeline.log", ".dropbox.cache/tmp{n}"]
+
+
+def klmodes_filename(date, band, mode):
+    """
+    Return:
+        fname: the filename pyklip gives the KL mode cube of a dataset
+    """
+    if mode == "Pol":
+        return "pyklip-S{0}-{1}-pol-k100a9s1m1-ADI-KLmodes-all.fits".format(date, band)
+    return "pyklip-S{0}-{1}-k150a9s4m1-KLmodes-all.fits".format(date, band)
+
+
+def write_klcube(filename, nmodes=50, size=281, scaled=False, seed=0):
+    """
+    Write a KL mode cube like the ones pyklip makes: an empty primary HDU and the cube in
+    the first extension, mostly noise at the 1e-6 level with a NaN corner outside the field
+    (left at zero if scaled, since integers can't be NaN)
+
+    Args:
+        filename: where to write it
+        nmodes: number of KL modes
+        size: width and height of each frame in pixels (GPI's are 281)
+        scaled: store the cube as scaled 16 bit integers (BSCALE/BZERO) instead of floats
+        seed: random seed
+    """
+    rng = np.random.RandomState(seed)
+    cube = rng.normal(0, 1e-6, (nmodes, size, size)).astype(np.float32)
+    if not scaled:
+        cube[:, :size//10, :size//10] = np.nan
+    hdu = fits.ImageHDU(cube)
+    if scaled:
+        hdu.scale('int16', bscale=1e-10)
+    fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(filename, overwrite=True)
+
+
+def make_gpidata_tree(gpidata_dir, nobjects=50, ndatasets=4, nothers=5, seed=42):
+    """
+    Make a GPIDATA tree of empty files: objects, each with a few dataset folders holding a
+    KL mode cube and some of the other files the pipeline leaves behind
+
+    Args:
+        gpidata_dir: where to make it
+        nobjects: number of objects
+        ndatasets: number of dataset folders per object
+        nothers: number of files that aren't KL mode cubes in each dataset folder
+        seed: random seed
+
+    Return:
+        datasets: list of (object name, date, band, mode, path to the KL mode cube)
+    """
+    rng = random.Random(seed)
+    datasets = []
+    for objname in objects[:nobjects]:
+        for i in range(ndatasets):
+            date = "20{0:02d}{1:02d}{2:02d}".format(rng.randint(14, 19), rng.randint(1, 12), rng.randint(1, 28))
+            band = rng.choice(bands)
+            mode = "Pol" if rng.random() < 0.3 else "Spec"
+            dirpath = os.path.join(gpidata_dir, objname, "autoreduced", "{0}_{1}_{2}".format(date, band, mode))
+            if not os.path.isdir(dirpath):
+                os.makedirs(dirpath)
+            for j in range(nothers):
+                fname = rng.choice(others[:-1]).format(date=date, band=band, n=rng.randint(0, 9999))
+                open(os.path.join(dirpath, fname), "a").close()
+            cube = os.path.join(dirpath, klmodes_filename(date, band, mode))
+            open(cube, "a").close()
+            datasets.append((objname, date, band, mode, cube))
+    return datasets
+
+
+def synthetic_paths(npaths, match_fraction=0.02, seed=42, root=None):
+    """
+    Make up a stream of paths in a GPIDATA tree
+
+    Args:
+        npaths: how many paths
+        match_fraction: fraction of them that are KL mode cubes we'd post
+        seed: random seed
+        root: the GPIDATA directory they're in (default: /dropbox/GPIDATA)
+
+    Return:
+        paths: list of paths
+    """
+    rng = random.Random(seed)
+    if root is None:
+        root = os.path.join(os.path.sep, "dropbox", "GPIDATA")
+    paths = []
+    for i in range(npaths):
+        date = "2014{0:02d}{1:02d}".format(rng.randint(1, 12), rng.randint(1, 28))
+        band = rng.choice(bands)
+        mode = "Pol" if rng.random() < 0.3 else "Spec"
+        folder = os.path.join(root, rng.choice(objects), "autoreduced", "{0}_{1}_{2}".format(date, band, mode))
+        if rng.random() < match_fraction:
+            fname = klmodes_filename(date, band, mode)
+        else:
+            fname = rng.choice(others).format(date=date, band=band, n=rng.randint(0, 9999))
+        paths.append(os.path.join(folder, fname))
+    return paths
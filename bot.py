@@ -5,22 +5,35 @@ if sys.version_info < (3,0):
 else:
     import configparser
 import time
-import threading
+import io
+import json
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from threading import Thread
-import re
 import os
 import random
-from websocket import WebSocketConnectionClosedException
-
-from slackclient import SlackClient
-from slacker import Slacker
+import re
+from datetime import datetime
+import aiohttp
 
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 
+import botlog
+import catalog
+import commands
+import metrics
+import batcher
+import debounce
+import workqueue
 import display_image
+import reductions
+import render_cache
+import render_service
+import slack_api
 import timezone
 import suntimes
+import supervisor
     
 
 # Read in configuration from config.ini
@@ -31,40 +44,216 @@ username = config.get('DEFAULT','username')
 token = config.get('DEFAULT', 'token')
 uid = config.get('DEFAULT', 'id')
 dropboxdir = os.path.normpath(config.get('DEFAULT', 'dropboxdir'))
+cachedir = config.get('DEFAULT', 'cachedir', fallback="render_cache")
+cache_max_mb = config.getfloat('DEFAULT', 'cache_max_mb', fallback=200)
+render_in_memory = config.getboolean('DEFAULT', 'render_in_memory', fallback=True)
+# estimate the color limits of an image from every sample_step-th pixel. 1 uses them all
+sample_step = config.getint('DEFAULT', 'sample_step', fallback=1)
+indexdb = config.get('DEFAULT', 'indexdb', fallback="reductions.sqlite")
+quiet_period = config.getfloat('DEFAULT', 'quiet_period', fallback=3.)
+batch_window = config.getfloat('DEFAULT', 'batch_window', fallback=0.)
+metrics_port = config.getint('DEFAULT', 'metrics_port', fallback=9105)
+log_level = config.get('DEFAULT', 'log_level', fallback="INFO")
+# longest we wait for room in the Slack API queue before giving up on a message
+queue_wait = config.getfloat('DEFAULT', 'queue_wait', fallback=10.)
+event_log_sample_rate = config.getfloat('DEFAULT', 'event_log_sample_rate', fallback=0.1)
+
+log = botlog.get_logger("bot")
+# every message the bot sees. Sampled, since it's by far the loudest
+event_log = botlog.get_logger("events")
+slack_log = botlog.get_logger("slack")
+
+fs_events = metrics.registry.counter(
+    "datacruncher_fs_events_total", "File system events seen in GPIDATA, by whether they're a PSF subtraction", ["matched"])
+rtm_events = metrics.registry.counter(
+    "datacruncher_rtm_events_total", "Events received over the RTM websocket, by type", ["type"])
+rtm_duplicates = metrics.registry.counter(
+    "datacruncher_rtm_duplicate_events_total", "RTM events dropped because they were already handled")
 
 class NewImagePoster(FileSystemEventHandler):
     """
     Thread that posts new PSF subtracted images to the Slack Chat
     """
-    def __init__(self, dropboxdir, slacker_bot):
+    def __init__(self, dropboxdir, slack, renderer, ledger, quiet_period=3., batch_window=0.):
         """
         Runs on creation
         
         Args:
             dropboxdir: full path to dropboxdir to scan
-            slacker_bot: a Slacker instance
+            slack: a SlackAPI client
+            renderer: a RenderService instance
+            ledger: a PostedLedger of what's already been posted
+            quiet_period: seconds a new file has to stop changing for before we process it
+            batch_window: if > 0, collect reductions that finish within this many seconds of
+                          each other and post them together as one message with a mosaic
     
         """
         self.dropboxdir = dropboxdir
-        self.newfiles = []
-        self.lock = threading.Lock()
-        self.slacker = slacker_bot
+        self.newfiles = workqueue.UniqueWorkQueue()
+        self.ledger = ledger
+        self.slack = slack
+        self.renderer = renderer
+        self.debouncer = debounce.Debouncer(self.file_ready, quiet_period=quiet_period)
+        self.debouncer.start()
+        self.batcher = None
+        if batch_window > 0:
+            self.batcher = batcher.Batcher(self.post_batch, window=batch_window)
+            self.batcher.start()
         
     
     def process_file(self):
-        with self.lock:
-            if len(self.newfiles) == 0:
-                return
-            
-            filepath = self.newfiles.pop(0)
+        filepath = self.newfiles.get()
+        if filepath is None:
+            return
             
-        # get title and make image after getting new klip file
+        # get title and queue up the image after getting new klip file
         title = display_image.get_title_from_filename(filepath)
-        display_image.save_klcube_image(filepath, "tmp.png", title=title)
-        #print(self.slacker.chat.post_message('@jwang', 'Beep. Boop. {0}'.format(filepath), username=username, as_user=True).raw)
-        print(self.slacker.chat.post_message('#gpies-observing', "Beep. Boop. I just finished a PSF Subtraction for {0}. Here's a quicklook image.".format(title), username=username, as_user=True).raw)
-        print(self.slacker.files.upload('tmp.png', channels="#gpies-observing",filename="{0}.png".format(title.replace(" ", "_")), title=title ).raw)
+        try:
+            job = self.renderer.submit(filepath, title=title)
+        except Exception:
+            self.newfiles.done(filepath)
+            raise
+        job.future.add_done_callback(lambda future: self.post_image(future, filepath, title))
         return
+
+    def post_image(self, future, filepath, title):
+        """
+        Post a rendered image once the render service is done with it
+
+        Args:
+            future: the future of the render job
+            filepath: full path to the KL mode cube
+            title: title of the image
+        """
+        try:
+            outputname = future.result()
+        except Exception as e:
+            log.error("Failed to render %s", title, exc_info=e, extra={"path": filepath})
+            self.newfiles.done(filepath)
+            return
+        if self.batcher is not None:
+            self.batcher.add((filepath, title, outputname))
+        else:
+            self.post_single(filepath, title, outputname)
+
+    def post_single(self, filepath, title, outputname):
+        """
+        Post one rendered image with its own message. Runs on a render callback, so if the
+        chat.postMessage queue is full the post is dropped rather than waiting for room
+
+        Args:
+            filepath: full path to the KL mode cube
+            title: title of the image
+            outputname: the render job's result
+        """
+        try:
+            #self.slack.post_message('@jwang', 'Beep. Boop. {0}'.format(filepath), username=username, as_user=True)
+            message = self.slack.post_message('#gpies-observing', "Beep. Boop. I just finished a PSF Subtraction for {0}. Here's a quicklook image.".format(title),
+                                              block=False, username=username, as_user=True)
+        except slack_api.OutboundQueueFull as e:
+            log.warning("Not posting %s: %s", title, e)
+            self.renderer.release(outputname)
+            self.newfiles.done(filepath)
+            return
+        message.add_done_callback(log_response)
+        # upload once the message is out, so they show up in the right order
+        message.add_done_callback(lambda f: self.upload_image(outputname, filepath, title))
+
+    def upload_image(self, outputname, filepath, title):
+        """
+        Upload a rendered image to the observing channel and remember that we posted it.
+        Runs on the chat.postMessage worker, so it never waits for room in the upload queue
+
+        Args:
+            outputname: the render job's result
+            filepath: full path to the KL mode cube
+            title: title of the image
+        """
+        try:
+            upload = self.slack.upload_file("#gpies-observing", render_service.open_image(outputname), "{0}.png".format(title.replace(" ", "_")), title,
+                                            block=False)
+        except Exception as e:
+            log.error("Couldn't upload %s", title, exc_info=e)
+            self.newfiles.done(filepath)
+            return
+        finally:
+            # the upload has its own copy of the image by now
+            self.renderer.release(outputname)
+        upload.add_done_callback(log_response)
+        upload.add_done_callback(lambda f: self.image_uploaded(f, [filepath]))
+
+    def post_batch(self, items):
+        """
+        Post a batch of rendered images as one message and one mosaic of all of them
+
+        Args:
+            items: list of (filepath, title, outputname) of each rendered image
+        """
+        if len(items) == 1:
+            self.post_single(*items[0])
+            return
+
+        try:
+            mosaic = display_image.render_mosaic_png([render_service.open_image(outputname) for _, _, outputname in items])
+        except Exception as e:
+            # each upload_image releases its own image once it's uploaded
+            log.warning("Couldn't make a mosaic, posting them one by one", exc_info=e)
+            for item in items:
+                self.post_single(*item)
+            return
+        # the mosaic has everything we need from them
+        for _, _, outputname in items:
+            self.renderer.release(outputname)
+
+        filepaths = [filepath for filepath, _, _ in items]
+        titles = [title for _, title, _ in items]
+        text = "Beep. Boop. I just finished PSF Subtractions for {0} datasets:\n{1}\nHere's a quicklook mosaic.".format(
+            len(items), "\n".join("\u2022 {0}".format(title) for title in titles))
+        try:
+            message = self.slack.post_message('#gpies-observing', text, timeout=queue_wait, username=username, as_user=True)
+        except slack_api.OutboundQueueFull as e:
+            log.warning("Not posting a batch of %d: %s", len(items), e)
+            for filepath in filepaths:
+                self.newfiles.done(filepath)
+            return
+        message.add_done_callback(log_response)
+        message.add_done_callback(lambda f: self.upload_mosaic(mosaic, filepaths, len(items)))
+
+    def upload_mosaic(self, mosaic, filepaths, count):
+        """
+        Upload the mosaic of a batch and remember that everything in it was posted.
+        Runs on the chat.postMessage worker, so it never waits for room in the upload queue
+
+        Args:
+            mosaic: PNG bytes
+            filepaths: full paths to the KL mode cubes in the mosaic
+            count: number of images in it
+        """
+        title = "{0} PSF Subtractions".format(count)
+        filename = "psf_subtractions_{0}.png".format(time.strftime("%Y%m%d_%H%M%S"))
+        try:
+            upload = self.slack.upload_file("#gpies-observing", io.BytesIO(mosaic), filename, title, block=False)
+        except Exception as e:
+            log.error("Couldn't upload %s", title, exc_info=e)
+            for filepath in filepaths:
+                self.newfiles.done(filepath)
+            return
+        upload.add_done_callback(log_response)
+        upload.add_done_callback(lambda f: self.image_uploaded(f, filepaths))
+
+    def image_uploaded(self, future, filepaths):
+        """
+        Called once an upload has gone through (or failed)
+
+        Args:
+            future: the future of the upload
+            filepaths: full paths to the KL mode cubes that are in the uploaded image
+        """
+        uploaded = future.exception() is None and future.result().get("ok")
+        for filepath in filepaths:
+            if uploaded:
+                self.ledger.record(filepath)
+            self.newfiles.done(filepath)
     
     
     def process_new_file_event(self, event):
@@ -77,22 +266,31 @@ class NewImagePoster(FileSystemEventHandler):
         filepath = event.src_path
         
         # we are looking for the first PSF subtraction that happens
-        if "_Pol" in filepath:
-            matches = re.findall(r".*m1-(ADI-)?KLmodes-all\.fits", filepath)
-        else:    
-            matches = re.findall(r".*m1-KLmodes-all\.fits", filepath)
-        # not a PSF subtraction
-        if len(matches) <= 0:
+        if reductions.match_path(filepath) is None:
+            # not a PSF subtraction
+            fs_events.inc(matched="false")
             return
+        fs_events.inc(matched="true")
             
+        # wait for it to finish syncing before processing
+        self.debouncer.submit(filepath)
+
+    def file_ready(self, filepath):
+        """
+        Called by the debouncer once a new file has stopped changing
+
+        Args:
+            filepath: full path to the file
+        """
+        # already posted this exact file before? e.g. Dropbox re-synced it
+        if self.ledger.is_posted(filepath):
+            return
+
         # add item to queue
-        with self.lock:
-            if filepath not in self.newfiles:
-                print("appending {0}".format(filepath))
-                self.newfiles.append(filepath)
+        if self.newfiles.put(filepath):
+            log.info("Queued %s", filepath, extra={"path": filepath})
 
-        # wait 3 seconds before processing
-        threading.Timer(3., self.process_file).start() 
+        self.process_file()
         
         
     def on_created(self, event):
@@ -110,20 +308,41 @@ class NewImagePoster(FileSystemEventHandler):
         self.process_new_file_event(event)
     
 
+# Chat commands the ChatResponder knows. Register more with @router.command
+router = commands.CommandRouter()
+
+# how long replies that depend on the time stay good for
+every_second = commands.until_next(1)
+every_minute = commands.until_next(60)
+every_hour = commands.until_next(3600)
+
+def time_ttl(args):
+    # LST and JD have seconds in them, everything else only shows minutes
+    if args.strip().upper() in ('LST', 'JD', 'MJD'):
+        return every_second(args)
+    return every_minute(args)
+
+
 class ChatResponder(Thread):
-    def __init__(self, dropboxdir, slack_bot, slacker):
+    """
+    Answers chat messages addressed to the bot. Getting the messages from Slack is up
+    to subclasses, i.e. AsyncChatResponder
+    """
+    def __init__(self, dropboxdir, slack, renderer, catalog):
         """
         Init
         
         Args:
             dropboxdir: absolute dropbox path
-            slack_bot: a SlackClient instance
-            slacker: a Slacker instance
+            slack: a SlackAPI client, for everything we send
+            renderer: a RenderService instance
+            catalog: a ReductionCatalog of GPIDATA
         """
         super(ChatResponder, self).__init__()
         self.dropboxdir = dropboxdir
-        self.slack_client = slack_bot
-        self.slacker = slacker
+        self.catalog = catalog
+        self.slack = slack
+        self.renderer = renderer
 
         self.jokes = []
         with open("jokes.txt") as jokes_file:
@@ -131,82 +350,6 @@ class ChatResponder(Thread):
                 joke = joke.strip()
                 if len(joke) > 0:
                     self.jokes.append(joke)
-                    
-                    
-    def run(self):
-        connected = self.slack_client.rtm_connect()
-        if not connected:
-            print("Connection Failed, invalid token?")
-            return
-
-        while connected:
-            try:
-                events = self.slack_client.rtm_read()
-            except WebSocketConnectionClosedException as e:
-                #couldn't connect. Try to reconnect...
-                connected = self.slack_client.rtm_connect()
-                continue
-
-            for event in events:
-                self.parse_event(event)
-                        
-            time.sleep(1)
-        else:
-            print("Connection Failed, invalid token?")
-    
-
-    def choose_folder(self, folders, date=None, band=None, mode=None):
-        """
-        Given subfolders in an autoreduced directory and some optional specifications,
-        find the best dataset to show
-
-        Args:
-            folders: a list of folders 
-            date: datestring (e.g 20141212)
-            band: e.g. H
-            mode Spec or Pol
-        Return:
-            chosen: chosen folder Name. None is nothing is chosen
-        """
-        # boudnary case of no folders
-        if len(folders) == 0:
-            return None
-
-        # limit by date
-        if date is not None:
-            folders = [folder for folder in folders if "{0}_".format(date) in folder]
-
-        # limit by band
-        if band is not None:
-            folders = [folder for folder in folders if "_{0}_".format(band) in folder]
-
-        # limit by mode
-        if mode is not None:
-            folders = [folder for folder in folders if "_{0}".format(mode) in folder]
-
-        # if more than one, pick a spec dataset in H band preferably. If not, just pick the first
-        if len(folders) > 1:
-            # narrow by spec if Pol not specified
-            if mode is None:
-                spec_folders = [folder for folder in folders if "_{0}".format("Spec") in folder]
-                # if there are spec datsets, let's pick those
-                if len(spec_folders) > 0:
-                    folders = spec_folders
-            # narrow by H band if not specified
-            if band is None:
-                H_folders = [folder for folder in folders if "_{0}_".format("H") in folder]
-                # if there are H datasets, pick those
-                if len(H_folders) > 0:
-                    folders = H_folders
-
-        # now pick the first one if we haven't removed all choices
-        if len(folders) > 0:
-            chosen = folders[0]
-        else:
-            chosen = None
-        return chosen
-
-
 
     def get_klipped_img_info(self, request):
         """
@@ -234,37 +377,20 @@ class ChatResponder(Thread):
                 if len(request_args) > 3:
                     mode = request_args[3].strip()
 
-        # get object name dropbox path
-        auto_dirpath = os.path.join(self.dropboxdir, "GPIDATA", objname, "autoreduced")
-        print(auto_dirpath)
-        # make sure folder exists
-        if not os.path.isdir(auto_dirpath):
-            return None
-       
-        date_folders = [fname for fname in os.listdir(auto_dirpath) if os.path.isdir(os.path.join(auto_dirpath, fname))]
-        if len(date_folders) == 0:
-            # no subdirs, uh oh
-            return None
-
-        datefolder = self.choose_folder(date_folders, date=date, band=band, mode=mode)
-        if datefolder is None:
+        # find the dataset in the catalog of everything in GPIDATA
+        chosen = self.catalog.choose(objname, date=date, band=band, mode=mode)
+        if chosen is None:
             # couldn't find it
             return None
-        
+        date, band, mode, files = chosen
 
-        dateband = datefolder.split("_")
-        date = dateband[0]
-        band = dateband[1]
-        mode = dateband[2]
- 
+        auto_dirpath = os.path.join(self.dropboxdir, "GPIDATA", objname, "autoreduced")
         dirpath = os.path.join(auto_dirpath,  "{0}_{1}_{2}".format(date, band, mode))
-        if mode == "Spec":
-            pyklip_name = "pyklip-S{date}-{band}-k150a9s4m1-KLmodes-all.fits"
-        else:
-            pyklip_name = "pyklip-S{date}-{band}-pol-k100a9s1m1-ADI-KLmodes-all.fits"
-    
-        pyklip_name = pyklip_name.format(date=date, band=band)
-        
+        pyklip_name = reductions.choose_file(date, band, mode, files)
+        if pyklip_name is None:
+            # the folder is there, but no PSF subtraction we know how to show is in it (yet)
+            return None
+
         filename = os.path.join(dirpath, pyklip_name)
         return filename, objname.replace("_", " "), date, band, mode
 
@@ -315,80 +441,203 @@ class ChatResponder(Thread):
             return
                
         msg = msg.strip()
-        if (msg.upper()[:4] == "SHOW") | (msg.upper()[:7] == "SHOW ME"):
-            # Someone wants us to show them something!!
-            # strip off the "Show (me)?"
-            if "SHOW ME" in msg.upper():
-                msg = msg[7:]
-            else:
-                msg = msg[4:]
-            msg = msg.strip()
-            
-            # get requested pyklip reduction by parsing message
-            klip_info = self.get_klipped_img_info(msg)
-            if klip_info is None:
-                reply = self.beepboop()+" I'm sorry, but I couldn't find the data you requested"
-            else:
-                # found it. Let's get the details of the request
-                pyklip_filename, objname, date, band, mode = klip_info
-                
-                reply = self.beepboop()+' Retrieving {obj} taken on {date} in {band}-{mode}...'.format(obj=objname, date=date, band=band, mode=mode)
-                
-                # generate image to upload
-                title = display_image.get_title_from_filename(pyklip_filename)
-                display_image.save_klcube_image(pyklip_filename, "tmp.png", title=title)
-                
-            # generate and send reply
-            full_reply = '<@{user}>: '.format(user=sender) + reply
-            print(self.slack_client.api_call("chat.postMessage", channel=channel, text=full_reply, username=username, as_user=True))
-            # upload image
-            if klip_info is not None:
-                print(self.slacker.files.upload('tmp.png', channels=channel,filename="{0}.png".format(title.replace(" ", "_")), title=title ).raw)
-        elif (msg.upper()[:4] == "TELL") and ("JOKE" in msg.upper()):
-            joke = self.get_joke()
-            if joke is not None:
-                full_reply = '<@{user}>: '.format(user=sender) + joke
-                print(self.slack_client.api_call("chat.postMessage", channel=channel, text=full_reply, username=username, as_user=True))
- 
-        elif (msg.upper()[:4] == 'TIME'):
-            thistz = msg[4:].strip().upper()
-            curr_time = timezone.get_time_now(thistz)
-            if curr_time is not None:
-                time_reply = "The current time in {tz} is: ".format(tz=thistz) + curr_time
-            else:
-                time_reply = "{tz} is not a valid time zone".format(tz=thistz)
-            full_reply = '<@{user}>: '.format(user=sender) + time_reply
-            print(self.slack_client.api_call("chat.postMessage", channel=channel, text=full_reply, username=username, as_user=True))
-        elif 'SUNRISE' in msg.upper():
-            time_reply = suntimes.sunrise_time_response()
-            full_reply = '<@{user}>: '.format(user=sender) + time_reply
-            print(self.slack_client.api_call("chat.postMessage", channel=channel, text=full_reply, username=username, as_user=True))
-        elif 'SUNSET' in msg.upper():
-            time_reply = suntimes.sunset_time_response()
-            full_reply = '<@{user}>: '.format(user=sender) + time_reply
-            print(self.slack_client.api_call("chat.postMessage", channel=channel, text=full_reply, username=username, as_user=True))
-        elif 'MOON' == msg.upper() or 'MOON PHASE' in msg.upper():
-            moon_phase = suntimes.get_current_moon_phase()
-            full_reply = '<@{user}>: '.format(user=sender) + moon_phase
-            print(self.slack_client.api_call("chat.postMessage", channel=channel, text=full_reply, username=username, as_user=True))
-        elif 'HELP' == msg.upper():
-            help_msg = (self.beepboop()+" I am smart enough to respond to these queries:\n"
-                       "1. show me objectname[, datestring[, band[, mode]]] (e.g. show me c Eri, 20141218, H, Spec)\n"
-                       "2. time [timezone, LST, UTC] (e.g. time CLT)\n"
-                       "3. sun[set/rise] (for the next sunset or sunrise time)\n"
-                       "4. moon phase (for the current moon phase)\n"
-                       "5. tell me a joke\n"
-                       "I also will post new PSF subtractions as I process them. " 
-                       "Just please don't say anything too complicated because I'm not that smart. Yet. :)")
-            full_reply = '<@{user}>: '.format(user=sender) + help_msg
-            print(self.slack_client.api_call("chat.postMessage", channel=channel, text=full_reply, username=username, as_user=True)) 
-            
-        else:
+        command, reply = router.dispatch(self, msg, sender, channel)
+        if command is None:
             reply = self.sarcastic_response(msg)
-            full_reply = '<@{user}>: '.format(user=sender) + reply
-            print(self.slack_client.api_call("chat.postMessage", channel=channel, text=full_reply, username=username, as_user=True))    
-                        
+        if reply is not None:
+            self.reply(sender, channel, reply)
+
+    def reply(self, sender, channel, text):
+        """
+        Answer someone
+
+        Args:
+            sender: ID of who we're answering
+            channel: ID of channel
+            text: the reply
+
+        Return:
+            future: of the chat.postMessage call, or None if there was no room to send it
+        """
+        return self.post_message(channel, '<@{user}>: '.format(user=sender) + text)
+
+    @router.command("show", prefixes=["SHOW ME", "SHOW"])
+    def show_command(self, args, sender, channel):
+        """
+        Someone wants us to show them something!! e.g. show me c Eri, 20141218, H, Spec
+        """
+        # get requested pyklip reduction by parsing message
+        klip_info = self.get_klipped_img_info(args)
+        if klip_info is None:
+            return self.beepboop()+" I'm sorry, but I couldn't find the data you requested"
+
+        # found it. Let's get the details of the request
+        pyklip_filename, objname, date, band, mode = klip_info
+
+        # queue up image to upload when it's ready
+        title = display_image.get_title_from_filename(pyklip_filename)
+        try:
+            job = self.renderer.submit(pyklip_filename, title=title, block=False)
+        except render_service.RenderQueueFull:
+            return self.beepboop()+" I'm sorry, but I'm too busy crunching other data right now. Try again in a bit"
+        except Exception as e:
+            log.error("Failed to queue up %s", pyklip_filename, exc_info=e)
+            return self.beepboop()+" I'm sorry, but something went wrong making the image for {0}".format(title)
+        upload = lambda future: self.upload_image(future, title, channel)
+
+        # reply ourselves, so the image (which may well be cached and ready already) goes up after the reply
+        message = self.reply(sender, channel, self.beepboop()+' Retrieving {obj} taken on {date} in {band}-{mode}...'.format(
+            obj=objname, date=date, band=band, mode=mode))
+        if message is None:
+            job.future.add_done_callback(upload)
+        else:
+            message.add_done_callback(lambda f: job.future.add_done_callback(upload))
+        return None
+
+    @router.command("joke", prefixes=["TELL"], requires=["JOKE"])
+    def joke_command(self, args, sender, channel):
+        """
+        tell me a joke
+        """
+        return self.get_joke()
+
+    @router.command("lst table", prefixes=["LST TABLE"], ttl=every_hour)
+    def lst_table_command(self, args, sender, channel):
+        """
+        lst table (LST every hour of tonight)
+        """
+        return suntimes.lst_table_response()
+
+    @router.command("time", prefixes=["TIME"], ttl=time_ttl)
+    def time_command(self, args, sender, channel):
+        """
+        time [timezone, LST, UTC]
+        """
+        thistz = args.upper()
+        curr_time = timezone.get_time_now(thistz)
+        if curr_time is not None:
+            reply = "The current time in {tz} is: ".format(tz=thistz) + curr_time
+            note = timezone.ambiguity_note(thistz)
+            if note is not None:
+                reply += "\n" + note
+            return reply
+        else:
+            return "{tz} is not a valid time zone".format(tz=thistz)
+
+    @router.command("sunrise", keywords=["SUNRISE"], ttl=every_minute)
+    def sunrise_command(self, args, sender, channel):
+        return suntimes.sunrise_time_response()
+
+    @router.command("sunset", keywords=["SUNSET"], ttl=every_minute)
+    def sunset_command(self, args, sender, channel):
+        return suntimes.sunset_time_response()
+
+    @router.command("twilight", prefixes=["TWILIGHT"], ttl=every_hour)
+    def twilight_command(self, args, sender, channel):
+        """
+        twilight [number of nights, or weeks] (e.g. twilight 2 weeks)
+        """
+        nights = 14
+        match = re.search(r"(\d+)\s*(WEEK)?", args.upper())
+        if match is not None:
+            nights = int(match.group(1)) * (7 if match.group(2) else 1)
+        return suntimes.twilight_response(nights)
+
+    @router.command("moon schedule", prefixes=["MOON SCHEDULE"], ttl=every_hour)
+    def moon_schedule_command(self, args, sender, channel):
+        """
+        moon schedule [start date] [nights] (e.g. moon schedule 20270301 5)
+        """
+        start = None
+        nights = 7
+        for word in re.findall(r"\d+", args):
+            if len(word) == 8:
+                try:
+                    start = datetime.strptime(word, "%Y%m%d")
+                except ValueError:
+                    return "{0} isn't a date I understand. Try YYYYMMDD".format(word)
+            else:
+                nights = int(word)
+        return suntimes.moon_schedule_response(start, nights)
+
+    @router.command("moon", exact=["MOON"], keywords=["MOON PHASE"], ttl=every_hour)
+    def moon_command(self, args, sender, channel):
+        return suntimes.get_current_moon_phase()
+
+    @router.command("help", exact=["HELP"])
+    def help_command(self, args, sender, channel):
+        return (self.beepboop()+" I am smart enough to respond to these queries:\n"
+                "1. show me objectname[, datestring[, band[, mode]]] (e.g. show me c Eri, 20141218, H, Spec)\n"
+                "2. time [timezone, LST, UTC] (e.g. time CLT)\n"
+                "3. sun[set/rise] (for the next sunset or sunrise time)\n"
+                "4. moon phase (for the current moon phase)\n"
+                "5. tell me a joke\n"
+                "6. twilight [nights] (sunset, twilight and sunrise times for the next two weeks, or that many nights)\n"
+                "7. moon schedule [YYYYMMDD] [nights] (moon phase and when it's up each night of an observing run, e.g. moon schedule 20270301 5)\n"
+                "8. lst table (LST at Gemini South for every hour of tonight)\n"
+                "I also will post new PSF subtractions as I process them. " 
+                "Just please don't say anything too complicated because I'm not that smart. Yet. :)")
             
+    def upload_image(self, future, title, channel):
+        """
+        Upload a rendered image once the render service is done with it
+
+        Args:
+            future: the future of the render job
+            title: title of the image
+            channel: ID of channel
+        """
+        try:
+            outputname = future.result()
+        except Exception as e:
+            log.error("Failed to render %s", title, exc_info=e)
+            reply = self.beepboop()+" I'm sorry, but something went wrong making the image for {0}".format(title)
+            # this is a render callback, which mustn't wait for room in the queue
+            self.post_message(channel, reply, block=False)
+            return
+        try:
+            self.upload_file(channel, render_service.open_image(outputname), "{0}.png".format(title.replace(" ", "_")), title)
+        finally:
+            self.renderer.release(outputname)
+
+    def post_message(self, channel, text, block=True):
+        """
+        Send a chat message as the data cruncher
+
+        Args:
+            channel: ID of channel
+            text: the message
+            block: if the queue is full, wait up to queue_wait seconds for room. Otherwise drop the message
+
+        Return:
+            future: of the chat.postMessage call, or None if there was no room to send it
+        """
+        try:
+            message = self.slack.post_message(channel, text, block=block, timeout=queue_wait, username=username, as_user=True)
+        except slack_api.OutboundQueueFull as e:
+            log.warning("Not replying in %s: %s", channel, e)
+            return None
+        message.add_done_callback(log_response)
+        return message
+
+    def upload_file(self, channel, image, filename, title):
+        """
+        Upload an image to a channel
+
+        Args:
+            channel: ID of channel
+            image: file path or file-like object of the image
+            filename: filename to show in Slack
+            title: title of the image
+        """
+        # this can run on the chat.postMessage worker or a render callback, neither of which should wait
+        try:
+            upload = self.slack.upload_file(channel, image, filename, title, block=False)
+        except slack_api.OutboundQueueFull as e:
+            log.warning("Not uploading %s: %s", title, e)
+            return
+        upload.add_done_callback(log_response)
+
     def sarcastic_response(self, msg):        
         """
         Return a sarcastic reply
@@ -476,17 +725,16 @@ class ChatResponder(Thread):
             return
         # look for chat messages
         if (event["type"] == "message") & ("text" in event):
-            print(event)
             # grab message info
             try:
                 msg = event["text"]
                 sender = event["user"]
                 channel = event["channel"]
             except KeyError as e:
-                print("Got a malformed message packet", e)
+                log.warning("Got a malformed message packet, missing %s", e, extra={"event": event})
                 return
             
-            print(u"From {0}@{1}".format(sender, channel))
+            event_log.info(u"From %s@%s", sender, channel, extra={"sender": sender, "channel": channel, "event": event})
             msg_parsed = self.parse_txt(msg)
             try:
                 self.craft_response(msg_parsed, sender, channel)
@@ -496,37 +744,285 @@ class ChatResponder(Thread):
 
 
 
-# client = SlackClient(token)
-# print(client.api_call(
-#     "chat.postMessage", channel="@jwang", text="Beep. Boop.",
-#     username=username, as_user=True))
-    
-    
-# using Slacker as it's file upload interface is much better
-client = Slacker(token)
-print(client.chat.post_message('@jwang', 'Beep. Boop.', username=username, as_user=True).raw)
-# print(client.files.upload('tmp.png', channels="@jwang",filename="HD_95086_160229_H_Spec.png", title="HD 95086 2016-02-29 H-Spec" ).raw)
+class AsyncChatResponder(ChatResponder):
+    """
+    ChatResponder that runs the RTM websocket on an asyncio event loop. Events are handled
+    as soon as they arrive, each one on a pool of handler threads, so a slow request doesn't
+    hold up the next one. Replies go out through the shared SlackAPI client.
 
+    The connection is supervised: dropped or stale connections are retried with exponential
+    backoff, and events Slack replays after a reconnect are only handled once.
+    """
+    def __init__(self, dropboxdir, token, slack, renderer, catalog, api_url="https://slack.com/api/", handler_threads=4,
+                 ping_interval=30., backoff=None):
+        """
+        Init
 
+        Args:
+            dropboxdir: absolute dropbox path
+            token: Slack API token
+            slack: a SlackAPI client, for everything we send
+            renderer: a RenderService instance
+            catalog: a ReductionCatalog of GPIDATA
+            api_url: base URL of the Slack Web API for rtm.connect (point it somewhere else for testing)
+            handler_threads: number of events that can be handled at once
+            ping_interval: ping Slack after this many quiet seconds, and give up on the
+                           connection if nothing comes back within as long again
+            backoff: a supervisor.Backoff for reconnecting (default: 1 s doubling up to 5 min)
+        """
+        super(AsyncChatResponder, self).__init__(dropboxdir, slack, renderer, catalog)
+        self.token = token
+        self.api_url = api_url
+        self.handlers = ThreadPoolExecutor(max_workers=handler_threads)
+        self.ping_interval = ping_interval
+        self.backoff = backoff if backoff is not None else supervisor.Backoff()
+        self.deduper = supervisor.EventDeduper()
+        self.connection_stats = supervisor.ConnectionStats()
+        self.loop = None
+        self.session = None
 
-    
-# Run real time message slack client 
-sc = SlackClient(token)
+    def run(self):
+        asyncio.run(self.main())
+
+    async def main(self):
+        """
+        Keep a connection to RTM up and handle events from it, until Slack says our token is no good
+        """
+        self.loop = asyncio.get_running_loop()
+        headers = {"Authorization": "Bearer {0}".format(self.token)}
+        async with aiohttp.ClientSession(headers=headers) as session:
+            self.session = session
+            while True:
+                try:
+                    keep_going = await self.read_events()
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    log.warning("Lost connection to Slack: %r", e)
+                    keep_going = True
+                except Exception:
+                    # whatever it was, the next connection might not run into it, so keep trying
+                    log.exception("Error talking to Slack")
+                    keep_going = True
+                self.connection_stats.disconnected()
+                if not keep_going:
+                    log.error("Connection Failed, invalid token?")
+                    return
+                delay = self.backoff.next_delay()
+                log.info("Reconnecting in %.1f s", delay, extra={"delay": delay})
+                await asyncio.sleep(delay)
+
+    async def read_events(self):
+        """
+        Open the RTM websocket and dispatch events from it until it closes or goes quiet
+
+        Return:
+            keep_going: False if Slack refused us for good (e.g. bad token), so retrying is pointless
+        """
+        response = await self.api_call("rtm.connect")
+        if not isinstance(response, dict):
+            log.warning("rtm.connect gave a malformed response", extra={"response": response})
+            self.connection_stats.failed()
+            return True
+        if not response.get("ok"):
+            log.warning("rtm.connect failed: %s", response.get("error"), extra={"response": response})
+            self.connection_stats.failed()
+            return response.get("error") not in ("invalid_auth", "not_authed", "account_inactive", "token_revoked")
+
+        async with self.session.ws_connect(response["url"]) as ws:
+            self.connection_stats.connected()
+            ping_id = 0
+            waiting_for_pong = False
+            while True:
+                try:
+                    msg = await ws.receive(timeout=self.ping_interval)
+                except asyncio.TimeoutError:
+                    if waiting_for_pong:
+                        log.warning("Connection to Slack went stale")
+                        break
+                    ping_id += 1
+                    await ws.send_str(json.dumps({"id": ping_id, "type": "ping"}))
+                    waiting_for_pong = True
+                    continue
+                waiting_for_pong = False
+
+                if msg.type == aiohttp.WSMsgType.TEXT:
+                    try:
+                        event = json.loads(msg.data)
+                    except ValueError:
+                        event = None
+                    if not isinstance(event, dict):
+                        log.warning("Got a malformed event", extra={"data": msg.data})
+                        continue
+                    rtm_events.inc(type=event.get("type", "unknown"))
+                    if event.get("type") == "hello":
+                        # connection is healthy, so the next failure starts from a short wait again
+                        self.backoff.reset()
+                    if self.deduper.is_duplicate(event):
+                        rtm_duplicates.inc()
+                        continue
+                    handled = self.loop.run_in_executor(self.handlers, self.parse_event, event)
+                    handled.add_done_callback(lambda future, event=event: self.event_handled(future, event))
+                elif msg.type in (aiohttp.WSMsgType.CLOSE, aiohttp.WSMsgType.CLOSING, aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.ERROR):
+                    break
+        return True
+
+    def event_handled(self, future, event):
+        """
+        Done callback of handling an event, so errors get logged instead of vanishing with the future
+
+        Args:
+            future: the future of parse_event
+            event: the event it handled
+        """
+        if future.cancelled():
+            return
+        e = future.exception()
+        if e is not None:
+            log.error("Failed to handle an event", exc_info=e, extra={"event": event})
+
+    async def api_call(self, method, **kwargs):
+        """
+        Call a Slack Web API method on the event loop
+
+        Args:
+            method: e.g. rtm.connect
+            kwargs: arguments of the method
+
+        Return:
+            response: the decoded JSON response, or None if it wasn't JSON
+        """
+        data = {key: str(value).lower() if isinstance(value, bool) else value for key, value in kwargs.items() if value is not None}
+        async with self.session.post(self.api_url + method, data=data) as resp:
+            try:
+                return await resp.json()
+            except ValueError:
+                # not JSON at all, e.g. an error page from a proxy
+                return None
+
+
+def log_response(future):
+    """
+    Done callback that logs the response of a Slack API call
+    """
+    try:
+        response = future.result()
+    except Exception as e:
+        slack_log.error("Slack API call failed", exc_info=e)
+        return
+    if response.get("ok"):
+        slack_log.debug("Slack API call succeeded", extra={"response": response})
+    else:
+        slack_log.warning("Slack API call failed: %s", response.get("error"), extra={"response": response})
+
+
+
+def collect_metrics(poster, responder, renderer, cache, slack):
+    """
+    Turn the stats the bot's parts already keep into metrics when /metrics is scraped
+
+    Args:
+        poster: the NewImagePoster
+        responder: the ChatResponder
+        renderer: the RenderService
+        cache: the RenderCache
+        slack: the SlackAPI client
+
+    Return:
+        metrics: list of (name, kind, documentation, samples), see metrics.Registry.add_collector
+    """
+    debouncer = poster.debouncer.stats()
+    router_stats = router.stats()
+    connection = responder.connection_stats.snapshot()
+    collected = [
+        ("datacruncher_debounce_events_total", "counter", "File system events for PSF subtractions given to the debouncer",
+         [({}, debouncer["events_received"])]),
+        ("datacruncher_debounce_dispatched_total", "counter", "New files that settled down and were handed off",
+         [({}, debouncer["jobs_dispatched"])]),
+        ("datacruncher_debounce_pending", "gauge", "Files waiting for their quiet period",
+         [({}, debouncer["pending"])]),
+        ("datacruncher_new_files_queued", "gauge", "New PSF subtractions waiting to be rendered",
+         [({}, len(poster.newfiles))]),
+        ("datacruncher_render_jobs_pending", "gauge", "Render jobs queued or running",
+         [({}, len(renderer.pending()))]),
+        ("datacruncher_render_cache_hits_total", "counter", "Render requests answered from the PNG cache",
+         [({}, cache.hits)]),
+        ("datacruncher_render_cache_misses_total", "counter", "Render requests that had to be rendered",
+         [({}, cache.misses)]),
+        ("datacruncher_render_cache_bytes", "gauge", "Size of the PNG cache",
+         [({}, cache.total_bytes)]),
+        ("datacruncher_commands_unmatched_total", "counter", "Chat messages that didn't match any command",
+         [({}, router_stats["unmatched"])]),
+        ("datacruncher_response_cache_hits_total", "counter", "Chat replies answered from the response cache",
+         [({"command": name}, counts["hits"]) for name, counts in sorted(router_stats["cache"]["commands"].items())]),
+        ("datacruncher_response_cache_misses_total", "counter", "Chat replies that had to be worked out",
+         [({"command": name}, counts["misses"]) for name, counts in sorted(router_stats["cache"]["commands"].items())]),
+        ("datacruncher_rtm_connects_total", "counter", "Successful RTM connections",
+         [({}, connection["connects"])]),
+        ("datacruncher_rtm_reconnects_total", "counter", "RTM connections after the first one",
+         [({}, connection["reconnects"])]),
+        ("datacruncher_rtm_failed_connects_total", "counter", "RTM connection attempts that failed",
+         [({}, connection["failed_attempts"])]),
+        ("datacruncher_rtm_downtime_seconds_total", "counter", "Time spent disconnected from RTM since the first connection",
+         [({}, connection["downtime"])]),
+        ("datacruncher_rtm_connected", "gauge", "1 if the RTM websocket is connected",
+         [({}, connection["connected"])]),
+        ("datacruncher_slack_api_queued", "gauge", "Slack Web API calls waiting to go out, by rate limit tier",
+         [({"tier": tier}, count) for tier, count in sorted(slack.queued().items(), key=lambda item: str(item[0]))]),
+    ]
+    if poster.batcher is not None:
+        batches = poster.batcher.stats()
+        collected.append(("datacruncher_batch_pending", "gauge", "Rendered images waiting to be posted in the next batch",
+                          [({}, batches["pending"])]))
+        collected.append(("datacruncher_batches_posted_total", "counter", "Batches of images handed off for posting",
+                          [({}, batches["batches_dispatched"])]))
+    return collected
+
+
+if __name__ == "__main__":
+    # JSON lines on stdout, written from a background thread
+    botlog.setup(log_level, sample_rates={event_log.name: event_log_sample_rate})
+
+    # everything we send to Slack goes through here
+    client = slack_api.SlackAPI(token)
+    log.info("Said hello", extra={"response": client.call("chat.postMessage", channel='@jwang', text='Beep. Boop.', username=username, as_user=True)})
+
+
+    # Render images in worker processes so neither thread blocks on matplotlib
+    # and remember what we've already rendered so repeat requests are instant
+    cache = render_cache.RenderCache(cachedir, max_bytes=int(cache_max_mb*1024*1024))
+    renderer = render_service.RenderService(cache=cache, in_memory=render_in_memory, sample_step=sample_step)
+
+    # Index GPIDATA. Reload what we knew last time and catch up on what changed while
+    # we were away in the background. The observer below keeps it up to date after that
+    reduction_catalog = catalog.ReductionCatalog(os.path.join(dropboxdir, 'GPIDATA'), catalog.CatalogStore(indexdb))
+    if reduction_catalog.load() > 0:
+        reconciler = Thread(target=reduction_catalog.build)
+        reconciler.daemon = True
+        reconciler.start()
+    else:
+        reduction_catalog.build()
+
+    # Run real time message slack client 
+    p = AsyncChatResponder(dropboxdir, token, client, renderer, reduction_catalog)
+    p.daemon = True
+    p.start()
 
-p = ChatResponder(dropboxdir, sc, client)
-p.daemon = True
-p.start()
 
 
+    # Run real time PSF subtraction updater
+    log.info("Watching %s", os.path.join(dropboxdir, 'GPIDATA'))
+    event_handler = NewImagePoster(dropboxdir, client, renderer, workqueue.PostedLedger(indexdb), quiet_period=quiet_period, batch_window=batch_window)
+    observer = Observer()
 
-# Run real time PSF subtraction updater
-print(dropboxdir)
-event_handler = NewImagePoster(dropboxdir, client)
-observer = Observer()
+    observer.schedule(event_handler, os.path.join(dropboxdir, 'GPIDATA'), recursive=True)
+    observer.schedule(reduction_catalog, os.path.join(dropboxdir, 'GPIDATA'), recursive=True)
+    observer.start()
 
-observer.schedule(event_handler, os.path.join(dropboxdir, 'GPIDATA'), recursive=True)
-observer.start()
+    # Export metrics on http://localhost:<metrics_port>/metrics
+    if metrics_port > 0:
+        metrics.registry.add_collector(lambda: collect_metrics(event_handler, p, renderer, cache, client))
+        metrics_server = metrics.MetricsServer(metrics.registry, port=metrics_port)
+        metrics_server.start()
 
 
-while True:
-    time.sleep(100)
+    while True:
+        time.sleep(100)
@@ -0,0 +1,226 @@
+import sys
+import copy
+import json
+import time
+import queue
+import atexit
+import logging
+import threading
+from logging.handlers import QueueHandler, QueueListener
+
+import metrics
+
+dropped_records = metrics.registry.counter(
+    "datacruncher_log_records_dropped_total", "Log records that were never written, by why", ["reason"])
+
+# everything the bot logs goes under this logger
+root_name = "datacruncher"
+
+# attributes every LogRecord has, so anything else on a record came in through extra=
+_standard_attributes = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+def get_logger(name):
+    """
+    Get the logger of part of the bot
+
+    Args:
+        name: e.g. bot, events, render
+
+    Return:
+        logger: a logging.Logger under datacruncher
+    """
+    return logging.getLogger("{0}.{1}".format(root_name, name))
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    Formats each record as one line of JSON: time, level, logger, message, any fields
+    passed with extra=, and the traceback if there is one
+    """
+    def format(self, record):
+        entry = {"ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + ".{0:03d}Z".format(int(record.msecs)),
+                 "level": record.levelname,
+                 "logger": record.name,
+                 "msg": record.getMessage()}
+        for key, value in vars(record).items():
+            if key not in _standard_attributes and key not in entry:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps only a fraction of the records of high volume loggers (e.g. every RTM event).
+    Warnings and errors always get through.
+    """
+    def __init__(self, rates):
+        """
+        Runs on creation
+
+        Args:
+            rates: dict of logger name -> fraction of its records to keep (0 to 1)
+        """
+        super(SamplingFilter, self).__init__()
+        self.rates = dict(rates)
+        self.seen = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        rate = self.rates.get(record.name)
+        if rate is None or rate >= 1 or record.levelno >= logging.WARNING:
+            return True
+        # keep evenly spaced records rather than random ones, so a burst is still represented
+        with self.lock:
+            seen = self.seen.get(record.name, 0)
+            self.seen[record.name] = seen + 1
+        if rate > 0 and int((seen + 1) * rate) > int(seen * rate):
+            return True
+        dropped_records.inc(reason="sampled")
+        return False
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """
+    Hands records to the listener thread without ever waiting. If the queue is full
+    (the output can't keep up), the record is dropped and counted instead
+    """
+    def prepare(self, record):
+        # fill in the message now, since its args might change once we return, but
+        # keep the traceback as a field of its own rather than tacked onto the message
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+            record.exc_text = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            dropped_records.inc(reason="queue_full")
+
+
+class RecordCollector(logging.Handler):
+    """
+    Keeps the records logged in a worker process as plain picklable dicts instead of
+    writing them, so they can go back to the bot's process with the worker's result
+    and be logged there with replay()
+    """
+    def __init__(self):
+        super(RecordCollector, self).__init__()
+        self.records = []
+
+    def emit(self, record):
+        fields = dict(vars(record))
+        fields["msg"] = record.getMessage()
+        fields["args"] = None
+        if record.exc_info:
+            fields["exc"] = logging.Formatter().formatException(record.exc_info)
+        fields["exc_info"] = None
+        fields["exc_text"] = None
+        for key, value in fields.items():
+            # whatever came in through extra= has to survive the trip back
+            if key not in _standard_attributes and not isinstance(value, (str, int, float, bool, type(None), tuple, list, dict)):
+                fields[key] = str(value)
+        self.records.append(fields)
+
+    def take(self):
+        """
+        Return:
+            records: list of dicts of the records collected since the last take()
+        """
+        records, self.records = self.records, []
+        return records
+
+
+_collector = None
+
+def collect(level):
+    """
+    Collect everything the bot logs in this process instead of writing it. For worker
+    processes, which can't share the listener thread of the bot's process
+
+    Args:
+        level: lowest level to collect, e.g. the level of the bot's process
+
+    Return:
+        collector: the RecordCollector of this process
+    """
+    global _collector
+    logger = logging.getLogger(root_name)
+    if _collector is None:
+        _collector = RecordCollector()
+        # a forked worker inherits the bot's handlers, whose queue nobody reads in this process
+        logger.handlers = [_collector]
+        logger.propagate = False
+    logger.setLevel(level)
+    return _collector
+
+
+def replay(records):
+    """
+    Log records collected in another process (see collect) as if they were logged here
+
+    Args:
+        records: list of dicts from RecordCollector.take()
+    """
+    for fields in records:
+        logger = logging.getLogger(fields["name"])
+        if logger.isEnabledFor(fields["levelno"]):
+            logger.handle(logging.makeLogRecord(fields))
+
+
+_listener = None
+
+
+def setup(level="INFO", stream=None, sample_rates=None, max_queued=10000):
+    """
+    Send the bot's logs through a queue to a background thread that writes them
+    as JSON lines, so logging never waits on a slow stdout
+
+    Args:
+        level: lowest level to log, e.g. INFO or DEBUG
+        stream: where to write the logs (default: stdout)
+        sample_rates: dict of logger name -> fraction of its records to keep
+        max_queued: most records waiting to be written before new ones are dropped
+
+    Return:
+        listener: the QueueListener writing the logs (stopped automatically at exit)
+    """
+    global _listener
+    if _listener is not None:
+        return _listener
+
+    output = logging.StreamHandler(stream if stream is not None else sys.stdout)
+    output.setFormatter(JSONFormatter())
+
+    records = queue.Queue(max_queued)
+    handler = NonBlockingQueueHandler(records)
+    if sample_rates:
+        handler.addFilter(SamplingFilter(sample_rates))
+
+    logger = logging.getLogger(root_name)
+    logger.setLevel(level)
+    logger.addHandler(handler)
+    logger.propagate = False
+
+    _listener = QueueListener(records, output)
+    _listener.start()
+    atexit.register(shutdown)
+    return _listener
+
+
+def shutdown():
+    """
+    Write out whatever is still queued and stop the listener thread
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,407 @@
+import os
+import sqlite3
+import threading
+
+from watchdog.events import FileSystemEventHandler
+
+import reductions
+
+
+def parse_folder_name(folder):
+    """
+    Split an autoreduced folder name into its parts
+
+    Args:
+        folder: e.g. 20141218_H_Spec
+
+    Return:
+        (date, band, mode): or None if it's not a dataset folder
+    """
+    parts = folder.split("_")
+    if len(parts) < 3:
+        return None
+    return parts[0], parts[1], parts[2]
+
+
+def is_klmodes_file(fname):
+    """
+    Return:
+        True if this file is a pyklip KL mode cube
+    """
+    return fname.endswith(reductions.klmodes_suffix)
+
+
+class CatalogStore(object):
+    """
+    SQLite copy of a ReductionCatalog so the bot doesn't have to rescan GPIDATA when it restarts.
+    Every dataset folder gets a row with an empty filename, plus one row per KL mode cube in it.
+    """
+    def __init__(self, dbpath):
+        """
+        Runs on creation
+
+        Args:
+            dbpath: path to the SQLite database (created if it doesn't exist)
+        """
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(dbpath, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS reductions ("
+                            "object TEXT NOT NULL, date TEXT NOT NULL, band TEXT NOT NULL, mode TEXT NOT NULL, "
+                            "filename TEXT NOT NULL, mtime REAL, "
+                            "PRIMARY KEY (object, date, band, mode, filename))")
+
+    def load(self):
+        """
+        Return:
+            rows: list of (object, date, band, mode, filename, mtime). filename is '' for the folder itself
+        """
+        with self.lock:
+            return self.db.execute("SELECT object, date, band, mode, filename, mtime FROM reductions").fetchall()
+
+    def save(self, rows):
+        """
+        Add or update rows
+
+        Args:
+            rows: list of (object, date, band, mode, filename, mtime)
+        """
+        with self.lock, self.db:
+            self.db.executemany("INSERT OR REPLACE INTO reductions VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+    def delete(self, objname, date=None, band=None, mode=None, filename=None):
+        """
+        Delete every row of an object, or of one of its folders, or one file
+        """
+        clauses = ["object = ?"]
+        values = [objname]
+        for column, value in (("date", date), ("band", band), ("mode", mode), ("filename", filename)):
+            if value is not None:
+                clauses.append("{0} = ?".format(column))
+                values.append(value)
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM reductions WHERE " + " AND ".join(clauses), values)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class ReductionCatalog(FileSystemEventHandler):
+    """
+    In memory index of the autoreduced datasets in GPIDATA:
+    object name -> date -> band -> mode -> set of pyklip KL mode cube filenames.
+
+    Built with one scan (or loaded from a CatalogStore) at startup and then kept up to
+    date from watchdog events, so looking up a dataset never has to list directories
+    on the Dropbox mount.
+    """
+    def __init__(self, gpidata_dir, store=None):
+        """
+        Runs on creation
+
+        Args:
+            gpidata_dir: full path to the GPIDATA directory
+            store: a CatalogStore to persist the index to (optional)
+        """
+        self.gpidata_dir = gpidata_dir
+        self.store = store
+        self.index = {}
+        self.folder_mtimes = {} # (object, date, band, mode) -> mtime of the folder when it was last listed
+        self.lock = threading.Lock()
+
+    def load(self):
+        """
+        Fill the index from the store instead of scanning GPIDATA
+
+        Return:
+            count: number of dataset folders loaded
+        """
+        if self.store is None:
+            return 0
+        index = {}
+        folder_mtimes = {}
+        for objname, date, band, mode, filename, mtime in self.store.load():
+            files = index.setdefault(objname, {}).setdefault(date, {}).setdefault(band, {}).setdefault(mode, set())
+            if filename == "":
+                folder_mtimes[(objname, date, band, mode)] = mtime
+            else:
+                files.add(filename)
+        with self.lock:
+            self.index = index
+            self.folder_mtimes = folder_mtimes
+        return len(folder_mtimes)
+
+    def build(self):
+        """
+        Scan GPIDATA and index everything in it. Only folders that changed since they were
+        last indexed get listed, and the index and store are updated with just the differences,
+        so this is cheap after load() and safe to run while watchdog events are coming in.
+        """
+        with self.lock:
+            known_mtimes = dict(self.folder_mtimes)
+            known = self._entries()
+
+        scanned = {}
+        if os.path.isdir(self.gpidata_dir):
+            for objname in os.listdir(self.gpidata_dir):
+                self._scan_object(scanned, objname, known_mtimes)
+
+        found = set()
+        for key, (mtime, fnames) in scanned.items():
+            found.add(key + ("",))
+            found.update(key + (fname,) for fname in fnames)
+
+        with self.lock:
+            for entry in known - found:
+                self._unindex(*entry)
+            for key, (mtime, fnames) in scanned.items():
+                if known_mtimes.get(key) != mtime:
+                    self._index_folder(key, [fname for fname in fnames if key + (fname,) not in known], mtime)
+
+    def _entries(self):
+        """
+        Return:
+            entries: set of (object, date, band, mode, filename) in the index, with '' as the filename
+                     of every folder. Call with the lock held
+        """
+        entries = set()
+        for objname, dates in self.index.items():
+            for date, bands in dates.items():
+                for band, modes in bands.items():
+                    for mode, files in modes.items():
+                        entries.add((objname, date, band, mode, ""))
+                        entries.update((objname, date, band, mode, fname) for fname in files)
+        return entries
+
+    def _scan_object(self, scanned, objname, known_mtimes=None):
+        """
+        List the dataset folders of one object
+
+        Args:
+            scanned: dict to fill with (object, date, band, mode) -> (folder mtime, KL mode cube filenames)
+            objname: object to scan
+            known_mtimes: folders with these mtimes haven't changed since they were indexed, so the
+                          filenames already in the index are reused instead of listing them again
+        """
+        auto_dirpath = os.path.join(self.gpidata_dir, objname, "autoreduced")
+        if not os.path.isdir(auto_dirpath):
+            return
+        for folder in os.listdir(auto_dirpath):
+            parsed = parse_folder_name(folder)
+            if parsed is None:
+                continue
+            dirpath = os.path.join(auto_dirpath, folder)
+            try:
+                mtime = os.stat(dirpath).st_mtime
+                if not os.path.isdir(dirpath):
+                    continue
+                key = (objname,) + parsed
+                if known_mtimes is not None and known_mtimes.get(key) == mtime:
+                    with self.lock:
+                        date, band, mode = parsed
+                        fnames = set(self.index.get(objname, {}).get(date, {}).get(band, {}).get(mode, ()))
+                else:
+                    fnames = set(fname for fname in os.listdir(dirpath) if is_klmodes_file(fname))
+            except OSError:
+                # it went away while we were looking at it
+                continue
+            scanned[key] = (mtime, fnames)
+
+    def _index_folder(self, key, fnames, mtime=None):
+        """
+        Add a dataset folder and some of its files to the index and the store. Call with the lock held
+
+        Args:
+            key: (object, date, band, mode)
+            fnames: KL mode cube filenames in the folder
+            mtime: mtime of the folder if it was fully listed, otherwise None
+        """
+        objname, date, band, mode = key
+        files = self.index.setdefault(objname, {}).setdefault(date, {}).setdefault(band, {}).setdefault(mode, set())
+        files.update(fnames)
+        if mtime is not None:
+            self.folder_mtimes[key] = mtime
+        if self.store is not None:
+            dirpath = os.path.join(self.gpidata_dir, objname, "autoreduced", "{0}_{1}_{2}".format(date, band, mode))
+            rows = [key + ("", self.folder_mtimes.get(key))]
+            for fname in fnames:
+                try:
+                    file_mtime = os.stat(os.path.join(dirpath, fname)).st_mtime
+                except OSError:
+                    file_mtime = None
+                rows.append(key + (fname, file_mtime))
+            self.store.save(rows)
+
+    def _unindex(self, objname, date=None, band=None, mode=None, filename=None):
+        """
+        Drop an object, a dataset folder (filename '' or None) or one file from the index and the store,
+        cleaning up anything left empty. Call with the lock held
+        """
+        if filename:
+            try:
+                self.index[objname][date][band][mode].discard(filename)
+            except KeyError:
+                pass
+            if self.store is not None:
+                self.store.delete(objname, date, band, mode, filename)
+            return
+
+        if date is None:
+            self.index.pop(objname, None)
+            for key in [key for key in self.folder_mtimes if key[0] == objname]:
+                del self.folder_mtimes[key]
+        else:
+            self.folder_mtimes.pop((objname, date, band, mode), None)
+            try:
+                modes = self.index[objname][date][band]
+            except KeyError:
+                modes = None
+            if modes is not None:
+                modes.pop(mode, None)
+                if len(modes) == 0:
+                    del self.index[objname][date][band]
+                    if len(self.index[objname][date]) == 0:
+                        del self.index[objname][date]
+                        if len(self.index[objname]) == 0:
+                            del self.index[objname]
+        if self.store is not None:
+            self.store.delete(objname, date, band, mode)
+
+    def choose(self, objname, date=None, band=None, mode=None):
+        """
+        Find the best dataset of an object to show, given some optional specifications.
+        If more than one matches, prefer a Spec dataset in H band, then the earliest date.
+
+        Args:
+            objname: object name as it appears in GPIDATA (with underscores)
+            date: datestring (e.g 20141212)
+            band: e.g. H
+            mode: Spec or Pol
+
+        Return:
+            (date, band, mode, files): the chosen dataset and its KL mode cube filenames,
+                                       or None if nothing matches
+        """
+        with self.lock:
+            dates = self.index.get(objname)
+            if dates is None:
+                return None
+
+            candidates = []
+            for this_date in ([date] if date is not None else sorted(dates)):
+                bands = dates.get(this_date, {})
+                for this_band in ([band] if band is not None else sorted(bands)):
+                    modes = bands.get(this_band, {})
+                    for this_mode in ([mode] if mode is not None else sorted(modes)):
+                        if this_mode in modes:
+                            candidates.append((this_date, this_band, this_mode, set(modes[this_mode])))
+
+        # if more than one, pick a spec dataset in H band preferably. If not, just pick the first
+        if len(candidates) > 1 and mode is None:
+            spec_candidates = [candidate for candidate in candidates if candidate[2] == "Spec"]
+            if len(spec_candidates) > 0:
+                candidates = spec_candidates
+        if len(candidates) > 1 and band is None:
+            H_candidates = [candidate for candidate in candidates if candidate[1] == "H"]
+            if len(H_candidates) > 0:
+                candidates = H_candidates
+
+        if len(candidates) == 0:
+            return None
+        return candidates[0]
+
+    def _split_path(self, path):
+        """
+        Figure out where in GPIDATA a path is
+
+        Return:
+            parts: [objname[, "autoreduced"[, folder[, filename]]]] or None if the path isn't in an object's autoreduced folder
+        """
+        relpath = os.path.relpath(path, self.gpidata_dir)
+        parts = relpath.split(os.path.sep)
+        if parts[0] in (os.curdir, os.pardir) or len(parts) > 4:
+            return None
+        if len(parts) > 1 and parts[1] != "autoreduced":
+            return None
+        return parts
+
+    def _path_added(self, path, is_directory):
+        parts = self._split_path(path)
+        if parts is None:
+            return
+        if len(parts) < 4 and not is_directory:
+            return
+        if len(parts) == 4 and (is_directory or not is_klmodes_file(parts[3])):
+            return
+
+        if len(parts) < 3:
+            # a whole object appeared at once (e.g. it got renamed), so index all of it
+            scanned = {}
+            self._scan_object(scanned, parts[0])
+            with self.lock:
+                for key, (mtime, fnames) in scanned.items():
+                    self._index_folder(key, fnames, mtime)
+            return
+
+        parsed = parse_folder_name(parts[2])
+        if parsed is None:
+            return
+        key = (parts[0],) + parsed
+        mtime = None
+        if len(parts) == 3:
+            # a folder that shows up with files already in it (e.g. it got renamed)
+            try:
+                mtime = os.stat(path).st_mtime
+                fnames = [fname for fname in os.listdir(path) if is_klmodes_file(fname)]
+            except OSError:
+                return
+        else:
+            fnames = [parts[3]]
+        with self.lock:
+            self._index_folder(key, fnames, mtime)
+
+    def _path_removed(self, path, is_directory):
+        parts = self._split_path(path)
+        if parts is None:
+            return
+        with self.lock:
+            if len(parts) < 3:
+                self._unindex(parts[0])
+                return
+            parsed = parse_folder_name(parts[2])
+            if parsed is None:
+                return
+            if len(parts) == 3:
+                self._unindex(parts[0], *parsed)
+            else:
+                self._unindex(parts[0], *parsed, filename=parts[3])
+
+    def on_created(self, event):
+        """
+        watchdog function to run when a new file or folder appears
+        """
+        self._path_added(event.src_path, event.is_directory)
+
+    def on_modified(self, event):
+        """
+        watchdog function to run when an existing file is modified
+        """
+        # folders get modified every time something inside them changes. Those changes
+        # come with their own events, so there's nothing to rescan
+        if event.is_directory:
+            return
+        self._path_added(event.src_path, event.is_directory)
+
+    def on_deleted(self, event):
+        """
+        watchdog function to run when a file or folder is removed
+        """
+        self._path_removed(event.src_path, event.is_directory)
+
+    def on_moved(self, event):
+        """
+        watchdog function to run when a file or folder is renamed
+        """
+        self._path_removed(event.src_path, event.is_directory)
+        self._path_added(event.dest_path, event.is_directory)
@@ -0,0 +1,263 @@
+import re
+import time
+import threading
+from collections import namedtuple, OrderedDict
+
+import metrics
+
+command_seconds = metrics.registry.histogram(
+    "datacruncher_command_seconds", "Time spent answering each chat command, cache hits included", ["command"])
+
+Command = namedtuple("Command", ["name", "handler", "requires", "priority", "ttl"])
+
+_word = re.compile(r"\w+")
+
+
+class CommandRouter(object):
+    """
+    Figures out which chat command a message is and runs its handler. Commands are
+    indexed when they're registered (a character trie of prefixes, a word index of
+    keywords and a dict of exact messages), so matching a message only costs as much
+    as the message is long, no matter how many commands there are.
+
+    Handlers get called as handler(responder, args, sender, channel) and return the
+    reply text, or None to not reply. args is the message with the matched prefix
+    taken off, or the whole message for keyword and exact matches.
+
+    Commands registered with a ttl have their replies cached, so asking the same thing
+    again before it expires is answered without running the handler.
+    """
+    def __init__(self, cache=None):
+        """
+        Runs on creation
+
+        Args:
+            cache: a ResponseCache for the replies of commands with a ttl (default: a new one)
+        """
+        self.cache = cache if cache is not None else ResponseCache()
+        self.commands = OrderedDict()
+        self.exact = {}
+        self.prefixes = {}
+        self.keywords = {}
+        self.lock = threading.Lock()
+        self.timings = {}
+        self.unmatched = 0
+
+    def register(self, name, handler, prefixes=(), keywords=(), exact=(), requires=(), ttl=None):
+        """
+        Add a command
+
+        Args:
+            name: name of the command, for timings
+            handler: function to run it
+            prefixes: the command matches messages starting with any of these.
+                      The longest one that matches is taken off the message
+            keywords: the command matches messages with any of these words (or phrases) in them
+            exact: the command matches messages that are exactly any of these
+            requires: words that also have to be somewhere in the message for a prefix match
+            ttl: cache replies for this many seconds, or a function of args giving the seconds
+                 (e.g. until_next(60)). 0 or None means don't cache
+        """
+        # earlier commands win when a message matches more than one of the same kind
+        command = Command(name, handler, tuple(word.upper() for word in requires), len(self.commands), ttl)
+        self.commands[name] = command
+        self.timings[name] = [0, 0., 0.]
+
+        for text in exact:
+            self.exact.setdefault(_normalize(text), command)
+        for prefix in prefixes:
+            node = self.prefixes
+            for char in prefix.upper():
+                node = node.setdefault(char, {})
+            node.setdefault(None, []).append(command)
+        for keyword in keywords:
+            words = tuple(_word.findall(keyword.upper()))
+            self.keywords.setdefault(words[0], []).append((words, command))
+
+    def command(self, name, **kwargs):
+        """
+        Decorator version of register, e.g. @router.command("joke", prefixes=["TELL"], requires=["JOKE"])
+        """
+        def decorator(handler):
+            self.register(name, handler, **kwargs)
+            return handler
+        return decorator
+
+    def match(self, msg):
+        """
+        Find the command of a message
+
+        Args:
+            msg: message text, with the @mention already taken out
+
+        Return:
+            command: the matching Command, or None if nothing matches
+            args: the rest of the message
+        """
+        upper = msg.upper()
+        command = self.exact.get(_normalize(upper))
+        if command is not None:
+            return command, msg
+
+        # walk the prefix trie as far as the message goes, then try the longest match first
+        matches = []
+        node = self.prefixes
+        for i, char in enumerate(upper):
+            node = node.get(char)
+            if node is None:
+                break
+            if None in node:
+                matches.append((i + 1, node[None]))
+        for length, candidates in reversed(matches):
+            for command in candidates:
+                if all(word in upper for word in command.requires):
+                    return command, msg[length:].strip()
+
+        words = _word.findall(upper)
+        best = None
+        for i, word in enumerate(words):
+            for phrase, command in self.keywords.get(word, ()):
+                if tuple(words[i:i + len(phrase)]) == phrase and (best is None or command.priority < best.priority):
+                    best = command
+        return best, msg
+
+    def dispatch(self, responder, msg, sender, channel):
+        """
+        Run the command of a message, timing how long answering it takes. If the command
+        has a ttl and the same thing was asked recently, the cached reply is returned instead
+
+        Args:
+            responder: the object the handlers were written for (e.g. a ChatResponder)
+            msg: message text
+            sender: ID of sender
+            channel: ID of channel
+
+        Return:
+            name: name of the command that ran, or None if nothing matched
+            reply: what the handler returned
+        """
+        command, args = self.match(msg)
+        if command is None:
+            with self.lock:
+                self.unmatched += 1
+            return None, None
+
+        start = time.time()
+        try:
+            ttl = command.ttl(args) if callable(command.ttl) else command.ttl
+            if ttl:
+                key = (command.name, _normalize(args))
+                reply = self.cache.get(key)
+                if reply is not None:
+                    return command.name, reply
+
+            reply = command.handler(responder, args, sender, channel)
+            if ttl and reply is not None:
+                self.cache.put(key, reply, ttl)
+            return command.name, reply
+        finally:
+            elapsed = time.time() - start
+            command_seconds.observe(elapsed, command=command.name)
+            with self.lock:
+                timing = self.timings[command.name]
+                timing[0] += 1
+                timing[1] += elapsed
+                timing[2] = max(timing[2], elapsed)
+
+    def stats(self):
+        """
+        Return:
+            stats: dict with "commands", a dict of command name -> calls and mean and max
+                   seconds spent answering it (cache hits included, see "cache" for how many
+                   there were), "unmatched", the number of messages
+                   that didn't match any command, and "cache", the ResponseCache stats
+        """
+        with self.lock:
+            timings = {name: {"calls": calls, "mean": total / calls if calls > 0 else 0., "max": longest}
+                       for name, (calls, total, longest) in self.timings.items()}
+            return {"commands": timings, "unmatched": self.unmatched, "cache": self.cache.stats()}
+
+
+class ResponseCache(object):
+    """
+    Replies to recent commands, each kept until its own expiry time. Keys are
+    (command name, normalized arguments), and hits and misses are counted per command.
+    """
+    def __init__(self, max_entries=256):
+        """
+        Runs on creation
+
+        Args:
+            max_entries: most replies to keep. The ones closest to expiring go first
+        """
+        self.max_entries = max_entries
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.hits = {}
+        self.misses = {}
+
+    def get(self, key):
+        """
+        Args:
+            key: (command name, normalized arguments)
+
+        Return:
+            reply: the cached reply, or None if there isn't one that's still good
+        """
+        name = key[0]
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > time.time():
+                self.hits[name] = self.hits.get(name, 0) + 1
+                return entry[1]
+            self.misses[name] = self.misses.get(name, 0) + 1
+            return None
+
+    def put(self, key, reply, ttl):
+        """
+        Args:
+            key: (command name, normalized arguments)
+            reply: the reply
+            ttl: seconds it's good for
+        """
+        now = time.time()
+        with self.lock:
+            self.entries[key] = (now + ttl, reply)
+            if len(self.entries) > self.max_entries:
+                # drop whatever has expired, and if that's not enough, whatever expires soonest
+                self.entries = {key: entry for key, entry in self.entries.items() if entry[0] > now}
+                while len(self.entries) > self.max_entries:
+                    del self.entries[min(self.entries, key=lambda key: self.entries[key][0])]
+
+    def stats(self):
+        """
+        Return:
+            stats: dict of command name -> hits and misses, plus the number of cached replies
+        """
+        with self.lock:
+            names = set(self.hits) | set(self.misses)
+            return {"entries": len(self.entries),
+                    "commands": {name: {"hits": self.hits.get(name, 0), "misses": self.misses.get(name, 0)} for name in names}}
+
+
+def until_next(period):
+    """
+    A ttl for replies that only change when the clock ticks over, e.g. until_next(60)
+    keeps a reply until the start of the next minute
+
+    Args:
+        period: seconds
+
+    Return:
+        ttl: function of a command's args giving the seconds until the next multiple of period
+    """
+    def ttl(args):
+        return period - time.time() % period
+    return ttl
+
+
+def _normalize(text):
+    """
+    Uppercase and collapse whitespace, so exact matches don't care about either
+    """
+    return " ".join(text.upper().split())
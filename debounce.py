@@ -0,0 +1,138 @@
+import os
+import time
+import threading
+
+import botlog
+
+log = botlog.get_logger("debounce")
+
+
+class Debouncer(object):
+    """
+    Coalesces bursts of file system events into one callback per file. A file is only
+    handed off once no events have come in for it for a quiet period and its size and
+    mtime have stopped changing, so we don't pick up files Dropbox is still syncing.
+    All the waiting happens on one scheduler thread, no matter how many events come in.
+    """
+    def __init__(self, callback, quiet_period=3.):
+        """
+        Runs on creation
+
+        Args:
+            callback: function to call with the path of each file that has settled down
+            quiet_period: seconds a file needs to be left alone before it's dispatched
+        """
+        self.callback = callback
+        self.quiet_period = quiet_period
+        self.pending = {} # path -> [time to check it, (size, mtime) when last checked]
+        self.cond = threading.Condition()
+        self.events_received = 0
+        self.jobs_dispatched = 0
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        """
+        Start the scheduler thread
+        """
+        self.running = True
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop the scheduler thread. Anything still pending is dropped
+        """
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        if self.thread is not None:
+            self.thread.join()
+
+    def submit(self, path):
+        """
+        Note that something happened to a file
+
+        Args:
+            path: path of the file
+        """
+        deadline = time.time() + self.quiet_period
+        with self.cond:
+            self.events_received += 1
+            entry = self.pending.get(path)
+            if entry is not None:
+                # already waiting on this one, just push it back
+                entry[0] = deadline
+                return
+            self.pending[path] = [deadline, None]
+            self.cond.notify()
+        # remember what it looked like at the first event
+        signature = _signature(path)
+        with self.cond:
+            entry = self.pending.get(path)
+            if entry is not None and entry[1] is None:
+                entry[1] = signature
+
+    def stats(self):
+        """
+        Return:
+            stats: dict of events received, jobs dispatched and files still waiting
+        """
+        with self.cond:
+            return {"events_received": self.events_received,
+                    "jobs_dispatched": self.jobs_dispatched,
+                    "pending": len(self.pending)}
+
+    def _run(self):
+        """
+        Scheduler thread. Sleeps until the next file is due, then checks on it
+        """
+        while True:
+            with self.cond:
+                while self.running:
+                    now = time.time()
+                    due = [path for path, entry in self.pending.items() if entry[0] <= now]
+                    if len(due) > 0:
+                        break
+                    if len(self.pending) > 0:
+                        self.cond.wait(min(entry[0] for entry in self.pending.values()) - now)
+                    else:
+                        self.cond.wait()
+                if not self.running:
+                    return
+                checks = [(path, self.pending[path][1]) for path in due]
+
+            for path, last_signature in checks:
+                signature = _signature(path)
+                with self.cond:
+                    entry = self.pending.get(path)
+                    if entry is None:
+                        continue
+                    if signature is None:
+                        # file is gone
+                        del self.pending[path]
+                        continue
+                    if signature != last_signature or entry[0] > time.time():
+                        # still changing, give it another quiet period
+                        entry[0] = max(entry[0], time.time() + self.quiet_period)
+                        entry[1] = signature
+                        continue
+                    del self.pending[path]
+                    self.jobs_dispatched += 1
+                try:
+                    self.callback(path)
+                except Exception as e:
+                    log.exception("Error handling %s", path)
+
+
+def _signature(path):
+    """
+    Return:
+        (size, mtime) of a file, or None if it doesn't exist
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime
@@ -1,9 +1,20 @@
 import os
+import io
+import sys
+import copy
+import threading
 import matplotlib
-import matplotlib.pylab as plt
+import matplotlib.image
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 import astropy.io.fits as fits
 import numpy as np
 
+import botlog
+import stretch as stretch_module
+
+log = botlog.get_logger("display_image")
+
 def get_title_from_filename(filename):
     """
     Generate title by parsing filename
@@ -26,23 +37,137 @@ def get_title_from_filename(filename):
     return title
 
 
-def save_klcube_image(filename, outputname, title=None):
+def read_klmode_frame(filename, klmode_index=3):
+    """
+    Read a single KL mode out of a KL Mode cube. The file is memory mapped and only
+    the requested plane is read, so the rest of the cube never gets loaded into memory
+    
+    Args:
+        filename: path to KL Mode cube
+        klmode_index: index of the KL mode plane to read
+        
+    Return:
+        frame: 2-D image of that KL mode (a copy that doesn't depend on the file staying open)
+    """
+    # astropy refuses to memory map scaled integer data, so do the scaling ourselves
+    with fits.open(filename, memmap=True, do_not_scale_image_data=True) as hdulist:
+        hdu = hdulist[1]
+        frame = np.array(hdu.section[klmode_index], dtype=float)
+        header = hdu.header
+        if 'BLANK' in header:
+            frame[frame == header['BLANK']] = np.nan
+        bscale = header.get('BSCALE', 1)
+        bzero = header.get('BZERO', 0)
+    if bscale != 1:
+        frame *= bscale
+    if bzero != 0:
+        frame += bzero
+    return frame
+
+
+class KLCubeRenderer(object):
+    """
+    Draws KL mode frames onto a single preallocated Agg figure. Only the image data,
+    color scale and labels change between images, so nothing piles up in pyplot
+    no matter how many images the bot makes.
+    """
+    def __init__(self):
+        """
+        Runs on creation. Sets up the figure, axes and colorbar once
+        """
+        self.lock = threading.Lock()
+        self.fig = Figure()
+        self.canvas = FigureCanvasAgg(self.fig)
+        self.ax = self.fig.add_subplot(111)
+
+        # set colormap to have nans as black
+        cmap = copy.copy(matplotlib.cm.viridis)
+        cmap.set_bad('k',1.)
+
+        self.im = self.ax.imshow(np.zeros((2, 2)), cmap=cmap, origin='lower')
+        self.cbar = self.fig.colorbar(self.im, ax=self.ax, orientation='vertical', shrink=0.9, pad=0.015)
+        self.cbar.set_label("Contrast", fontsize=12)
+        self.cbar.ax.tick_params(labelsize=12)
+
+    def render(self, frame, outputname, title=None, stretch='log', sample_step=1):
+        """
+        Plot a (throughput corrected) KL mode frame and save it as a PNG
+
+        Args:
+            frame: 2-D image
+            outputname: output PNG filepath, or a writable file-like object
+            title: title of the plot
+            stretch: 'log', 'asinh' or 'linear'
+            sample_step: estimate the upper color limit from every sample_step-th pixel (see stretch.stretch_frame)
+        """
+        stretched = stretch_module.stretch_frame(frame, kind=stretch, sample_step=sample_step)
+
+        with self.lock:
+            # swap in the new image and let the axes follow its shape
+            ny, nx = stretched.image.shape
+            self.im.set_data(stretched.image)
+            self.im.set_extent((-0.5, nx - 0.5, -0.5, ny - 0.5))
+            self.ax.set_xlim(-0.5, nx - 0.5)
+            self.ax.set_ylim(-0.5, ny - 0.5)
+            self.im.set_clim(stretched.vmin, stretched.vmax)
+
+            # update colorbar
+            self.cbar.update_normal(self.im)
+            self.cbar.set_ticks(stretched.ticks)
+            self.cbar.ax.set_yticklabels(stretched.ticklabels)
+
+            self.ax.set_title(title)
+
+            self.fig.savefig(outputname, format='png')
+
+
+_renderer = None
+
+def get_renderer():
+    """
+    Get the renderer of this process, creating it the first time
+
+    Return:
+        renderer: a KLCubeRenderer
+    """
+    global _renderer
+    if _renderer is None:
+        _renderer = KLCubeRenderer()
+    return _renderer
+
+
+def save_klcube_image(filename, outputname, title=None, klmode_index=3, stretch='log', sample_step=1):
     """
     Open the PSF Subtraction saved as a KL Mode Cube and write the image as a PNG
     in the path as specified by outputname
     
     Args:
         filename: path to KL Mode cube to display
-        outputname: output PNG filepath
+        outputname: output PNG filepath, or a writable file-like object
         title: title of saved PNG plot
+        klmode_index: which KL mode of the cube to show
+        stretch: 'log', 'asinh' or 'linear'
+        sample_step: estimate the upper color limit from every sample_step-th pixel (see stretch.stretch_frame)
         
     Return:
         None
     """
-    hdulist = fits.open(filename)
-    klcube = hdulist[1].data
-    frame50 = klcube[3]
-    hdulist.close()
+    frame50 = load_klcube_frame(filename, klmode_index)
+    get_renderer().render(frame50, outputname, title=title, stretch=stretch, sample_step=sample_step)
+
+
+def load_klcube_frame(filename, klmode_index=3):
+    """
+    Read the KL mode frame we show out of a KL Mode cube, throughput corrected
+
+    Args:
+        filename: path to KL Mode cube
+        klmode_index: which KL mode of the cube to show
+
+    Return:
+        frame: 2-D image in contrast units
+    """
+    frame50 = read_klmode_frame(filename, klmode_index)
     
     # rough throuhghput calibration
     if 'methane' in filename:
@@ -50,35 +175,73 @@ def save_klcube_image(filename, outputname, title=None):
     else:
         throughput_corr = 0.65
     frame50 /= throughput_corr
-    
-    # make strictly positive for log stretch
-    minval = np.nanmin(frame50) - 1
-    log_frame = np.log(frame50 - minval)
-       
-    limits = [-3.e-7, np.min([np.nanpercentile(frame50, 99.6), 8.e-5])]
-    
-    # set colormap to have nans as black
-    cmap = matplotlib.cm.viridis
-    cmap.set_bad('k',1.)
-    
-    # plot
-    fig = plt.figure()
-    ax = fig.add_subplot(111)
-    im = ax.imshow(log_frame, cmap=cmap, vmin=np.log(limits[0]-minval), vmax=np.log(limits[1]-minval))
-    ax.invert_yaxis()
+    log.debug("Loaded %s", filename, extra={"klmode_index": klmode_index, "shape": frame50.shape, "throughput_corr": throughput_corr})
+    return frame50
 
-    
-    #add colorbar
-    cbar = plt.colorbar(im, orientation='vertical', shrink=0.9, pad=0.015, ticks=[np.log(limits[0]-minval),np.log(-minval), (np.log(limits[0]-minval)*2 + np.log(limits[1]-minval))/3., (np.log(limits[0]-minval) + np.log(limits[1]-minval)*2)/3. ,np.log(limits[1]-minval)])
-    cbar.ax.set_yticklabels(["{0:.1e}".format(limits[0]), "0", "{0:.1e}".format((np.exp((np.log(limits[0]-minval)*2 + np.log(limits[1]-minval))/3))+minval), "{0:.1e}".format((np.exp((np.log(limits[0]-minval) + np.log(limits[1]-minval)*2)/3))+minval), "{0:.1e}".format(limits[1])])
-    cbar.set_label("Contrast", fontsize=12)
-    cbar.ax.tick_params(labelsize=12) 
-    
-    ax.set_title(title)
-    
-    plt.savefig(outputname)
-    
-    
-# For testing purposes only
+
+def render_klcube_png(filename, title=None, klmode_index=3, stretch='log', sample_step=1):
+    """
+    Same as save_klcube_image, but keep the PNG in memory instead of writing it to disk
+
+    Args:
+        filename: path to KL Mode cube to display
+        title: title of the PNG plot
+        klmode_index: which KL mode of the cube to show
+        stretch: 'log', 'asinh' or 'linear'
+        sample_step: estimate the upper color limit from every sample_step-th pixel (see stretch.stretch_frame)
+
+    Return:
+        png: the PNG image as bytes
+    """
+    buf = io.BytesIO()
+    save_klcube_image(filename, buf, title=title, klmode_index=klmode_index, stretch=stretch, sample_step=sample_step)
+    return buf.getvalue()
+
+
+def save_mosaic(images, outputname, ncols=None):
+    """
+    Tile already rendered quicklook images into one contact sheet, each at its own resolution
+
+    Args:
+        images: list of PNG filepaths or file-like objects
+        outputname: output PNG filepath, or a writable file-like object
+        ncols: number of columns (default: as close to square as possible)
+
+    Return:
+        None
+    """
+    tiles = [matplotlib.image.imread(image, format='png') for image in images]
+    if ncols is None:
+        ncols = int(np.ceil(np.sqrt(len(tiles))))
+    nrows = int(np.ceil(len(tiles) / float(ncols)))
+    height = max(tile.shape[0] for tile in tiles)
+    width = max(tile.shape[1] for tile in tiles)
+
+    dpi = 100.
+    fig = Figure(figsize=(ncols * width / dpi, nrows * height / dpi), dpi=dpi)
+    canvas = FigureCanvasAgg(fig)
+    for i, tile in enumerate(tiles):
+        row, col = divmod(i, ncols)
+        ax = fig.add_axes([col / float(ncols), 1 - (row + 1) / float(nrows), 1. / ncols, 1. / nrows])
+        ax.imshow(tile)
+        ax.set_axis_off()
+    fig.savefig(outputname, format='png', dpi=dpi)
+    log.debug("Made a %dx%d mosaic of %d images", nrows, ncols, len(tiles))
+
+
+def render_mosaic_png(images, ncols=None):
+    """
+    Same as save_mosaic, but keep the PNG in memory
+
+    Return:
+        png: the PNG image as bytes
+    """
+    buf = io.BytesIO()
+    save_mosaic(images, buf, ncols=ncols)
+    return buf.getvalue()
+
+
+# For testing purposes only. See benchmarks/run_benchmarks.py for timing it
 if __name__ == "__main__":
-    save_klcube_image('C:\\Users\\jwang\\OneDrive\\GPI\\data\\Reduced\\hd95086\\pyklip-S20160229-H-k150a9s4m1-KLmodes-all.fits', "tmp.png", "HD 95086 2016-02-29 H-Spec")
+    # e.g. python display_image.py pyklip-S20160229-H-k150a9s4m1-KLmodes-all.fits tmp.png
+    save_klcube_image(sys.argv[1], sys.argv[2], os.path.basename(sys.argv[1]))
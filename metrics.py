@@ -0,0 +1,267 @@
+import time
+import bisect
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+
+# botlog uses metrics, so get the logger directly rather than through it
+log = logging.getLogger("datacruncher.metrics")
+
+# seconds. Covers everything from a cached chat reply to a slow upload
+default_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30., 60.)
+
+
+class Metric(object):
+    """
+    Base class of a metric with optional labels. Each combination of label values
+    gets its own series, created the first time it's used
+    """
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        """
+        Runs on creation
+
+        Args:
+            name: metric name, e.g. datacruncher_renders_total
+            documentation: one line description for the HELP line
+            labelnames: names of the labels each observation has to give
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError("{0} needs labels {1}, got {2}".format(self.name, self.labelnames, sorted(labels)))
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        """
+        Return:
+            samples: list of (name suffix, labels dict, value) for the exposition
+        """
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    """
+    A count that only goes up, e.g. number of events received
+    """
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.series[key] = self.series.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            return [("", dict(zip(self.labelnames, key)), value) for key, value in sorted(self.series.items())]
+
+
+class Histogram(Metric):
+    """
+    Distribution of observed values (usually latencies in seconds) in cumulative buckets
+    """
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=default_buckets):
+        """
+        Runs on creation
+
+        Args:
+            buckets: upper bounds of the buckets, in increasing order (+Inf is added)
+        """
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                # per bucket counts (not cumulative), then sum and count
+                series = self.series[key] = [[0] * (len(self.buckets) + 1), 0., 0]
+            series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def time(self, **labels):
+        """
+        Time a block of code, e.g. with render_seconds.time(): ...
+        """
+        return _Timer(self, labels)
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for key, (counts, total, count) in sorted(self.series.items()):
+                labels = dict(zip(self.labelnames, key))
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += bucket_count
+                    samples.append(("_bucket", dict(labels, le=_format_value(bound)), cumulative))
+                samples.append(("_sum", labels, total))
+                samples.append(("_count", labels, count))
+        return samples
+
+
+class _Timer(object):
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.time() - self.start, **self.labels)
+
+
+class Registry(object):
+    """
+    All the metrics we export, plus collectors that turn stats other objects already
+    keep (queue lengths, cache hits, etc.) into metrics when they're scraped
+    """
+    def __init__(self):
+        self.metrics = {}
+        self.collectors = []
+        self.lock = threading.Lock()
+
+    def _get(self, cls, name, documentation, **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, documentation, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError("{0} is already registered as a {1}".format(name, metric.kind))
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        """
+        Get a Counter, creating it the first time
+        """
+        return self._get(Counter, name, documentation, labelnames=labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=default_buckets):
+        """
+        Get a Histogram, creating it the first time
+        """
+        return self._get(Histogram, name, documentation, labelnames=labelnames, buckets=buckets)
+
+    def add_collector(self, collector):
+        """
+        Add a function that gets called on every scrape
+
+        Args:
+            collector: function returning a list of (name, kind, documentation, samples),
+                       where kind is gauge or counter and samples is a list of (labels dict, value)
+        """
+        with self.lock:
+            self.collectors.append(collector)
+
+    def render(self):
+        """
+        Return:
+            text: every metric in the Prometheus text exposition format
+        """
+        with self.lock:
+            metrics = sorted(self.metrics.values(), key=lambda metric: metric.name)
+            collectors = list(self.collectors)
+
+        lines = []
+        for metric in metrics:
+            lines.append("# HELP {0} {1}".format(metric.name, metric.documentation))
+            lines.append("# TYPE {0} {1}".format(metric.name, metric.kind))
+            for suffix, labels, value in metric.samples():
+                lines.append(_format_sample(metric.name + suffix, labels, value))
+        for collector in collectors:
+            try:
+                collected = collector()
+            except Exception as e:
+                log.exception("Metrics collector failed")
+                continue
+            for name, kind, documentation, samples in collected:
+                lines.append("# HELP {0} {1}".format(name, documentation))
+                lines.append("# TYPE {0} {1}".format(name, kind))
+                for labels, value in samples:
+                    lines.append(_format_sample(name, labels, value))
+        return "\n".join(lines) + "\n"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _format_sample(name, labels, value):
+    if len(labels) == 0:
+        return "{0} {1}".format(name, _format_value(value))
+    labeltext = ",".join('{0}="{1}"'.format(key, str(val).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                         for key, val in sorted(labels.items()))
+    return "{0}{{{1}}} {2}".format(name, labeltext, _format_value(value))
+
+
+registry = Registry()
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class MetricsServer(object):
+    """
+    Serves a Registry on /metrics over HTTP from a background thread
+    """
+    def __init__(self, registry=registry, port=9105, host="127.0.0.1"):
+        """
+        Runs on creation
+
+        Args:
+            registry: the Registry to serve
+            port: port to listen on (0 picks a free one)
+            host: interface to listen on. Only local by default
+        """
+        self.registry = registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(handler):
+                if handler.path.split("?")[0] != "/metrics":
+                    handler.send_error(404)
+                    return
+                body = self.registry.render().encode("utf-8")
+                handler.send_response(200)
+                handler.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                handler.send_header("Content-Length", str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, *args):
+                # scrapes every few seconds would drown out everything else
+                pass
+
+        self.server = _ThreadingHTTPServer((host, port), Handler)
+        self.port = self.server.server_address[1]
+        self.thread = None
+
+    def start(self):
+        """
+        Start serving in a background thread
+        """
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,91 @@
+import os
+import re
+from collections import namedtuple
+
+# every pyklip KL mode cube ends with this, so anything else can be skipped without a regex
+klmodes_suffix = "KLmodes-all.fits"
+
+ReductionProduct = namedtuple("ReductionProduct", ["name", "mode", "pattern", "template"])
+
+# Reduction products we know about, most preferred first within each mode. pattern is matched
+# against the filename of a KL mode cube and tells what mode the product is. template, if there
+# is one, gives the filename of the product for a date and band.
+# The Pol products come before spec-other, which would otherwise take Pol files with other KL
+# settings for Spec ones.
+products = (
+    ReductionProduct("spec", "Spec",
+                     re.compile(r"pyklip-S(?P<date>\d+)-(?P<band>[^-]+)-k150a9s4m1-KLmodes-all\.fits$"),
+                     "pyklip-S{date}-{band}-k150a9s4m1-KLmodes-all.fits"),
+    ReductionProduct("pol", "Pol",
+                     re.compile(r"pyklip-S(?P<date>\d+)-(?P<band>[^-]+)-pol-k100a9s1m1-ADI-KLmodes-all\.fits$"),
+                     "pyklip-S{date}-{band}-pol-k100a9s1m1-ADI-KLmodes-all.fits"),
+    # methane (spectral differential) reductions, with whatever KL settings
+    ReductionProduct("spec-methane", "Spec", re.compile(r".*-methane-KLmodes-all\.fits$"), None),
+    # reductions with KL settings other than the standard ones
+    ReductionProduct("pol-other", "Pol", re.compile(r".*-pol-.*m\d+(-ADI)?-KLmodes-all\.fits$"), None),
+    ReductionProduct("spec-other", "Spec", re.compile(r".*m\d+-KLmodes-all\.fits$"), None),
+)
+
+_products_by_mode = {}
+for _product in products:
+    _products_by_mode.setdefault(_product.mode, []).append(_product)
+
+
+def match_filename(fname, mode=None):
+    """
+    Figure out what reduction product a file is
+
+    Args:
+        fname: filename (no directory)
+        mode: Spec or Pol to only consider products of that mode (default: any)
+
+    Return:
+        product: the first matching ReductionProduct, or None if it isn't one
+    """
+    if not fname.endswith(klmodes_suffix):
+        return None
+    for product in (products if mode is None else _products_by_mode.get(mode, ())):
+        if product.pattern.match(fname) is not None:
+            return product
+    return None
+
+
+def match_path(filepath):
+    """
+    Check if a path that showed up in GPIDATA is a PSF subtraction we should post.
+    Cheap enough to run on every file system event.
+
+    Args:
+        filepath: full path to a file
+
+    Return:
+        product: the matching ReductionProduct, or None if it isn't one
+    """
+    if not filepath.endswith(klmodes_suffix):
+        return None
+    return match_filename(os.path.basename(filepath))
+
+
+def choose_file(date, band, mode, fnames):
+    """
+    Pick the KL mode cube to show for a dataset
+
+    Args:
+        date: datestring (e.g 20141212)
+        band: e.g. H
+        mode: Spec or Pol
+        fnames: KL mode cube filenames known to be in the dataset folder
+
+    Return:
+        fname: the most preferred product of this mode that's there, or None if none of them are
+    """
+    for product in _products_by_mode.get(mode, ()):
+        if product.template is not None:
+            fname = product.template.format(date=date, band=band)
+            if fname in fnames:
+                return fname
+        else:
+            matches = sorted(fname for fname in fnames if product.pattern.match(fname) is not None)
+            if len(matches) > 0:
+                return matches[0]
+    return None
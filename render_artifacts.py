@@ -0,0 +1,76 @@
+import os
+import itertools
+import tempfile
+import threading
+
+
+class ArtifactManager(object):
+    """
+    Hands out a private output path to every render job so that concurrent
+    renders never write over each other's images, and cleans them up once
+    they've been uploaded
+    """
+    def __init__(self, workdir=None):
+        """
+        Runs on creation
+
+        Args:
+            workdir: directory to put rendered images in. Defaults to a new temporary directory
+        """
+        if workdir is None:
+            workdir = tempfile.mkdtemp(prefix="datacruncher_")
+        elif not os.path.isdir(workdir):
+            os.makedirs(workdir)
+        self.workdir = workdir
+        self.counter = itertools.count(1)
+        self.live = set()
+        self.lock = threading.Lock()
+
+    def allocate(self, title=None):
+        """
+        Reserve a unique output path
+
+        Args:
+            title: plot title, used to make the filename readable
+
+        Return:
+            path: full path of a PNG file that nobody else will write to
+        """
+        with self.lock:
+            number = next(self.counter)
+        label = "quicklook" if title is None else "".join(c if c.isalnum() else "_" for c in title)
+        path = os.path.join(self.workdir, "{0}-{1:06d}-{2}.png".format(os.getpid(), number, label))
+        with self.lock:
+            self.live.add(path)
+        return path
+
+    def release(self, path):
+        """
+        Delete an output file once we are done with it
+
+        Args:
+            path: a path returned by allocate()
+        """
+        with self.lock:
+            if path not in self.live:
+                return
+            self.live.discard(path)
+        try:
+            os.remove(path)
+        except OSError:
+            # never got written, e.g. the render failed
+            pass
+
+    def cleanup(self):
+        """
+        Delete every output file that hasn't been released yet, and the working directory
+        if it's empty
+        """
+        with self.lock:
+            paths = list(self.live)
+        for path in paths:
+            self.release(path)
+        try:
+            os.rmdir(self.workdir)
+        except OSError:
+            pass
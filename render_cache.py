@@ -0,0 +1,168 @@
+import os
+import shutil
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+class RenderCache(object):
+    """
+    On-disk cache of rendered PNGs, keyed by the content of the request so that
+    asking for the same image twice does not touch the FITS file again.
+    Least recently used images get evicted once the cache is over budget.
+    """
+    def __init__(self, cachedir, max_bytes=200*1024*1024):
+        """
+        Runs on creation
+
+        Args:
+            cachedir: directory to store cached PNGs in (created if it doesn't exist)
+            max_bytes: maximum total size of the cached PNGs
+        """
+        self.cachedir = cachedir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict() # key -> size in bytes, least recently used first
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+
+        # pick up what's already on disk, oldest access first
+        cached = []
+        for fname in os.listdir(cachedir):
+            if not fname.endswith(".png"):
+                continue
+            stat = os.stat(os.path.join(cachedir, fname))
+            cached.append((stat.st_mtime, fname[:-4], stat.st_size))
+        for mtime, key, size in sorted(cached):
+            self.entries[key] = size
+            self.total_bytes += size
+        with self.lock:
+            self._evict()
+
+    def make_key(self, filename, title=None, **params):
+        """
+        Make the cache key of a render request
+
+        Args:
+            filename: path to KL Mode cube
+            title: title of the plot
+            params: any other parameters that change the rendered image
+
+        Return:
+            key: hex digest identifying the request, or None if the file can't be read
+        """
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return None
+        fields = [os.path.abspath(filename), str(stat.st_size), repr(stat.st_mtime), repr(title)]
+        fields += ["{0}={1!r}".format(name, params[name]) for name in sorted(params)]
+        return hashlib.sha1("\n".join(fields).encode("utf-8")).hexdigest()
+
+    def path(self, key):
+        """
+        Return:
+            path: where the PNG for this key lives in the cache
+        """
+        return os.path.join(self.cachedir, "{0}.png".format(key))
+
+    def get(self, key):
+        """
+        Look up a rendered PNG
+
+        Args:
+            key: cache key from make_key()
+
+        Return:
+            path: path to the cached PNG, or None if it's not cached
+        """
+        with self.lock:
+            if key is None or key not in self.entries:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            cachepath = self.path(key)
+        try:
+            # persist the access time for LRU ordering across restarts
+            os.utime(cachepath, None)
+        except OSError:
+            # someone cleaned up the cache behind our backs
+            with self.lock:
+                self._remove(key)
+            return None
+        return cachepath
+
+    def read(self, key):
+        """
+        Look up a rendered PNG and read it into memory
+
+        Args:
+            key: cache key from make_key()
+
+        Return:
+            png: the cached PNG as bytes, or None if it's not cached
+        """
+        cachepath = self.get(key)
+        if cachepath is None:
+            return None
+        try:
+            with open(cachepath, 'rb') as f:
+                return f.read()
+        except (IOError, OSError):
+            return None
+
+    def put(self, key, png):
+        """
+        Add a rendered PNG to the cache
+
+        Args:
+            key: cache key from make_key()
+            png: path to the PNG to copy into the cache, or the PNG itself as bytes
+        """
+        if key is None:
+            return
+        # write to a temporary file first so readers never see a partial PNG
+        fd, tmppath = tempfile.mkstemp(suffix=".tmp", dir=self.cachedir)
+        if isinstance(png, bytes):
+            with os.fdopen(fd, 'wb') as f:
+                f.write(png)
+        else:
+            os.close(fd)
+            shutil.copyfile(png, tmppath)
+        size = os.path.getsize(tmppath)
+        os.replace(tmppath, self.path(key))
+
+        with self.lock:
+            if key in self.entries:
+                self.total_bytes -= self.entries[key]
+            self.entries[key] = size
+            self.entries.move_to_end(key)
+            self.total_bytes += size
+            self._evict()
+
+    def _evict(self):
+        """
+        Drop least recently used PNGs until we're under budget. Call with the lock held
+        """
+        while self.total_bytes > self.max_bytes and len(self.entries) > 0:
+            key = next(iter(self.entries))
+            self._remove(key)
+
+    def _remove(self, key):
+        """
+        Forget about a cached PNG and delete it. Call with the lock held
+        """
+        size = self.entries.pop(key, None)
+        if size is None:
+            return
+        self.total_bytes -= size
+        try:
+            os.remove(self.path(key))
+        except OSError:
+            pass
@@ -0,0 +1,298 @@
+import io
+import time
+import logging
+import itertools
+import multiprocessing
+import shutil
+import threading
+from collections import namedtuple
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import botlog
+import display_image
+import metrics
+import render_artifacts
+
+render_seconds = metrics.registry.histogram(
+    "datacruncher_render_seconds", "Time from submitting a render job to its image being ready", ["source"])
+fits_load_seconds = metrics.registry.histogram(
+    "datacruncher_fits_load_seconds", "Time a render worker spends reading the KL mode frame")
+draw_seconds = metrics.registry.histogram(
+    "datacruncher_render_draw_seconds", "Time a render worker spends plotting and encoding the PNG")
+render_failures = metrics.registry.counter(
+    "datacruncher_render_failures_total", "Render jobs that raised an error")
+pool_restarts = metrics.registry.counter(
+    "datacruncher_render_pool_restarts_total", "Times the render worker pool broke and was started over")
+
+log = botlog.get_logger("render")
+
+
+class RenderQueueFull(Exception):
+    """
+    Raised when a render job is submitted without blocking and the queue is full
+    """
+    pass
+
+
+RenderJob = namedtuple("RenderJob", ["job_id", "filename", "title", "future"])
+
+
+class RenderService(object):
+    """
+    Renders KL mode cubes in a pool of worker processes so that FITS loading
+    and matplotlib plotting never block the threads that talk to Slack
+    """
+    def __init__(self, max_workers=None, max_pending=16, cache=None, artifacts=None, in_memory=False, sample_step=1):
+        """
+        Runs on creation
+
+        Args:
+            max_workers: number of worker processes (default: number of CPUs)
+            max_pending: maximum number of jobs queued or running at once
+            cache: a RenderCache to check before rendering (optional)
+            artifacts: an ArtifactManager to get output paths from (default: a new one in a temp dir)
+            in_memory: if True, jobs resolve to the PNG as bytes and nothing is written to disk
+            sample_step: default sample_step of jobs (see stretch.stretch_frame)
+        """
+        if max_workers is None:
+            max_workers = multiprocessing.cpu_count()
+        self.max_workers = max_workers
+        # start workers from a clean process rather than forking this one, whose other threads
+        # (logging, Slack, watchdog) might be holding locks the worker would never see released
+        method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        self.mp_context = multiprocessing.get_context(method)
+        self.executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=self.mp_context)
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.job_ids = itertools.count(1)
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.cache = cache
+        self.in_memory = in_memory
+        self.sample_step = sample_step
+        if artifacts is None and not in_memory:
+            artifacts = render_artifacts.ArtifactManager()
+        self.artifacts = artifacts
+
+    def submit(self, filename, title=None, klmode_index=3, stretch='log', sample_step=None, block=True, timeout=None):
+        """
+        Queue up a KL mode cube to be rendered to a PNG
+
+        Args:
+            filename: path to KL Mode cube to display
+            title: title of saved PNG plot
+            klmode_index: which KL mode of the cube to show
+            stretch: 'log', 'asinh' or 'linear'
+            sample_step: estimate the upper color limit from every sample_step-th pixel
+                         (default: the service's sample_step)
+            block: if True, wait for a free slot in the queue. Otherwise raise RenderQueueFull
+            timeout: maximum number of seconds to wait for a free slot when blocking
+
+        Return:
+            job: a RenderJob. job.future resolves to the PNG path when the image is written,
+                 or to the PNG bytes for an in memory service. Pass the result to release()
+                 once you are done with it.
+        """
+        # already made this exact image? Then skip the FITS file entirely
+        start = time.time()
+        if sample_step is None:
+            sample_step = self.sample_step
+        cachekey = None
+        if self.cache is not None:
+            cachekey = self.cache.make_key(filename, title=title, klmode_index=klmode_index, stretch=stretch,
+                                           sample_step=sample_step)
+            if self.in_memory:
+                png = self.cache.read(cachekey)
+                if png is not None:
+                    render_seconds.observe(time.time() - start, source="cache")
+                    return self._finished_job(filename, title, png)
+            else:
+                cachepath = self.cache.get(cachekey)
+                if cachepath is not None:
+                    render_seconds.observe(time.time() - start, source="cache")
+                    return self._cached_job(cachepath, filename, title)
+
+        if block:
+            acquired = self.slots.acquire(True, timeout)
+        else:
+            acquired = self.slots.acquire(False)
+        if not acquired:
+            raise RenderQueueFull("Render queue is full, could not queue {0}".format(filename))
+
+        with self.lock:
+            job_id = next(self.job_ids)
+
+        outputname = None
+        try:
+            if not self.in_memory:
+                outputname = self.artifacts.allocate(title)
+            log_level = logging.getLogger(botlog.root_name).getEffectiveLevel()
+            args = (_render, filename, outputname, title, klmode_index, stretch, sample_step, log_level)
+            executor = self.executor
+            try:
+                worker_future = executor.submit(*args)
+            except BrokenProcessPool:
+                # a worker died (e.g. killed for running out of memory), which takes the whole pool
+                # with it. Start a new one and give this job a go on that
+                executor = self._restart_executor(executor)
+                worker_future = executor.submit(*args)
+        except Exception:
+            self.release(outputname)
+            self.slots.release()
+            raise
+
+        job = RenderJob(job_id, filename, title, Future())
+        with self.lock:
+            self.jobs[job_id] = job
+        worker_future.add_done_callback(lambda f: self._job_done(job_id, f, outputname, cachekey, start, executor))
+        return job
+
+    def _restart_executor(self, broken):
+        """
+        Replace a broken worker pool with a new one, unless another thread got there first
+
+        Args:
+            broken: the ProcessPoolExecutor that raised BrokenProcessPool
+
+        Return:
+            executor: the ProcessPoolExecutor to submit to now
+        """
+        with self.lock:
+            if self.executor is broken:
+                log.error("Render worker pool broke, starting a new one")
+                pool_restarts.inc()
+                self.executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=self.mp_context)
+                broken.shutdown(wait=False)
+            return self.executor
+
+    def _finished_job(self, filename, title, png):
+        """
+        Make an already finished job out of an image we already have in memory
+        """
+        with self.lock:
+            job_id = next(self.job_ids)
+        future = Future()
+        future.set_result(png)
+        return RenderJob(job_id, filename, title, future)
+
+    def _cached_job(self, cachepath, filename, title):
+        """
+        Make an already finished job out of a cached image
+        """
+        with self.lock:
+            job_id = next(self.job_ids)
+        outputname = self.artifacts.allocate(title)
+        future = Future()
+        try:
+            shutil.copyfile(cachepath, outputname)
+            future.set_result(outputname)
+        except (IOError, OSError) as e:
+            self.artifacts.release(outputname)
+            future.set_exception(e)
+        return RenderJob(job_id, filename, title, future)
+
+    def _job_done(self, job_id, worker_future, outputname, cachekey=None, start=None, executor=None):
+        """
+        Free up the queue slot of a finished job, record how long it took, remember
+        its image and hand the image to whoever is waiting on the job
+        """
+        with self.lock:
+            job = self.jobs.pop(job_id, None)
+        self.slots.release()
+
+        if job is None:
+            return
+        if not worker_future.cancelled() and isinstance(worker_future.exception(), BrokenProcessPool):
+            # every job running in the pool fails with it. Fail them, but get the next ones a working pool
+            self._restart_executor(executor)
+        if worker_future.cancelled() or worker_future.exception() is not None:
+            # nobody is going to upload this one
+            render_failures.inc()
+            self.release(outputname)
+            if worker_future.cancelled():
+                job.future.cancel()
+            else:
+                job.future.set_exception(worker_future.exception())
+            return
+
+        result, timings, records = worker_future.result()
+        botlog.replay(records)
+        fits_load_seconds.observe(timings["fits_load"])
+        draw_seconds.observe(timings["draw"])
+        if start is not None:
+            render_seconds.observe(time.time() - start, source="worker")
+        if self.cache is not None:
+            try:
+                self.cache.put(cachekey, result)
+            except (IOError, OSError) as e:
+                log.warning("Couldn't cache image for %s", job.filename, exc_info=e)
+        job.future.set_result(result)
+
+    def release(self, outputname):
+        """
+        Clean up the PNG of a finished job once it has been uploaded
+
+        Args:
+            outputname: what the job's future resolved to
+        """
+        # in memory images just get garbage collected
+        if outputname is None or isinstance(outputname, bytes):
+            return
+        self.artifacts.release(outputname)
+
+    def pending(self):
+        """
+        Return:
+            jobs: list of RenderJobs that are queued or running
+        """
+        with self.lock:
+            return list(self.jobs.values())
+
+    def shutdown(self, wait=True):
+        """
+        Stop accepting jobs and shut down the worker processes
+        """
+        self.executor.shutdown(wait=wait)
+        if self.artifacts is not None:
+            self.artifacts.cleanup()
+
+
+def open_image(outputname):
+    """
+    Get something that can be handed to Slacker's files.upload
+
+    Args:
+        outputname: what a render job's future resolved to
+
+    Return:
+        image: a file path, or a file-like object for in memory images
+    """
+    if isinstance(outputname, bytes):
+        return io.BytesIO(outputname)
+    return outputname
+
+
+def _render(filename, outputname, title, klmode_index, stretch, sample_step=1, log_level=logging.INFO):
+    """
+    Runs in a worker process. Metrics and logs don't make it back from the workers on their own,
+    so hand back how long each step took and what got logged along with the image
+
+    Return:
+        result: outputname, or the PNG bytes if outputname is None
+        timings: dict of seconds spent loading the FITS frame and drawing the image
+        records: what was logged at log_level and up, to pass to botlog.replay
+    """
+    collector = botlog.collect(log_level)
+    # anything left over is from a job that failed
+    collector.take()
+    start = time.time()
+    frame = display_image.load_klcube_frame(filename, klmode_index)
+    loaded = time.time()
+    if outputname is None:
+        buf = io.BytesIO()
+        display_image.get_renderer().render(frame, buf, title=title, stretch=stretch, sample_step=sample_step)
+        result = buf.getvalue()
+    else:
+        display_image.get_renderer().render(frame, outputname, title=title, stretch=stretch, sample_step=sample_step)
+        result = outputname
+    return result, {"fits_load": loaded - start, "draw": time.time() - loaded}, collector.take()
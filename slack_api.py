@@ -0,0 +1,255 @@
+import time
+import queue
+import threading
+from concurrent.futures import Future
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+api_seconds = metrics.registry.histogram(
+    "datacruncher_slack_api_seconds", "Time each Slack Web API HTTP request takes", ["method"])
+api_calls = metrics.registry.counter(
+    "datacruncher_slack_api_calls_total", "Slack Web API HTTP requests by how they turned out", ["method", "outcome"])
+queue_seconds = metrics.registry.histogram(
+    "datacruncher_slack_api_queue_seconds", "Time a Slack Web API call waits in its tier's queue and token bucket", ["method"])
+dropped_calls = metrics.registry.counter(
+    "datacruncher_slack_api_dropped_total", "Slack Web API calls dropped because their tier's queue was full", ["method"])
+
+
+class OutboundQueueFull(Exception):
+    """
+    Raised when too many Slack API calls are already waiting to go out
+    """
+    pass
+
+
+# Slack's rate limit tiers, in calls per minute. https://api.slack.com/docs/rate-limits
+tier_rates = {
+    1: 1.,
+    2: 20.,
+    3: 50.,
+    4: 100.,
+    # chat.postMessage gets its own limit of about one message per second
+    "post": 60.,
+}
+
+method_tiers = {
+    "rtm.connect": 1,
+    "files.upload": 2,
+    "chat.postMessage": "post",
+}
+default_tier = 3
+
+
+class TokenBucket(object):
+    """
+    Lets calls through at a steady rate, with some room for short bursts
+    """
+    def __init__(self, rate, burst=1):
+        """
+        Runs on creation
+
+        Args:
+            rate: calls per second
+            burst: number of calls that can go out back to back after a quiet spell
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """
+        Block until a call is allowed, and use up a token for it
+        """
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+    def pause(self, seconds):
+        """
+        Don't let anything through for a while, e.g. when Slack tells us to back off
+        """
+        with self.lock:
+            self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+
+class SlackAPI(object):
+    """
+    The one way the bot talks to the Slack Web API. Calls share a pool of keep-alive
+    connections, are queued per rate limit tier with a token bucket each so uploads
+    can't hold up chat replies, and get retried when Slack says to slow down.
+    """
+    def __init__(self, token, api_url="https://slack.com/api/", max_queued=100, max_retries=3, timeout=60.):
+        """
+        Runs on creation
+
+        Args:
+            token: Slack API token
+            api_url: base URL of the Slack Web API (point it somewhere else for testing)
+            max_queued: maximum number of calls waiting in each tier's queue
+            max_retries: number of times to retry a call that got rate limited or couldn't connect
+            timeout: seconds to wait on each HTTP request
+        """
+        self.api_url = api_url
+        self.max_queued = max_queued
+        self.max_retries = max_retries
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        self.session.headers["Authorization"] = "Bearer {0}".format(token)
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=len(tier_rates))
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self.lanes = {}
+        self.lock = threading.Lock()
+
+    def submit(self, method, files=None, block=True, timeout=None, **kwargs):
+        """
+        Queue up a Web API call
+
+        Args:
+            method: e.g. chat.postMessage
+            files: dict of name -> (filename, bytes) to upload as multipart form data
+            block: if the queue is full, wait for room. Otherwise raise OutboundQueueFull
+            timeout: maximum number of seconds to wait for room when blocking
+            kwargs: arguments of the method
+
+        Return:
+            future: resolves to the decoded JSON response
+        """
+        lane = self._lane(method_tiers.get(method, default_tier))
+        future = Future()
+        try:
+            lane.put((future, method, files, kwargs, time.time()), block, timeout)
+        except queue.Full:
+            dropped_calls.inc(method=method)
+            raise OutboundQueueFull("Too many Slack API calls queued, dropping {0}".format(method))
+        return future
+
+    def call(self, method, files=None, **kwargs):
+        """
+        Make a Web API call and wait for the response
+
+        Return:
+            response: the decoded JSON response
+        """
+        return self.submit(method, files=files, **kwargs).result()
+
+    def post_message(self, channel, text, block=True, timeout=None, **kwargs):
+        """
+        Queue up a chat message
+
+        Args:
+            block, timeout: what to do if the queue is full, as in submit
+
+        Return:
+            future: resolves to the response
+        """
+        return self.submit("chat.postMessage", block=block, timeout=timeout, channel=channel, text=text, **kwargs)
+
+    def upload_file(self, channel, image, filename, title, block=True, timeout=None):
+        """
+        Queue up an image upload
+
+        Args:
+            channel: channel name or ID
+            image: file path or file-like object of the image
+            filename: filename to show in Slack
+            title: title of the image
+            block, timeout: what to do if the queue is full, as in submit
+
+        Return:
+            future: resolves to the response
+        """
+        # read it now so it can be resent if the call needs retrying
+        if hasattr(image, "read"):
+            content = image.read()
+        else:
+            with open(image, 'rb') as f:
+                content = f.read()
+        return self.submit("files.upload", files={"file": (filename, content)}, block=block, timeout=timeout,
+                           channels=channel, filename=filename, title=title)
+
+    def queued(self):
+        """
+        Return:
+            queued: dict of rate limit tier -> number of calls waiting in its queue
+        """
+        with self.lock:
+            return {tier: lane.qsize() for tier, lane in self.lanes.items()}
+
+    def _lane(self, tier):
+        """
+        Get the queue of a rate limit tier, starting its worker thread the first time
+        """
+        with self.lock:
+            if tier not in self.lanes:
+                lane = queue.Queue(self.max_queued)
+                bucket = TokenBucket(tier_rates[tier] / 60., burst=max(1, int(tier_rates[tier] // 20)))
+                worker = threading.Thread(target=self._work, args=(lane, bucket))
+                worker.daemon = True
+                worker.start()
+                self.lanes[tier] = lane
+            return self.lanes[tier]
+
+    def _work(self, lane, bucket):
+        """
+        Worker thread of one tier. Sends its calls one at a time, as fast as the tier allows
+        """
+        while True:
+            future, method, files, kwargs, queued = lane.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(self._send(bucket, method, files, kwargs, queued))
+            except Exception as e:
+                future.set_exception(e)
+
+    def _send(self, bucket, method, files, kwargs, queued=None):
+        """
+        Make one call, retrying if we're rate limited or the connection fails
+        """
+        data = {key: str(value).lower() if isinstance(value, bool) else value for key, value in kwargs.items() if value is not None}
+        attempt = 0
+        while True:
+            bucket.wait()
+            if queued is not None:
+                queue_seconds.observe(time.time() - queued, method=method)
+                queued = None
+            start = time.time()
+            try:
+                resp = self.session.post(self.api_url + method, data=data, files=files, timeout=self.timeout)
+            except requests.ConnectionError:
+                api_calls.inc(method=method, outcome="connection_error")
+                if attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                time.sleep(2 ** attempt)
+                continue
+            api_seconds.observe(time.time() - start, method=method)
+
+            if resp.status_code == 429:
+                api_calls.inc(method=method, outcome="rate_limited")
+                if attempt < self.max_retries:
+                    attempt += 1
+                    retry_after = float(resp.headers.get("Retry-After", 1))
+                    bucket.pause(retry_after)
+                    continue
+            elif resp.status_code >= 400:
+                api_calls.inc(method=method, outcome="http_error")
+            resp.raise_for_status()
+            response = resp.json()
+            api_calls.inc(method=method, outcome="ok" if response.get("ok") else "slack_error")
+            return response
@@ -0,0 +1,78 @@
+import numpy as np
+from collections import namedtuple
+
+# where the colorbar ticks go, as fractions of the way from the lower to the upper limit
+# in stretched units. The tick at the data value of 0 is added separately
+tick_fractions = np.array([0., 1/3., 2/3., 1.])
+
+StretchedImage = namedtuple("StretchedImage", ["image", "vmin", "vmax", "ticks", "ticklabels"])
+
+
+def _log_stretch(minval, limits):
+    """
+    log(x - minval), which needs minval to be below every pixel
+    """
+    return (lambda x: np.log(x - minval)), (lambda y: np.exp(y) + minval)
+
+
+def _asinh_stretch(minval, limits):
+    """
+    asinh(x / softening), linear near 0 and logarithmic for bright pixels
+    """
+    softening = (limits[1] - limits[0]) / 10.
+    return (lambda x: np.arcsinh(x / softening)), (lambda y: np.sinh(y) * softening)
+
+
+def _linear_stretch(minval, limits):
+    """
+    No stretch at all
+    """
+    return (lambda x: np.asarray(x, dtype=float)), (lambda y: y)
+
+
+stretches = {
+    'log': _log_stretch,
+    'asinh': _asinh_stretch,
+    'linear': _linear_stretch,
+}
+
+
+def stretch_frame(frame, kind='log', lower=-3.e-7, upper_percentile=99.6, upper_max=8.e-5, sample_step=1):
+    """
+    Stretch a contrast image for display and work out the color limits and colorbar ticks
+
+    Args:
+        frame: 2-D contrast image
+        kind: 'log', 'asinh' or 'linear'
+        lower: lower color limit in contrast
+        upper_percentile: upper color limit is this percentile of the image...
+        upper_max: ...unless that is bigger than this
+        sample_step: estimate the percentile from every sample_step-th pixel along each axis.
+                     1 uses every pixel. Bigger is faster but approximate.
+
+    Return:
+        stretched: a StretchedImage with the stretched image, the color limits in stretched
+                   units, and the colorbar tick positions and labels
+    """
+    if kind not in stretches:
+        raise ValueError("Unknown stretch {0}. Pick one of {1}".format(kind, ", ".join(sorted(stretches))))
+
+    # make strictly positive for log stretch. Needs every pixel, a subsample could miss the minimum
+    minval = np.nanmin(frame) - 1
+
+    sample = frame if sample_step <= 1 else frame[::sample_step, ::sample_step]
+    limits = np.array([lower, min(np.nanpercentile(sample, upper_percentile), upper_max)])
+
+    forward, inverse = stretches[kind](minval, limits)
+    image = forward(frame)
+
+    # all the tick positions in one go: the limits and 0 in stretched units,
+    # then the evenly spaced ones in between
+    vmin, zero, vmax = forward(np.array([limits[0], 0., limits[1]]))
+    spaced = vmin + tick_fractions * (vmax - vmin)
+    ticks = [spaced[0], zero, spaced[1], spaced[2], spaced[3]]
+
+    middle = inverse(spaced[1:3])
+    ticklabels = ["{0:.1e}".format(limits[0]), "0", "{0:.1e}".format(middle[0]), "{0:.1e}".format(middle[1]), "{0:.1e}".format(limits[1])]
+
+    return StretchedImage(image, vmin, vmax, ticks, ticklabels)
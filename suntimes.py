@@ -1,11 +1,18 @@
 import ephem
 import pytz
 import copy
+import time
+import bisect
+import threading
+from collections import namedtuple
 from datetime import datetime, timedelta
 import numpy as np
 
+import botlog
 import timezone
 
+log = botlog.get_logger("suntimes")
+
 
 def is_dst(zonename):
     tz = pytz.timezone(zonename)
@@ -32,9 +39,195 @@ def _gemini():
     gemini.horizon = '-1:45'  # earth's horizon is below local horizontal if you're on a mountain.
     return gemini
 
-gemsouth = _gemini()
-gemsouth_twi = _gemini()
-gemsouth_twi.horizon='-12'
+# Sun and moon events we keep a table of, as (observer horizon, body, rising?, use_center)
+event_kinds = {
+    "sunrise": ('-1:45', ephem.Sun, True, False),
+    "sunset": ('-1:45', ephem.Sun, False, False),
+    "morning_12": ('-12', ephem.Sun, True, True),
+    "evening_12": ('-12', ephem.Sun, False, True),
+    "morning_18": ('-18', ephem.Sun, True, True),
+    "evening_18": ('-18', ephem.Sun, False, True),
+    "moonrise": ('-1:45', ephem.Moon, True, False),
+    "moonset": ('-1:45', ephem.Moon, False, False),
+}
+
+Night = namedtuple("Night", ["sunset", "evening_12", "evening_18", "morning_18", "morning_12", "sunrise"])
+EphemerisTable = namedtuple("EphemerisTable", ["start", "end", "events"])
+
+
+def compute_events(kind, start, end):
+    """
+    Compute every time an event happens at Gemini South between two dates
+
+    Args:
+        kind: one of event_kinds
+        start, end: ephem dates
+
+    Return:
+        times: tuple of ephem dates (as floats), in order
+    """
+    horizon, body, rising, use_center = event_kinds[kind]
+    # a fresh observer each time, so nothing is shared between threads
+    observer = _gemini()
+    observer.horizon = horizon
+    observer.date = start
+    body = body()
+    times = []
+    while True:
+        try:
+            if rising:
+                when = observer.next_rising(body, use_center=use_center)
+            else:
+                when = observer.next_setting(body, use_center=use_center)
+        except (ephem.AlwaysUpError, ephem.NeverUpError):
+            # doesn't happen today, try tomorrow
+            observer.date = observer.date + 1
+            if observer.date > end:
+                break
+            continue
+        if when > end:
+            break
+        times.append(float(when))
+        observer.date = when + ephem.minute
+    return tuple(times)
+
+
+class Ephemeris(object):
+    """
+    Table of sunrise, sunset, twilight, moonrise and moonset times at Gemini South
+    for the next few weeks. Requests are answered by looking up the table, which is
+    rebuilt once a day. The table itself is never modified after it's built, so any
+    number of threads can read it at once.
+    """
+    def __init__(self, days=31, refresh=1.):
+        """
+        Runs on creation. The table is built on first use
+
+        Args:
+            days: number of days ahead to compute
+            refresh: rebuild the table once it's this many days old
+        """
+        self.days = days
+        self.refresh = refresh
+        self.table = None
+        self.lock = threading.Lock()
+
+    def build(self, start=None):
+        """
+        Compute a new table
+
+        Args:
+            start: ephem date to start from (default: now)
+        """
+        if start is None:
+            start = ephem.now()
+        start = ephem.Date(start)
+        end = ephem.Date(start + self.days)
+        began = time.time()
+        # start the events a couple days early, so we know if the moon is up at the start
+        events = {kind: compute_events(kind, ephem.Date(start - 2), end) for kind in event_kinds}
+        self.table = EphemerisTable(float(start), float(end), events)
+        log.info("Built the ephemeris", extra={"start": str(start), "days": self.days, "seconds": time.time() - began})
+
+    def _current(self):
+        """
+        Return:
+            table: a table that's up to date, rebuilding it first if needed
+        """
+        table = self.table
+        if table is None or ephem.now() - table.start > self.refresh:
+            with self.lock:
+                # someone else might have just done it
+                table = self.table
+                if table is None or ephem.now() - table.start > self.refresh:
+                    self.build()
+                    table = self.table
+        return table
+
+    def next_event(self, kind, after=None):
+        """
+        Look up the next time something happens
+
+        Args:
+            kind: one of event_kinds, e.g. sunrise
+            after: ephem date (default: now)
+
+        Return:
+            when: ephem.Date of the event, or None if it's past the end of the table
+        """
+        if after is None:
+            after = ephem.now()
+        times = self._current().events[kind]
+        i = bisect.bisect_right(times, float(after))
+        if i == len(times):
+            return None
+        return ephem.Date(times[i])
+
+    def nights(self, count=14, after=None):
+        """
+        Sunset to sunrise times of the next few nights
+
+        Args:
+            count: number of nights
+            after: ephem date (default: now)
+
+        Return:
+            nights: list of Night, with ephem dates of each event (None if it's past the end of the table)
+        """
+        if after is None:
+            after = ephem.now()
+        table = self._current()
+        sunsets = table.events["sunset"]
+        first = bisect.bisect_right(sunsets, float(after))
+        nights = []
+        for sunset in sunsets[first:first + count]:
+            times = [sunset]
+            for kind in Night._fields[1:]:
+                events = table.events[kind]
+                i = bisect.bisect_right(events, sunset)
+                times.append(events[i] if i < len(events) else None)
+            nights.append(Night(*[ephem.Date(when) if when is not None else None for when in times]))
+        return nights
+
+    def moon_up(self, start, end):
+        """
+        When the moon is up between two times
+
+        Args:
+            start, end: ephem dates
+
+        Return:
+            windows: list of (rise, set) ephem dates, clipped to start and end
+        """
+        table = self._current()
+        rises = table.events["moonrise"]
+        sets = table.events["moonset"]
+        start, end = float(start), float(end)
+
+        # the moon is up if it rose more recently than it set
+        i = bisect.bisect_right(rises, start)
+        j = bisect.bisect_right(sets, start)
+        up_since = start if i > 0 and (j == 0 or rises[i-1] > sets[j-1]) else None
+        windows = []
+        while True:
+            next_rise = rises[i] if i < len(rises) else None
+            next_set = sets[j] if j < len(sets) else None
+            if up_since is None:
+                if next_rise is None or next_rise >= end:
+                    break
+                up_since = next_rise
+                i += 1
+            else:
+                if next_set is None or next_set >= end:
+                    windows.append((ephem.Date(up_since), ephem.Date(end)))
+                    break
+                windows.append((ephem.Date(up_since), ephem.Date(next_set)))
+                up_since = None
+                j += 1
+        return windows
+
+
+ephemeris = Ephemeris()
 
 def delta_to_now(sometime):
     deltat = (sometime - ephem.now()) # in days
@@ -55,46 +248,206 @@ def utc_to_multizone(date_utc):
 
 
 def sunrise_time_response():
-    gemsouth.date = ephem.now()
-    gemsouth_twi.date = ephem.now()
-
-    risetime = gemsouth.next_rising(ephem.Sun())
-    twitime = gemsouth_twi.next_rising(ephem.Sun(), use_center=True)
+    risetime = ephemeris.next_event("sunrise")
+    twitime = ephemeris.next_event("morning_12")
     return ("Next sunrise at Gemini South is {}, which is {} h {} m from now.".format(utc_to_multizone(risetime.datetime()), *delta_to_now(risetime)) +
             "\nAnd 12 deg twilight is at {}".format(utc_to_multizone(twitime.datetime()) ) )
 
 
 
 def sunset_time_response():
-    gemsouth.date = ephem.now()
-    gemsouth_twi.date = ephem.now()
-    settime = gemsouth.next_setting(ephem.Sun())
-
-    twitime = gemsouth_twi.next_setting(ephem.Sun(), use_center=True)
+    settime = ephemeris.next_event("sunset")
+    twitime = ephemeris.next_event("evening_12")
     return ("Next sunset at Gemini South is {}, which is {} h {} m from now.".format(utc_to_multizone(settime.datetime()), *delta_to_now(settime)) +
             "\nAnd 12 deg twilight is at {}".format(utc_to_multizone(twitime.datetime()) ) )
 
 
+def twilight_response(count=14):
+    """
+    Sunset, twilight and sunrise times for the next few nights, in Chile time
+
+    Args:
+        count: number of nights (at most as many as there are in the ephemeris table)
+
+    Return:
+        reply: a table of times
+    """
+    count = max(1, min(count, ephemeris.days - 1))
+    lines = ["Night        Sunset    12 deg    18 deg  |  18 deg    12 deg   Sunrise"]
+    for night in ephemeris.nights(count):
+        sunset = utc.localize(night.sunset.datetime()).astimezone(chile)
+        times = ["{0:>8}".format(format_time(utc.localize(when.datetime()), chile)) if when is not None else "       -"
+                 for when in night]
+        lines.append("{0}  {1}  {2}  {3}  |{4}  {5}  {6}".format(sunset.strftime('%a %b %d'), *times))
+    return ("Twilight times at Gemini South for the next {0} nights (Chile time):\n```\n{1}\n```".format(count, "\n".join(lines)))
+
+
+def lst_table_response():
+    """
+    LST at Gemini South on every hour of tonight (or the night we're in), sunset to sunrise
+
+    Return:
+        reply: a table of Chile time, UTC and LST
+    """
+    now = ephem.now()
+    # the first night that hasn't ended yet
+    night = [night for night in ephemeris.nights(2, after=now - 1) if night.sunrise is not None and night.sunrise > now][0]
+    start = np.datetime64(night.sunset.datetime(), 'h') + np.timedelta64(1, 'h')
+    end = np.datetime64(night.sunrise.datetime(), 'h')
+    hours = np.arange(start, end + np.timedelta64(1, 'h'), np.timedelta64(1, 'h'))
+    lsts = timezone.format_hours(timezone.lst_hours(hours))
+
+    lines = ["   Chile     UTC       LST"]
+    for hour, lst in zip(hours.astype(datetime), lsts):
+        lines.append("{0:>8}   {1}  {2}".format(format_time(utc.localize(hour), chile), hour.strftime('%H:%M'), lst))
+    return ("LST at Gemini South tonight (sunset {0}, sunrise {1} Chile time):\n```\n{2}\n```".format(
+        format_time(utc.localize(night.sunset.datetime()), chile), format_time(utc.localize(night.sunrise.datetime()), chile), "\n".join(lines)))
+
+
 moon_phases = [ ":new_moon:", ":waxing_crescent_moon:", ":first_quarter_moon:", ":waxing_gibbous_moon:", ":full_moon:", ":waning_gibbous_moon:", ":last_quarter_moon:", ":waning_crescent_moon:"]
-moon_observer = _gemini()
-    
-def get_current_moon_phase():
+
+
+class LunationTable(object):
     """
-    Get the current moon phase
+    Dates of the new, first quarter, full and last quarter moons over a span of years,
+    so the moon's phase at any time is a lookup between the quarters on either side of it.
+    Like Ephemeris, the table is never modified once built and is rebuilt if asked about
+    a time outside of it.
     """
-    # get the dates of the last and next new moon
-    moon_observer.date = datetime.now()
-    phase_end = ephem.next_new_moon(moon_observer.date)
-    phase_start = ephem.previous_new_moon(moon_observer.date)
+    def __init__(self, years_before=1, years_after=5):
+        """
+        Runs on creation. The table is built on first use
 
-    
-    # based on that figure out what part of the phase we are in. Phase goes from [0,1)
-    phase = (moon_observer.date - phase_start) / (phase_end - phase_start)
+        Args:
+            years_before: years before now to cover
+            years_after: years after now to cover
+        """
+        self.years_before = years_before
+        self.years_after = years_after
+        self.quarters = None
+        self.lock = threading.Lock()
+
+    def build(self, center=None):
+        """
+        Compute a new table
+
+        Args:
+            center: ephem date to build it around (default: now)
+        """
+        if center is None:
+            center = ephem.now()
+        began = time.time()
+        when = ephem.previous_new_moon(ephem.Date(center - 365.25 * self.years_before))
+        end = center + 365.25 * self.years_after
+        next_quarter = [ephem.next_first_quarter_moon, ephem.next_full_moon, ephem.next_last_quarter_moon, ephem.next_new_moon]
+        quarters = [float(when)]
+        while when < end:
+            when = next_quarter[(len(quarters) - 1) % 4](when)
+            quarters.append(float(when))
+        self.quarters = tuple(quarters)
+        log.info("Built the lunation table", extra={"quarters": len(quarters), "seconds": time.time() - began})
+
+    def phase(self, date=None):
+        """
+        How far through its cycle the moon is
+
+        Args:
+            date: ephem date (default: now)
+
+        Return:
+            phase: 0 at new moon, 0.5 at full moon, going up to 1 at the next new moon
+        """
+        if date is None:
+            date = ephem.now()
+        date = float(date)
+        quarters = self.quarters
+        if quarters is None or not quarters[0] <= date < quarters[-1]:
+            with self.lock:
+                quarters = self.quarters
+                if quarters is None or not quarters[0] <= date < quarters[-1]:
+                    self.build(date)
+                    quarters = self.quarters
+        # the table starts at a new moon, so every 4th entry is one
+        i = bisect.bisect_right(quarters, date)
+        quarter_start, quarter_end = quarters[i-1], quarters[i]
+        return ((i - 1) % 4 + (date - quarter_start) / (quarter_end - quarter_start)) / 4.
+
+    def illumination(self, date=None):
+        """
+        Approximate fraction of the moon that's lit (good to a couple percent)
+
+        Args:
+            date: ephem date (default: now)
+
+        Return:
+            illumination: 0 to 1
+        """
+        return (1 - np.cos(2 * np.pi * self.phase(date))) / 2.
+
+
+lunations = LunationTable()
+
+
+def moon_phase_emoji(phase):
+    """
+    Args:
+        phase: 0 to 1, see LunationTable.phase
+
+    Return:
+        emoji: the closest of the 8 moon_phases
+    """
     # 8 moon phases, so do this for easy indexing
-    phase *= 8 
     # round to the nearest phase and wrap aroudn for the 7.5-7.9 range mapping to 0
-    phase = round(phase) % 8
-    
-    return "The current moon phase is {0}".format(moon_phases[int(phase)])
-     
+    return moon_phases[int(round(phase * 8)) % 8]
+
     
+def get_current_moon_phase():
+    """
+    Get the current moon phase
+    """
+    return "The current moon phase is {0}".format(moon_phase_emoji(lunations.phase()))
+
+
+def moon_schedule_response(start=None, count=7):
+    """
+    Moon phase, illumination and when the moon is up during astronomical night,
+    for each night of an observing run. Times are in Chile time
+
+    Args:
+        start: datetime (UTC) of the first night of the run (default: tonight)
+        count: number of nights
+
+    Return:
+        reply: a table of the moon each night
+    """
+    count = max(1, min(count, ephemeris.days - 1))
+    table = ephemeris
+    if start is not None:
+        current = ephemeris._current()
+        if ephem.Date(start) < current.start or ephem.Date(start) + count + 1 > current.end:
+            # outside the usual table, so work out just this run. It's never rebuilt,
+            # since that would move it to start from now
+            table = Ephemeris(days=count + 1, refresh=float("inf"))
+            table.build(start)
+    after = ephem.Date(start) if start is not None else None
+
+    def local(when):
+        return format_time(utc.localize(when.datetime()), chile)
+
+    lines = []
+    for night in table.nights(count, after=after):
+        if night.sunrise is None:
+            break
+        midnight = ephem.Date((night.sunset + night.sunrise) / 2.)
+        phase = lunations.phase(midnight)
+        if night.evening_18 is not None and night.morning_18 is not None:
+            windows = table.moon_up(night.evening_18, night.morning_18)
+        else:
+            windows = table.moon_up(night.sunset, night.sunrise)
+        if len(windows) == 0:
+            moon = "down all night"
+        else:
+            moon = ", ".join("up {0} - {1}".format(local(rise), local(set)) for rise, set in windows)
+        lines.append("{0} {1} {2:3.0f}%  {3}".format(utc.localize(night.sunset.datetime()).astimezone(chile).strftime('%a %b %d'),
+                                                      moon_phase_emoji(phase), 100 * lunations.illumination(midnight), moon))
+    return "Moon schedule at Gemini South (between 18 deg twilights, Chile time):\n" + "\n".join(lines)
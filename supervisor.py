@@ -0,0 +1,138 @@
+import time
+import random
+import threading
+from collections import OrderedDict
+
+
+class Backoff(object):
+    """
+    Exponential backoff with jitter, for waiting between reconnection attempts
+    """
+    def __init__(self, base=1., maximum=300., factor=2., jitter=0.5):
+        """
+        Runs on creation
+
+        Args:
+            base: seconds to wait after the first failure
+            maximum: never wait longer than this many seconds
+            factor: how much longer to wait after each further failure
+            jitter: fraction of each wait that is randomized, so a bunch of clients don't retry in lockstep
+        """
+        self.base = base
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+        self.attempts = 0
+
+    def next_delay(self):
+        """
+        Return:
+            delay: seconds to wait before the next attempt
+        """
+        delay = min(self.maximum, self.base * self.factor ** self.attempts)
+        self.attempts += 1
+        return delay * (1 - self.jitter * random.random())
+
+    def reset(self):
+        """
+        Start over from the shortest wait, e.g. once a connection succeeds
+        """
+        self.attempts = 0
+
+
+class EventDeduper(object):
+    """
+    Remembers the most recent events so ones replayed after a reconnect are only handled once
+    """
+    def __init__(self, size=1000):
+        """
+        Runs on creation
+
+        Args:
+            size: number of recent events to remember
+        """
+        self.size = size
+        self.seen = OrderedDict()
+        self.lock = threading.Lock()
+
+    def is_duplicate(self, event):
+        """
+        Check an event and remember it
+
+        Args:
+            event: a Slack event dictionary
+
+        Return:
+            True if we've seen this event before
+        """
+        if "ts" not in event:
+            # can't tell these apart, so let them all through
+            return False
+        key = (event.get("type"), event.get("channel"), event["ts"])
+        with self.lock:
+            if key in self.seen:
+                return True
+            self.seen[key] = None
+            if len(self.seen) > self.size:
+                self.seen.popitem(last=False)
+        return False
+
+
+class ConnectionStats(object):
+    """
+    Keeps track of how often the connection drops and for how long
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connects = 0
+        self.reconnects = 0
+        self.failed_attempts = 0
+        self.downtime = 0.
+        self.down_since = time.time()
+        self.up_since = None
+
+    def connected(self):
+        """
+        Call when a connection is up
+        """
+        with self.lock:
+            now = time.time()
+            if self.connects > 0:
+                self.reconnects += 1
+                # time before the very first connection is just startup, not downtime
+                if self.down_since is not None:
+                    self.downtime += now - self.down_since
+            self.connects += 1
+            self.down_since = None
+            self.up_since = now
+
+    def disconnected(self):
+        """
+        Call when a connection drops
+        """
+        with self.lock:
+            if self.down_since is None:
+                self.down_since = time.time()
+            self.up_since = None
+
+    def failed(self):
+        """
+        Call when a connection attempt doesn't work
+        """
+        with self.lock:
+            self.failed_attempts += 1
+
+    def snapshot(self):
+        """
+        Return:
+            stats: dict of reconnects, failed attempts and total seconds spent disconnected
+        """
+        with self.lock:
+            downtime = self.downtime
+            if self.down_since is not None and self.connects > 0:
+                downtime += time.time() - self.down_since
+            return {"connects": self.connects,
+                    "reconnects": self.reconnects,
+                    "failed_attempts": self.failed_attempts,
+                    "downtime": downtime,
+                    "connected": self.up_since is not None}
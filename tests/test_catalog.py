@@ -0,0 +1,146 @@
+"""
+Tests that a ReductionCatalog kept up to date from watchdog events agrees with a full
+rescan of GPIDATA, on a synthetic GPIDATA tree.
+
+    $ python -m pytest tests
+"""
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+from watchdog.events import (DirCreatedEvent, DirDeletedEvent, DirMovedEvent,
+                             FileCreatedEvent, FileDeletedEvent, FileMovedEvent)
+
+repo = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, repo)
+sys.path.insert(0, os.path.join(repo, "benchmarks"))
+
+import catalog
+import synthetic
+
+
+class ReductionCatalogTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="test_catalog")
+        self.gpidata = os.path.join(self.workdir, "GPIDATA")
+        self.datasets = synthetic.make_gpidata_tree(self.gpidata, nobjects=6, ndatasets=3)
+        self.store = catalog.CatalogStore(os.path.join(self.workdir, "reductions.sqlite"))
+        self.catalog = catalog.ReductionCatalog(self.gpidata, self.store)
+        self.catalog.build()
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.workdir)
+
+    def folder(self, objname, name):
+        return os.path.join(self.gpidata, objname, "autoreduced", name)
+
+    def assertMatchesRescan(self):
+        rescanned = catalog.ReductionCatalog(self.gpidata)
+        rescanned.build()
+        self.assertEqual(self.catalog.index, rescanned.index)
+        # and what it saved is what a restart would load
+        reloaded = catalog.ReductionCatalog(self.gpidata, self.store)
+        reloaded.load()
+        self.assertEqual(reloaded.index, rescanned.index)
+
+        requests = [(objname, None, None, None) for objname in synthetic.objects[:8]]
+        requests += [(objname, date, band, mode) for objname, date, band, mode, _ in self.datasets]
+        requests += [(objname, date, None, None) for objname, date, _, _, _ in self.datasets]
+        requests += [(objname, None, band, None) for objname, _, band, _, _ in self.datasets]
+        for request in requests:
+            self.assertEqual(self.catalog.choose(*request), rescanned.choose(*request), request)
+
+    def test_created(self):
+        objname, date, band, mode, cube = self.datasets[0]
+        # another cube in a folder we know
+        fname = "pyklip-S{0}-{1}-k100a9s4m1-KLmodes-all.fits".format(date, band)
+        path = os.path.join(os.path.dirname(cube), fname)
+        open(path, "a").close()
+        self.catalog.on_created(FileCreatedEvent(path))
+
+        # a new folder, then a cube in it
+        dirpath = self.folder(objname, "20200101_K1_Spec")
+        os.makedirs(dirpath)
+        self.catalog.on_created(DirCreatedEvent(dirpath))
+        path = os.path.join(dirpath, synthetic.klmodes_filename("20200101", "K1", "Spec"))
+        open(path, "a").close()
+        self.catalog.on_created(FileCreatedEvent(path))
+
+        # a file that isn't a KL mode cube changes nothing
+        path = os.path.join(dirpath, "S20200101S0001_spdc.fits")
+        open(path, "a").close()
+        self.catalog.on_created(FileCreatedEvent(path))
+
+        self.assertEqual(self.catalog.choose(objname, "20200101"),
+                         ("20200101", "K1", "Spec", {synthetic.klmodes_filename("20200101", "K1", "Spec")}))
+        self.assertMatchesRescan()
+
+    def test_deleted(self):
+        objname, date, band, mode, cube = self.datasets[0]
+        os.remove(cube)
+        self.catalog.on_deleted(FileDeletedEvent(cube))
+
+        objname, date, band, mode, cube = self.datasets[4]
+        shutil.rmtree(os.path.dirname(cube))
+        self.catalog.on_deleted(DirDeletedEvent(os.path.dirname(cube)))
+        self.assertIsNone(self.catalog.choose(objname, date, band, mode))
+
+        objname = self.datasets[-1][0]
+        shutil.rmtree(os.path.join(self.gpidata, objname))
+        self.catalog.on_deleted(DirDeletedEvent(os.path.join(self.gpidata, objname)))
+        self.assertIsNone(self.catalog.choose(objname))
+
+        self.assertMatchesRescan()
+
+    def test_moved(self):
+        # a cube renamed within its folder
+        objname, date, band, mode, cube = self.datasets[0]
+        dest = os.path.join(os.path.dirname(cube), "pyklip-S{0}-{1}-k100a9s4m1-KLmodes-all.fits".format(date, band))
+        os.rename(cube, dest)
+        self.catalog.on_moved(FileMovedEvent(cube, dest))
+
+        # a dataset folder renamed, e.g. a reduction given the right date
+        objname, date, band, mode, cube = self.datasets[4]
+        src = os.path.dirname(cube)
+        dest = self.folder(objname, "20201231_{0}_{1}".format(band, mode))
+        os.rename(src, dest)
+        self.catalog.on_moved(DirMovedEvent(src, dest))
+        self.assertIsNone(self.catalog.choose(objname, date, band, mode))
+        self.assertIsNotNone(self.catalog.choose(objname, "20201231", band, mode))
+
+        # a whole object renamed
+        objname = self.datasets[-1][0]
+        src = os.path.join(self.gpidata, objname)
+        dest = os.path.join(self.gpidata, "HD_999")
+        os.rename(src, dest)
+        self.catalog.on_moved(DirMovedEvent(src, dest))
+        self.assertIsNone(self.catalog.choose(objname))
+        self.assertIsNotNone(self.catalog.choose("HD_999"))
+
+        # a cube moved out of GPIDATA altogether
+        objname, date, band, mode, cube = self.datasets[7]
+        dest = os.path.join(self.workdir, os.path.basename(cube))
+        os.rename(cube, dest)
+        self.catalog.on_moved(FileMovedEvent(cube, dest))
+
+        self.assertMatchesRescan()
+
+    def test_build_after_load_catches_up(self):
+        # changes made while the bot was down get picked up by build() after load()
+        objname, date, band, mode, cube = self.datasets[0]
+        os.remove(cube)
+        dirpath = self.folder(objname, "20200101_J_Pol")
+        os.makedirs(dirpath)
+        open(os.path.join(dirpath, synthetic.klmodes_filename("20200101", "J", "Pol")), "a").close()
+
+        self.catalog = catalog.ReductionCatalog(self.gpidata, self.store)
+        self.assertGreater(self.catalog.load(), 0)
+        self.catalog.build()
+        self.assertMatchesRescan()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,136 @@
+"""
+Tests of matching chat messages to commands and caching their replies.
+
+    $ python -m pytest tests
+"""
+import os
+import sys
+import time
+import unittest
+from unittest import mock
+
+repo = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, repo)
+
+import commands
+
+
+def handler(name):
+    def handle(responder, args, sender, channel):
+        responder.append((name, args))
+        return "{0}: {1}".format(name, args)
+    return handle
+
+
+class CommandRouterTest(unittest.TestCase):
+    def setUp(self):
+        self.router = commands.CommandRouter()
+        self.calls = []
+        self.router.register("help", handler("help"), exact=["help"])
+        self.router.register("show", handler("show"), prefixes=["SHOW ME", "SHOW"])
+        self.router.register("joke", handler("joke"), prefixes=["TELL"], requires=["JOKE"])
+        self.router.register("sunset", handler("sunset"), keywords=["SUNSET"])
+        self.router.register("help words", handler("help words"), keywords=["HELP", "what can you do"])
+        self.router.register("lst", handler("lst"), keywords=["LST"], ttl=60)
+
+    def dispatch(self, msg):
+        return self.router.dispatch(self.calls, msg, "U0001", "C0001")
+
+    def test_exact_beats_everything(self):
+        self.assertEqual(self.dispatch("  Help "), ("help", "help:   Help "))
+        self.assertEqual(self.dispatch("help me"), ("help words", "help words: help me"))
+
+    def test_longest_prefix_wins(self):
+        self.assertEqual(self.dispatch("show me c Eri"), ("show", "show: c Eri"))
+        self.assertEqual(self.dispatch("show c Eri"), ("show", "show: c Eri"))
+
+    def test_prefix_beats_keyword(self):
+        self.assertEqual(self.dispatch("show me the sunset")[0], "show")
+
+    def test_earlier_keyword_command_wins(self):
+        self.assertEqual(self.dispatch("what can you do at sunset")[0], "sunset")
+        self.assertEqual(self.dispatch("so what can you do")[0], "help words")
+
+    def test_requires(self):
+        self.assertEqual(self.dispatch("tell me a joke")[0], "joke")
+        self.assertEqual(self.dispatch("tell me the time"), (None, None))
+        self.assertEqual(self.router.stats()["unmatched"], 1)
+
+    def test_cache_hits_are_timed(self):
+        self.assertEqual(self.dispatch("what's the LST"), ("lst", "lst: what's the LST"))
+        # same question, any case and spacing, is answered from the cache
+        self.assertEqual(self.dispatch("WHAT'S  THE lst"), ("lst", "lst: what's the LST"))
+        self.assertEqual(len(self.calls), 1)
+        stats = self.router.stats()
+        self.assertEqual(stats["commands"]["lst"]["calls"], 2)
+        self.assertEqual(stats["cache"]["commands"]["lst"], {"hits": 1, "misses": 1})
+
+    def test_errors_are_timed(self):
+        def broken(responder, args, sender, channel):
+            raise RuntimeError("broken")
+        self.router.register("broken", broken, exact=["break"])
+        with self.assertRaises(RuntimeError):
+            self.dispatch("break")
+        self.assertEqual(self.router.stats()["commands"]["broken"]["calls"], 1)
+
+
+class ResponseCacheTest(unittest.TestCase):
+    def test_expires(self):
+        cache = commands.ResponseCache()
+        with mock.patch("commands.time.time", return_value=1000.):
+            cache.put(("time", "UTC"), "noon", 30)
+            self.assertEqual(cache.get(("time", "UTC")), "noon")
+        with mock.patch("commands.time.time", return_value=1029.):
+            self.assertEqual(cache.get(("time", "UTC")), "noon")
+        with mock.patch("commands.time.time", return_value=1030.):
+            self.assertIsNone(cache.get(("time", "UTC")))
+        self.assertEqual(cache.stats()["commands"]["time"], {"hits": 2, "misses": 1})
+
+    def test_evicts_whatever_expires_soonest(self):
+        cache = commands.ResponseCache(max_entries=3)
+        with mock.patch("commands.time.time", return_value=1000.):
+            cache.put(("a", ""), "a", 300)
+            cache.put(("b", ""), "b", 10)
+            cache.put(("c", ""), "c", 200)
+            cache.put(("d", ""), "d", 100)
+            self.assertIsNone(cache.get(("b", "")))
+            for name in "acd":
+                self.assertEqual(cache.get((name, "")), name)
+            cache.put(("e", ""), "e", 400)
+            self.assertIsNone(cache.get(("d", "")))
+        self.assertEqual(cache.stats()["entries"], 3)
+
+    def test_drops_expired_first(self):
+        cache = commands.ResponseCache(max_entries=2)
+        with mock.patch("commands.time.time", return_value=1000.):
+            cache.put(("a", ""), "a", 10)
+            cache.put(("b", ""), "b", 20)
+        with mock.patch("commands.time.time", return_value=1015.):
+            cache.put(("c", ""), "c", 1)
+            self.assertEqual(cache.get(("b", "")), "b")
+            self.assertEqual(cache.get(("c", "")), "c")
+
+    def test_until_next(self):
+        ttl = commands.until_next(60)
+        with mock.patch("commands.time.time", return_value=6000. + 45):
+            self.assertAlmostEqual(ttl("anything"), 15.)
+        with mock.patch("commands.time.time", return_value=6000.):
+            self.assertAlmostEqual(ttl("anything"), 60.)
+
+    def test_router_ttl_until_next(self):
+        router = commands.CommandRouter()
+        calls = []
+        router.register("minute", handler("minute"), exact=["minute"], ttl=commands.until_next(60))
+        with mock.patch("commands.time.time", return_value=6000. + 50):
+            router.dispatch(calls, "minute", "U0001", "C0001")
+        with mock.patch("commands.time.time", return_value=6000. + 59):
+            router.dispatch(calls, "minute", "U0001", "C0001")
+        self.assertEqual(len(calls), 1)
+        # a new minute, so a new answer
+        with mock.patch("commands.time.time", return_value=6000. + 61):
+            router.dispatch(calls, "minute", "U0001", "C0001")
+        self.assertEqual(len(calls), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,52 @@
+"""
+Tests of the registry of reduction products.
+
+    $ python -m pytest tests
+"""
+import os
+import sys
+import unittest
+
+repo = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, repo)
+
+import reductions
+
+spec = "pyklip-S20141218-H-k150a9s4m1-KLmodes-all.fits"
+pol = "pyklip-S20141218-H-pol-k100a9s1m1-ADI-KLmodes-all.fits"
+methane = "pyklip-S20141218-H-k150a9s4m1-methane-KLmodes-all.fits"
+spec_other = "pyklip-S20141218-H-k100a7s4m3-KLmodes-all.fits"
+pol_other = "pyklip-S20141218-H-pol-k50a9s1m1-KLmodes-all.fits"
+
+
+class ReductionsTest(unittest.TestCase):
+    def test_match_path(self):
+        folder = os.path.join("/dropbox", "GPIDATA", "c_Eri", "autoreduced", "20141218_H_{0}")
+        for fname, name, mode in [(spec, "spec", "Spec"), (pol, "pol", "Pol"), (methane, "spec-methane", "Spec"),
+                                  (spec_other, "spec-other", "Spec"), (pol_other, "pol-other", "Pol")]:
+            product = reductions.match_path(os.path.join(folder.format(mode), fname))
+            self.assertEqual((product.name, product.mode), (name, mode), fname)
+
+    def test_mode_comes_from_the_file(self):
+        # not from where it is: an object with _Pol in its name doesn't make its Spec reductions Pol
+        product = reductions.match_path(os.path.join("/dropbox", "GPIDATA", "HD_Pol", "autoreduced", "20141218_H_Spec", spec))
+        self.assertEqual(product.mode, "Spec")
+
+    def test_not_reductions(self):
+        for fname in ["S20141218S0001_spdc.fits", "pyklip-S20141218-H-k150a9s4m1-speccube.fits", "recipe.xml"]:
+            self.assertIsNone(reductions.match_path(os.path.join("/dropbox", "GPIDATA", "c_Eri", fname)))
+
+    def test_choose_file(self):
+        self.assertEqual(reductions.choose_file("20141218", "H", "Spec", {spec_other, methane, spec}), spec)
+        self.assertEqual(reductions.choose_file("20141218", "H", "Spec", {spec_other, methane}), methane)
+        self.assertEqual(reductions.choose_file("20141218", "H", "Spec", {spec_other}), spec_other)
+        self.assertEqual(reductions.choose_file("20141218", "H", "Pol", {pol_other, pol}), pol)
+        self.assertEqual(reductions.choose_file("20141218", "H", "Pol", {pol_other}), pol_other)
+
+    def test_choose_file_never_makes_up_a_name(self):
+        self.assertIsNone(reductions.choose_file("20141218", "H", "Spec", set()))
+        self.assertIsNone(reductions.choose_file("20141218", "H", "Spec", {pol}))
+
+
+if __name__ == "__main__":
+    unittest.main()
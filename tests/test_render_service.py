@@ -0,0 +1,87 @@
+"""
+Tests of the render service's worker pool, rendering synthetic KL mode cubes.
+
+    $ python -m pytest tests
+"""
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+repo = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, repo)
+sys.path.insert(0, os.path.join(repo, "benchmarks"))
+
+import render_service
+import synthetic
+
+
+def broken_executor():
+    executor = ProcessPoolExecutor(max_workers=1)
+    try:
+        executor.submit(os._exit, 1).result(10)
+    except BrokenProcessPool:
+        pass
+    return executor
+
+
+class RenderServiceTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="test_render")
+        self.cube = os.path.join(self.workdir, "pyklip-S20141218-H-k150a9s4m1-KLmodes-all.fits")
+        synthetic.write_klcube(self.cube, nmodes=5, size=41)
+        self.service = render_service.RenderService(max_workers=1, in_memory=True)
+
+    def tearDown(self):
+        self.service.shutdown()
+        shutil.rmtree(self.workdir)
+
+    def test_renders(self):
+        png = self.service.submit(self.cube, title="c Eri").future.result(60)
+        self.assertTrue(png.startswith(b"\x89PNG"))
+
+    def test_worker_logs_are_logged_here(self):
+        with self.assertLogs("datacruncher", "DEBUG") as logs:
+            self.service.submit(self.cube, title="c Eri").future.result(60)
+        self.assertTrue(any("Loaded {0}".format(self.cube) in line for line in logs.output), logs.output)
+        self.assertEqual(logs.records[0].name, "datacruncher.display_image")
+        self.assertNotEqual(logs.records[0].process, os.getpid())
+
+    def test_sample_step(self):
+        # subsampled color limits change the image, so the service's default has to reach the workers
+        exact = self.service.submit(self.cube, title="c Eri").future.result(60)
+        self.service.sample_step = 8
+        sampled = self.service.submit(self.cube, title="c Eri").future.result(60)
+        self.assertNotEqual(exact, sampled)
+        self.assertEqual(self.service.submit(self.cube, title="c Eri", sample_step=1).future.result(60), exact)
+
+    def test_starts_over_after_pool_breaks(self):
+        # a worker dying takes the pool with it. The next job gets a new one
+        self.service.executor.shutdown()
+        self.service.executor = broken_executor()
+        png = self.service.submit(self.cube, title="c Eri").future.result(60)
+        self.assertTrue(png.startswith(b"\x89PNG"))
+
+    def test_jobs_in_a_pool_that_breaks_fail(self):
+        job = self.service.submit(self.cube, title="c Eri")
+        job.future.result(60)
+        # kill the worker out from under the pool, then check the jobs after it still render
+        broken = self.service.executor
+        lost = self.service.submit(self.cube, title="c Eri again")
+        for process in list(broken._processes.values()):
+            process.kill()
+        try:
+            lost.future.result(60)
+        except BrokenProcessPool:
+            pass
+        self.assertEqual(len(self.service.pending()), 0)
+        png = self.service.submit(self.cube, title="c Eri").future.result(60)
+        self.assertTrue(png.startswith(b"\x89PNG"))
+        self.assertIsNot(self.service.executor, broken)
+
+
+if __name__ == "__main__":
+    unittest.main()
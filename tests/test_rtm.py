@@ -0,0 +1,346 @@
+"""
+Tests of the bot against a fake Slack: a local aiohttp server that answers rtm.connect,
+chat.postMessage and files.upload and plays scripted events over the RTM websocket.
+
+    $ python -m pytest tests
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import tempfile
+import threading
+import unittest
+from concurrent.futures import Future
+
+from aiohttp import web
+
+repo = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, repo)
+
+config = """[DEFAULT]
+username = data_cruncher
+token = xoxb-test
+id = U1234ASDF
+dropboxdir = {dropboxdir}
+metrics_port = 0
+"""
+
+workdir = None
+olddir = None
+bot = None
+slack_api = None
+supervisor = None
+
+
+def setUpModule():
+    # bot reads config.ini and jokes.txt from the working directory
+    global workdir, olddir, bot, slack_api, supervisor
+    workdir = tempfile.mkdtemp(prefix="test_rtm")
+    with open(os.path.join(workdir, "config.ini"), "w") as f:
+        f.write(config.format(dropboxdir=workdir))
+    shutil.copy(os.path.join(repo, "jokes.txt"), workdir)
+    olddir = os.getcwd()
+    os.chdir(workdir)
+    import bot
+    import slack_api
+    import supervisor
+
+
+def tearDownModule():
+    os.chdir(olddir)
+    shutil.rmtree(workdir)
+
+
+def message(text, ts, user="U0001", channel="C0001"):
+    return {"type": "message", "text": "<@U1234ASDF> " + text, "user": user, "channel": channel, "ts": ts}
+
+
+class FakeSlack(object):
+    """
+    Fake Slack Web API and RTM websocket. Each connection gets the next list of events
+    from the script, after which the server closes the websocket
+    """
+    def __init__(self, script):
+        """
+        Args:
+            script: list of lists of events, one list per connection
+        """
+        self.script = list(script)
+        self.connections = 0
+        self.posted = []
+        # names of the Web API methods called, in the order they were answered (uploads as they start)
+        self.calls = []
+        # seconds chat.postMessage takes
+        self.post_delay = 0.
+        self.revoked = False
+        # rtm.connect answers with these bodies before it starts working
+        self.bad_connects = []
+        # uploads hang until this is set
+        self.uploads_released = threading.Event()
+        self.uploads_released.set()
+        self.lock = threading.Lock()
+        self.loop = asyncio.new_event_loop()
+        self.started = threading.Event()
+        self.thread = threading.Thread(target=self._serve)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        self.started.wait(10)
+        return self
+
+    def stop(self):
+        self.uploads_released.set()
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result(10)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(10)
+
+    @property
+    def api_url(self):
+        return "http://127.0.0.1:{0}/api/".format(self.port)
+
+    def _serve(self):
+        asyncio.set_event_loop(self.loop)
+        app = web.Application()
+        app.router.add_post("/api/rtm.connect", self.rtm_connect)
+        app.router.add_post("/api/chat.postMessage", self.post_message)
+        app.router.add_post("/api/files.upload", self.upload_file)
+        app.router.add_get("/ws", self.websocket)
+        self.runner = web.AppRunner(app)
+        self.loop.run_until_complete(self.runner.setup())
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        self.loop.run_until_complete(site.start())
+        self.port = self.runner.addresses[0][1]
+        self.started.set()
+        self.loop.run_forever()
+
+    async def rtm_connect(self, request):
+        if self.revoked:
+            return web.json_response({"ok": False, "error": "token_revoked"})
+        with self.lock:
+            bad = self.bad_connects.pop(0) if len(self.bad_connects) > 0 else None
+        if bad is not None:
+            return web.Response(text=bad, content_type="application/json")
+        return web.json_response({"ok": True, "url": "http://127.0.0.1:{0}/ws".format(self.port)})
+
+    async def post_message(self, request):
+        data = await request.post()
+        await asyncio.sleep(self.post_delay)
+        with self.lock:
+            self.calls.append("chat.postMessage")
+            self.posted.append(dict(data))
+        return web.json_response({"ok": True})
+
+    async def upload_file(self, request):
+        with self.lock:
+            self.calls.append("files.upload")
+        await request.read()
+        while not self.uploads_released.is_set():
+            await asyncio.sleep(0.02)
+        return web.json_response({"ok": True})
+
+    async def websocket(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        with self.lock:
+            self.connections += 1
+            events = self.script.pop(0) if len(self.script) > 0 else []
+        await ws.send_str(json.dumps({"type": "hello"}))
+        for event in events:
+            # strings go out as they are, to send things that aren't events
+            await ws.send_str(event if isinstance(event, str) else json.dumps(event))
+        # give the bot time to answer before hanging up
+        await asyncio.sleep(0.2)
+        await ws.close()
+        return ws
+
+
+def wait_for(condition, timeout=10.):
+    start = time.time()
+    while not condition():
+        if time.time() - start > timeout:
+            return False
+        time.sleep(0.02)
+    return True
+
+
+class AsyncChatResponderTest(unittest.TestCase):
+    def start(self, script, responder_class=None, bad_connects=()):
+        self.slack = FakeSlack(script).start()
+        self.slack.bad_connects = list(bad_connects)
+        self.client = slack_api.SlackAPI("xoxb-test", api_url=self.slack.api_url)
+        responder_class = responder_class if responder_class is not None else bot.AsyncChatResponder
+        self.responder = responder_class(workdir, "xoxb-test", self.client, None, None, api_url=self.slack.api_url,
+                                         ping_interval=1., backoff=supervisor.Backoff(base=0.05, jitter=0))
+        self.responder.daemon = True
+        self.responder.start()
+
+    def tearDown(self):
+        # once the token stops working the responder gives up, so it doesn't outlive the test
+        self.slack.revoked = True
+        self.responder.join(10)
+        self.assertFalse(self.responder.is_alive())
+        self.slack.stop()
+
+    def texts(self):
+        with self.slack.lock:
+            return [posted["text"] for posted in self.slack.posted]
+
+    def test_replies(self):
+        self.start([[message("help", "1.0")]])
+        self.assertTrue(wait_for(lambda: len(self.texts()) == 1))
+        self.assertTrue(self.texts()[0].startswith("<@U0001>: "))
+        self.assertIn("I am smart enough to respond to these queries", self.texts()[0])
+
+    def test_reconnects_and_drops_replayed_events(self):
+        # Slack replays recent events after a reconnect. Only the new one should be answered
+        self.start([[message("help", "1.0")],
+                    [message("help", "1.0"), message("help", "2.0", user="U0002")]])
+        self.assertTrue(wait_for(lambda: self.slack.connections >= 2 and len(self.texts()) >= 2))
+        time.sleep(0.3)
+        texts = self.texts()
+        self.assertEqual(len(texts), 2)
+        self.assertEqual(sorted(text.split(":")[0] for text in texts), ["<@U0001>", "<@U0002>"])
+        self.assertGreaterEqual(self.responder.connection_stats.reconnects, 1)
+
+    def test_handler_errors_are_logged(self):
+        class BrokenResponder(bot.AsyncChatResponder):
+            def parse_event(self, event):
+                if event.get("type") == "message":
+                    raise RuntimeError("broken handler")
+
+        with self.assertLogs("datacruncher.bot", "ERROR") as logs:
+            self.start([[message("help", "1.0")]], BrokenResponder)
+            self.assertTrue(wait_for(lambda: any("Failed to handle an event" in line for line in logs.output)))
+        self.assertIn("broken handler", "\n".join(logs.output))
+
+    def test_survives_malformed_responses(self):
+        with self.assertLogs("datacruncher.bot", "WARNING") as logs:
+            self.start([["[1, 2]", "42", "null", "not json", message("help", "1.0")]], bad_connects=["not json", "[1, 2]"])
+            self.assertTrue(wait_for(lambda: len(self.texts()) == 1))
+        self.assertTrue(any("malformed response" in line for line in logs.output))
+        self.assertEqual(sum("Got a malformed event" in line for line in logs.output), 4)
+
+    def test_survives_unexpected_errors(self):
+        class FlakyResponder(bot.AsyncChatResponder):
+            calls = 0
+
+            async def api_call(self, method, **kwargs):
+                FlakyResponder.calls += 1
+                if FlakyResponder.calls == 1:
+                    raise RuntimeError("something unexpected")
+                return await super(FlakyResponder, self).api_call(method, **kwargs)
+
+        with self.assertLogs("datacruncher.bot", "ERROR") as logs:
+            self.start([[message("help", "1.0")]], FlakyResponder)
+            self.assertTrue(wait_for(lambda: len(self.texts()) == 1))
+        self.assertIn("something unexpected", "\n".join(logs.output))
+
+    def test_gives_up_on_bad_token(self):
+        self.start([])
+        self.slack.revoked = True
+        self.responder.join(10)
+        self.assertFalse(self.responder.is_alive())
+
+
+class FakeRenderer(object):
+    def release(self, outputname):
+        # like a RenderService that renders to files, i.e. render_in_memory = false
+        if not isinstance(outputname, bytes) and os.path.exists(outputname):
+            os.remove(outputname)
+
+
+class FakeLedger(object):
+    def __init__(self):
+        self.recorded = []
+
+    def is_posted(self, path):
+        return False
+
+    def record(self, path):
+        self.recorded.append(path)
+
+
+class NewImagePosterTest(unittest.TestCase):
+    def setUp(self):
+        self.slack = FakeSlack([]).start()
+        self.client = slack_api.SlackAPI("xoxb-test", api_url=self.slack.api_url, max_queued=1)
+        self.poster = bot.NewImagePoster(workdir, self.client, FakeRenderer(), FakeLedger(), quiet_period=3600.)
+
+    def tearDown(self):
+        self.poster.debouncer.stop()
+        self.slack.stop()
+
+    def test_full_upload_queue_doesnt_hold_up_messages(self):
+        # one upload stuck on the network and one waiting fill up the upload queue, so the
+        # third post's upload has nowhere to go. That mustn't stall the chat.postMessage worker
+        self.slack.uploads_released.clear()
+        for i in range(3):
+            self.poster.post_single("/GPIDATA/c_Eri/autoreduced/20141218_H_Spec/{0}.fits".format(i), "c Eri {0}".format(i), b"png")
+        reply = self.client.post_message("C0001", "still here?")
+        self.assertTrue(reply.result(timeout=10)["ok"])
+        self.assertIn("still here?", [posted["text"] for posted in self.slack.posted])
+
+    def test_render_callbacks_dont_wait_for_the_queue(self):
+        # post_single runs on the render pool's callback thread. With the message queue full
+        # it has to drop the post instead of holding up every other render
+        self.slack.post_delay = 0.5
+        start = time.time()
+        for i in range(4):
+            self.poster.post_single("/GPIDATA/c_Eri/autoreduced/20141218_H_Spec/{0}.fits".format(i), "c Eri {0}".format(i), b"png")
+        self.assertLess(time.time() - start, 0.4)
+        # let the ones that made it in go out, so they don't turn up at the next test's fake Slack
+        self.assertTrue(wait_for(lambda: sum(self.client.queued().values()) == 0))
+        time.sleep(0.7)
+
+    def test_batch_falls_back_to_single_posts(self):
+        # images that can't be made into a mosaic still get posted one by one
+        self.client = self.poster.slack = slack_api.SlackAPI("xoxb-test", api_url=self.slack.api_url)
+        items = []
+        for i in range(2):
+            outputname = os.path.join(workdir, "render{0}.png".format(i))
+            with open(outputname, "wb") as f:
+                f.write(b"not a png")
+            items.append(("/GPIDATA/c_Eri/autoreduced/20141218_H_Spec/{0}.fits".format(i), "c Eri {0}".format(i), outputname))
+        self.poster.post_batch(items)
+        self.assertTrue(wait_for(lambda: len(self.poster.ledger.recorded) == 2))
+        self.assertFalse(any(os.path.exists(outputname) for _, _, outputname in items))
+
+
+class CachedRenderer(FakeRenderer):
+    # every image is already in the render cache, so jobs are done as soon as they're submitted
+    def submit(self, filename, title=None, block=True):
+        job = type("Job", (object,), {})()
+        job.future = Future()
+        job.future.set_result(b"png")
+        return job
+
+
+class FakeCatalog(object):
+    def choose(self, objname, date=None, band=None, mode=None):
+        return "20141218", "H", "Spec", {"pyklip-S20141218-H-k150a9s4m1-KLmodes-all.fits"}
+
+
+class ChatResponderTest(unittest.TestCase):
+    def setUp(self):
+        self.slack = FakeSlack([]).start()
+        self.client = slack_api.SlackAPI("xoxb-test", api_url=self.slack.api_url)
+        self.responder = bot.ChatResponder(workdir, self.client, CachedRenderer(), FakeCatalog())
+
+    def tearDown(self):
+        self.slack.stop()
+
+    def test_show_replies_before_uploading(self):
+        # a slow reply, so an upload that doesn't wait for it would get there first
+        self.slack.post_delay = 0.3
+        self.responder.craft_response("show me c Eri, 20141218, H, Spec", "U0001", "C0001")
+        self.assertTrue(wait_for(lambda: len(self.slack.calls) == 2))
+        self.assertEqual(self.slack.calls, ["chat.postMessage", "files.upload"])
+        self.assertIn("Retrieving c Eri taken on 20141218 in H-Spec", self.slack.posted[0]["text"])
+
+
+if __name__ == "__main__":
+    unittest.main()
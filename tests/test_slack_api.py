@@ -0,0 +1,131 @@
+"""
+Tests of the rate limited Slack Web API client against a fake Slack that rate limits
+the calls it's told to.
+
+    $ python -m pytest tests
+"""
+import os
+import sys
+import json
+import time
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+repo = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, repo)
+
+import slack_api
+
+
+class RateLimitingSlack(object):
+    """
+    Fake Slack Web API. Answers every method with ok, except that it answers the first
+    calls of a method with 429 Too Many Requests while it has limits left for it
+    """
+    def __init__(self):
+        self.limits = {} # method -> list of Retry-After values to answer with
+        self.calls = [] # (time, method, status)
+        self.lock = threading.Lock()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                method = self.path.rsplit("/", 1)[-1]
+                with fake.lock:
+                    limits = fake.limits.get(method, [])
+                    retry_after = limits.pop(0) if len(limits) > 0 else None
+                    fake.calls.append((time.time(), method, 200 if retry_after is None else 429))
+                if retry_after is None:
+                    body = json.dumps({"ok": True}).encode("utf-8")
+                    self.send_response(200)
+                else:
+                    body = json.dumps({"ok": False, "error": "ratelimited"}).encode("utf-8")
+                    self.send_response(429)
+                    self.send_header("Retry-After", str(retry_after))
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def api_url(self):
+        return "http://127.0.0.1:{0}/api/".format(self.server.server_address[1])
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def calls_of(self, method):
+        with self.lock:
+            return [(when, status) for when, called, status in self.calls if called == method]
+
+
+class SlackAPITest(unittest.TestCase):
+    def setUp(self):
+        self.slack = RateLimitingSlack()
+        self.client = slack_api.SlackAPI("xoxb-test", api_url=self.slack.api_url)
+
+    def tearDown(self):
+        self.slack.stop()
+
+    def test_waits_out_retry_after(self):
+        self.slack.limits["chat.postMessage"] = [1]
+        start = time.time()
+        response = self.client.post_message("C0001", "hello").result(10)
+        self.assertTrue(response["ok"])
+        calls = self.slack.calls_of("chat.postMessage")
+        self.assertEqual([status for _, status in calls], [429, 200])
+        self.assertGreaterEqual(calls[1][0] - calls[0][0], 0.9)
+        self.assertGreaterEqual(time.time() - start, 0.9)
+
+    def test_gives_up_after_max_retries(self):
+        self.client = slack_api.SlackAPI("xoxb-test", api_url=self.slack.api_url, max_retries=1)
+        self.slack.limits["chat.postMessage"] = [0, 0, 0]
+        with self.assertRaises(Exception):
+            self.client.post_message("C0001", "hello").result(10)
+        self.assertEqual(len(self.slack.calls_of("chat.postMessage")), 2)
+
+    def test_rate_limited_tier_doesnt_hold_up_others(self):
+        # uploads told to back off for a good while mustn't hold up chat replies
+        self.slack.limits["files.upload"] = [1]
+        upload = self.client.upload_file("C0001", __file__, "test.py", "test")
+        self.assertTrue(wait_for(lambda: len(self.slack.calls_of("files.upload")) > 0))
+        start = time.time()
+        for i in range(3):
+            self.assertTrue(self.client.post_message("C0001", "hello {0}".format(i)).result(10)["ok"])
+        self.assertLess(time.time() - start, 1.)
+        self.assertFalse(upload.done())
+        self.assertTrue(upload.result(20)["ok"])
+
+    def test_full_queue(self):
+        self.client = slack_api.SlackAPI("xoxb-test", api_url=self.slack.api_url, max_queued=1)
+        self.slack.limits["chat.postMessage"] = [2]
+        first = self.client.post_message("C0001", "first")
+        self.assertTrue(wait_for(lambda: len(self.slack.calls_of("chat.postMessage")) > 0))
+        self.client.post_message("C0001", "second")
+        with self.assertRaises(slack_api.OutboundQueueFull):
+            self.client.post_message("C0001", "third", block=False)
+        self.assertTrue(first.result(10)["ok"])
+
+
+def wait_for(condition, timeout=10.):
+    start = time.time()
+    while not condition():
+        if time.time() - start > timeout:
+            return False
+        time.sleep(0.02)
+    return True
+
+
+if __name__ == "__main__":
+    unittest.main()
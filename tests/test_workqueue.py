@@ -0,0 +1,99 @@
+"""
+Tests of the ledger of posted files, against a temporary SQLite database.
+
+    $ python -m pytest tests
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+
+repo = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, repo)
+
+import workqueue
+
+
+class PostedLedgerTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="test_ledger")
+        self.dbpath = os.path.join(self.workdir, "posted.sqlite")
+        self.cube = os.path.join(self.workdir, "pyklip-S20141218-H-k150a9s4m1-KLmodes-all.fits")
+        self.write(b"KL modes")
+        self.ledger = workqueue.PostedLedger(self.dbpath)
+
+    def tearDown(self):
+        self.ledger.close()
+        shutil.rmtree(self.workdir)
+
+    def write(self, contents):
+        with open(self.cube, "wb") as f:
+            f.write(contents)
+
+    def touch(self):
+        # a new mtime, the way Dropbox re-syncing a file leaves it
+        stat = os.stat(self.cube)
+        os.utime(self.cube, (stat.st_atime, stat.st_mtime + 10))
+
+    def restart(self):
+        # close() waits for the background hashing to finish
+        self.ledger.close()
+        self.ledger = workqueue.PostedLedger(self.dbpath)
+
+    def test_remembers_across_restarts(self):
+        self.assertFalse(self.ledger.is_posted(self.cube))
+        self.ledger.record(self.cube)
+        self.assertTrue(self.ledger.is_posted(self.cube))
+        self.restart()
+        self.assertTrue(self.ledger.is_posted(self.cube))
+        self.assertFalse(self.ledger.is_posted(os.path.join(self.workdir, "other-KLmodes-all.fits")))
+
+    def test_touched_but_unchanged_isnt_posted_again(self):
+        self.ledger.record(self.cube)
+        self.restart()
+        self.touch()
+        self.assertTrue(self.ledger.is_posted(self.cube))
+        # and it remembers the new mtime, so it doesn't have to hash the file next time
+        self.restart()
+        with self.ledger.lock:
+            mtime, = self.ledger.db.execute("SELECT mtime FROM posted WHERE path = ?", (self.cube,)).fetchone()
+        self.assertEqual(mtime, os.stat(self.cube).st_mtime)
+        self.assertTrue(self.ledger.is_posted(self.cube))
+
+    def test_changed_is_posted_again(self):
+        self.ledger.record(self.cube)
+        self.restart()
+        # same size, different contents
+        stat = os.stat(self.cube)
+        self.write(b"KL MODES")
+        os.utime(self.cube, (stat.st_atime, stat.st_mtime + 10))
+        self.assertFalse(self.ledger.is_posted(self.cube))
+        # different size
+        self.write(b"more KL modes")
+        self.assertFalse(self.ledger.is_posted(self.cube))
+
+    def test_touched_before_hashing_is_posted_again(self):
+        # without the hash of what was posted, there's no telling a touched file from a new one
+        self.ledger.record(self.cube)
+        self.restart()
+        with self.ledger.lock, self.ledger.db:
+            self.ledger.db.execute("UPDATE posted SET sha1 = NULL")
+        self.touch()
+        self.assertFalse(self.ledger.is_posted(self.cube))
+
+    def test_hashes_in_the_background(self):
+        self.ledger.record(self.cube)
+        start = time.time()
+        while time.time() - start < 10:
+            with self.ledger.lock:
+                sha1, = self.ledger.db.execute("SELECT sha1 FROM posted WHERE path = ?", (self.cube,)).fetchone()
+            if sha1 is not None:
+                break
+            time.sleep(0.02)
+        self.assertEqual(sha1, workqueue._sha1(self.cube))
+
+
+if __name__ == "__main__":
+    unittest.main()
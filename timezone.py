@@ -1,20 +1,123 @@
+import time
+import bisect
+import threading
+from collections import namedtuple
 from datetime import datetime
+import numpy as np
 import pytz as tz
-import astropy.time
+
+import botlog
+
+log = botlog.get_logger("timezone")
 
 gemini_longitude = -70 - 44/60. - 12.096/3600
 
 all_timezones = tz.common_timezones
-all_abbreviations = {} # convert from abbreviation to full time zone
-for zone in all_timezones:
-    abbrev = tz.timezone(zone).localize(datetime.now()).strftime('%Z')
-    if abbrev == 'CLT' and 'Santiago' not in zone:
-        continue
-    if abbrev == 'CLST' and 'Santiago' not in zone:
-        continue
-    if abbrev == 'CLDT' and 'Santiago' not in zone:
-        continue
-    all_abbreviations[abbrev] = zone
+
+# abbreviations that always mean one zone to us, no matter who else uses them.
+# (tzdata calls Chile's zones -04/-03 nowadays, so nobody officially uses these)
+preferred_zones = {
+    'CLT': 'America/Santiago',
+    'CLST': 'America/Santiago',
+    'CLDT': 'America/Santiago',
+}
+
+AbbreviationSnapshot = namedtuple("AbbreviationSnapshot", ["zones", "valid_until"])
+
+
+class AbbreviationIndex(object):
+    """
+    Index of time zone abbreviations (e.g. PDT) to the zones using them right now.
+    It's built the first time it's needed rather than at import, and rebuilt once any
+    zone switches to or from daylight savings, since that changes which abbreviations
+    are in use. Each build is a new snapshot, so lookups never see a half built index.
+    """
+    def __init__(self, zones=all_timezones):
+        """
+        Runs on creation
+
+        Args:
+            zones: names of the zones to index
+        """
+        self.zone_names = zones
+        self.snapshot = None
+        self.lock = threading.Lock()
+
+    def build(self, now=None):
+        """
+        Index the abbreviation every zone uses at a time
+
+        Args:
+            now: naive UTC datetime (default: now)
+        """
+        if now is None:
+            now = datetime.utcnow()
+        began = time.time()
+        zones = {}
+        valid_until = None
+        for name in self.zone_names:
+            zone = tz.timezone(name)
+            abbrev = tz.utc.localize(now).astimezone(zone).strftime('%Z')
+            zones.setdefault(abbrev, []).append(name)
+
+            # the index is good until the soonest any zone changes its offset
+            transitions = getattr(zone, '_utc_transition_times', None)
+            if transitions:
+                i = bisect.bisect_right(transitions, now)
+                if i < len(transitions) and (valid_until is None or transitions[i] < valid_until):
+                    valid_until = transitions[i]
+        self.snapshot = AbbreviationSnapshot({abbrev: tuple(names) for abbrev, names in zones.items()}, valid_until)
+        log.info("Built the time zone abbreviation index", extra={"abbreviations": len(zones), "valid_until": valid_until,
+                                                                 "seconds": time.time() - began})
+
+    def _current(self):
+        """
+        Return:
+            snapshot: an up to date snapshot, building it first if needed
+        """
+        snapshot = self.snapshot
+        if snapshot is None or (snapshot.valid_until is not None and datetime.utcnow() >= snapshot.valid_until):
+            with self.lock:
+                snapshot = self.snapshot
+                if snapshot is None or (snapshot.valid_until is not None and datetime.utcnow() >= snapshot.valid_until):
+                    self.build()
+                    snapshot = self.snapshot
+        return snapshot
+
+    def zones(self, abbrev):
+        """
+        All the zones currently using an abbreviation
+
+        Args:
+            abbrev: e.g. IST
+
+        Return:
+            zones: tuple of zone names (empty if nobody uses it right now)
+        """
+        return self._current().zones.get(abbrev, ())
+
+    def zone(self, abbrev):
+        """
+        The zone we take an abbreviation to mean
+
+        Args:
+            abbrev: e.g. CLT
+
+        Return:
+            zone: a zone name, or None if nobody uses it right now
+        """
+        if abbrev in preferred_zones:
+            return preferred_zones[abbrev]
+        zones = self.zones(abbrev)
+        if len(zones) == 0:
+            return None
+        return zones[-1]
+
+    def __contains__(self, abbrev):
+        return self.zone(abbrev) is not None
+
+
+all_abbreviations = AbbreviationIndex()
 
 def get_timezone(tz_abbrev):
     """
@@ -46,11 +149,36 @@ def get_timezone(tz_abbrev):
     if new_tz_abbrev.upper() == u'UTC':
         timezone = tz.timezone('UTC')   
     else:       
-        try:    
-            timezone = tz.timezone(all_abbreviations[new_tz_abbrev])
-        except KeyError:
-            timezone = None
+        zone = all_abbreviations.zone(new_tz_abbrev)
+        timezone = tz.timezone(zone) if zone is not None else None
     return timezone
+
+
+def ambiguity_note(tz_abbrev):
+    """
+    If an abbreviation means different UTC offsets depending on who's using it
+    (e.g. IST in India, Ireland and Israel), say what else it could mean
+
+    Args:
+        tz_abbrev: abbreviation, e.g. IST
+
+    Return:
+        note: text listing the other offsets and their zones, or None if it's not ambiguous
+    """
+    timezone = get_timezone(tz_abbrev)
+    if timezone is None:
+        return None
+    now = tz.utc.localize(datetime.utcnow())
+    offset = now.astimezone(timezone).strftime('%z')
+    others = {}
+    for zone in all_abbreviations.zones(now.astimezone(timezone).strftime('%Z')):
+        other_offset = now.astimezone(tz.timezone(zone)).strftime('%z')
+        if other_offset != offset:
+            others.setdefault(other_offset, []).append(zone)
+    if len(others) == 0:
+        return None
+    return "{0} is ambiguous, it can also mean {1}".format(tz_abbrev, ", ".join(
+        "UT{0} ({1})".format(other_offset, ", ".join(zones)) for other_offset, zones in sorted(others.items())))
     
 
 
@@ -59,26 +187,49 @@ def convert_time(time_str, zone_from, zone_to):
     Args:
         time_str: "HH:MM"
     """
-    # figure out time zones
+    converted = convert_times([time_str], zone_from, [zone_to])
+    if converted is None:
+        return None
+    return converted[0][0]
+
+
+def convert_times(time_strs, zone_from, zones_to, date=None):
+    """
+    Convert a bunch of times of day from one time zone to several others at once
+
+    Args:
+        time_strs: list of "HH:MM"
+        zone_from: abbreviation the times are in, e.g. CLT
+        zones_to: list of abbreviations to convert them to
+        date: datetime.date the times are on (default: today in zone_from)
+
+    Return:
+        converted: list with a list per time, of that time in each of zones_to
+                   (formatted like "01:45 PM PDT-0700"), or None if any zone isn't known
+    """
     tz_from = get_timezone(zone_from)
-    tz_to = get_timezone(zone_to)
-    
-    if tz_from is None or tz_to is None:
+    tzs_to = [get_timezone(zone) for zone in zones_to]
+    if tz_from is None or any(tz_to is None for tz_to in tzs_to):
         return None
-    
-    # parse input time
-    time_str_args = time_str.split(":")
-    hours = int(time_str_args[0])
-    min = int(time_str_args[1])
-    print(hours, min)
-    
-    # since date is unknown, grab today's date
-    time = datetime.now()
-    time = datetime(time.year, time.month, time.day, hours, min, tzinfo=tz_from)
-    
-    fmt = "%I:%M %Z%z"
-    new_time = time.astimezone(tz_to)
-    return new_time.strftime(fmt)
+
+    if date is None:
+        date = datetime.now(tz_from).date()
+    # the date is only used for the UTC offsets, so look them up once, at midday
+    midday = tz_from.localize(datetime(date.year, date.month, date.day, 12))
+    local_times = [midday.astimezone(tz_to) for tz_to in tzs_to]
+    offsets_to = np.array([local.utcoffset().total_seconds() // 60 for local in local_times])
+    offset_from = midday.utcoffset().total_seconds() // 60
+
+    # minutes since midnight in zone_from -> minutes since midnight in each of zones_to
+    hours_minutes = np.array([[int(part) for part in time_str.split(":")[:2]] for time_str in time_strs]).reshape(-1, 2)
+    minutes = hours_minutes[:, 0] * 60 + hours_minutes[:, 1]
+    converted = (minutes[:, None] - offset_from + offsets_to[None, :]) % (24 * 60)
+    hours, minutes = np.divmod(converted.astype(int), 60)
+
+    labels = [local.strftime("%Z%z") for local in local_times]
+    return [["{0:02d}:{1:02d} {2} {3}".format(hour % 12 if hour % 12 != 0 else 12, minute, "AM" if hour < 12 else "PM", label)
+             for hour, minute, label in zip(hour_row, minute_row, labels)]
+            for hour_row, minute_row in zip(hours, minutes)]
     
 
 def get_time_now(mytz):
@@ -111,20 +262,7 @@ def get_lst(longitude):
     Args:
         longitude: decimal degrees (west is negative so longitude ranges from [-180,180])
     """  
-    t = astropy.time.Time(datetime.utcnow())
-    jd0 = (t.jd-0.5) // 1 + 0.5
-    ut = ((t.jd-0.5) % 1) * 24
-    T=(jd0-2451545.0)/36525.0
-    T0 = 6.697374558+ (2400.051336*T)+(0.000025862*T**2)+(ut*1.0027379093)
-    GST = T0 % 24
-    LST = (GST + longitude/15) % 24
-    
-    LST_hour = LST//1
-    LST_min = (LST % 1) * 60
-    LST_sec = round((LST_min % 1) * 60)
-    LST_min = LST_min // 1
-    LST_str = "%02d:%02d:%02d" % (LST_hour, LST_min, LST_sec)
-    return LST_str
+    return format_hours(lst_hours([datetime.utcnow()], longitude))[0]
     
     
 def get_jd(modified=True):
@@ -134,13 +272,73 @@ def get_jd(modified=True):
     Args:
         modified: if True, get MJD instead
     """
-    t = astropy.time.Time(datetime.utcnow())
-    jd = t.jd
+    jd = julian_dates([datetime.utcnow()])[0]
     if modified:
-        jd -= 2400000.5
+        jd = mjd_from_jd(jd)
         
     return "{0:.5f}".format(jd)
 
+
+unix_epoch_jd = 2440587.5
+
+def julian_dates(times):
+    """
+    Julian dates of a bunch of times at once
+
+    Args:
+        times: list or array of naive UTC datetimes (or numpy datetime64s)
+
+    Return:
+        jd: array of Julian dates (UTC)
+    """
+    times = np.asarray(times, dtype='datetime64[us]')
+    seconds = (times - np.datetime64(0, 's')) / np.timedelta64(1, 's')
+    return seconds / 86400. + unix_epoch_jd
+
+
+def mjd_from_jd(jd):
+    """
+    Convert Julian dates (scalar or array) to modified Julian dates
+    """
+    return jd - 2400000.5
+
+
+def lst_hours(times, longitude=gemini_longitude):
+    """
+    Local Sidereal Time at a bunch of times at once
+
+    Args:
+        times: list or array of naive UTC datetimes (or numpy datetime64s)
+        longitude: decimal degrees (west is negative so longitude ranges from [-180,180])
+
+    Return:
+        lst: array of LSTs in hours [0, 24)
+    """
+    jd = julian_dates(times)
+    jd0 = (jd - 0.5) // 1 + 0.5
+    ut = ((jd - 0.5) % 1) * 24
+    T = (jd0 - 2451545.0) / 36525.0
+    T0 = 6.697374558 + (2400.051336*T) + (0.000025862*T**2) + (ut*1.0027379093)
+    GST = T0 % 24
+    return (GST + longitude/15) % 24
+
+
+def format_hours(hours):
+    """
+    Format hours (e.g. from lst_hours) as HH:MM:SS
+
+    Args:
+        hours: array of hours [0, 24)
+
+    Return:
+        strings: list of "HH:MM:SS"
+    """
+    # round to the second first, so we never get 60 seconds
+    seconds = np.round(np.asarray(hours) * 3600).astype(int) % (24 * 3600)
+    hh, remainder = np.divmod(seconds, 3600)
+    mm, ss = np.divmod(remainder, 60)
+    return ["%02d:%02d:%02d" % values for values in zip(hh, mm, ss)]
+
 # print(get_time_now('PDT'))
 # print(get_time_now('CLT'))
 # print(convert_time('1:45', 'PDT', 'CLT'))
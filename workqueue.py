@@ -0,0 +1,180 @@
+import os
+import time
+import queue
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+class UniqueWorkQueue(object):
+    """
+    First in, first out queue that ignores items that are already queued or being worked on.
+    Adding, taking and membership checks are all constant time.
+    """
+    def __init__(self):
+        self.queued = OrderedDict()
+        self.active = set()
+        self.lock = threading.Lock()
+
+    def put(self, item):
+        """
+        Add an item to the back of the queue
+
+        Return:
+            added: False if the item was already queued or being worked on
+        """
+        with self.lock:
+            if item in self.queued or item in self.active:
+                return False
+            self.queued[item] = None
+            return True
+
+    def get(self):
+        """
+        Take the item at the front of the queue. It counts as being worked on until done() is called
+
+        Return:
+            item: or None if the queue is empty
+        """
+        with self.lock:
+            if len(self.queued) == 0:
+                return None
+            item, _ = self.queued.popitem(last=False)
+            self.active.add(item)
+            return item
+
+    def done(self, item):
+        """
+        Finish working on an item, so it can be queued again
+        """
+        with self.lock:
+            self.active.discard(item)
+
+    def __contains__(self, item):
+        with self.lock:
+            return item in self.queued or item in self.active
+
+    def __len__(self):
+        with self.lock:
+            return len(self.queued)
+
+
+class PostedLedger(object):
+    """
+    Persistent record of the files that have already been posted, so each reduction
+    is posted once even across restarts and Dropbox re-syncs. A file counts as the same
+    if its size and mtime match, or failing that, if its contents hash the same.
+
+    Hashing a whole KL mode cube over a network mount is slow, so record() only stores the
+    size and mtime and a background thread fills in the hash afterwards. is_posted() only
+    hashes when a file was touched without changing size.
+    """
+    def __init__(self, dbpath):
+        """
+        Runs on creation
+
+        Args:
+            dbpath: path to the SQLite database (created if it doesn't exist)
+        """
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(dbpath, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS posted ("
+                            "path TEXT PRIMARY KEY, size INTEGER, mtime REAL, sha1 TEXT, posted REAL)")
+        self.to_hash = queue.Queue()
+        self.hasher = threading.Thread(target=self._hash_recorded)
+        self.hasher.daemon = True
+        self.hasher.start()
+
+    def is_posted(self, path):
+        """
+        Check if this version of a file has been posted already
+
+        Args:
+            path: full path to the file
+
+        Return:
+            True if it has
+        """
+        with self.lock:
+            row = self.db.execute("SELECT size, mtime, sha1 FROM posted WHERE path = ?", (path,)).fetchone()
+        if row is None:
+            return False
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        size, mtime, sha1 = row
+        if stat.st_size != size:
+            return False
+        if stat.st_mtime == mtime:
+            return True
+        # same size but touched. Only the contents can tell if it's really new, and if the
+        # posted version never got hashed we can't tell, so post it again to be safe
+        if sha1 is None:
+            return False
+        try:
+            current = _sha1(path)
+        except (IOError, OSError):
+            return False
+        if current != sha1:
+            return False
+        with self.lock, self.db:
+            self.db.execute("UPDATE posted SET mtime = ? WHERE path = ?", (stat.st_mtime, path))
+        return True
+
+    def record(self, path):
+        """
+        Remember that the current version of a file has been posted
+
+        Args:
+            path: full path to the file
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO posted VALUES (?, ?, ?, ?, ?)",
+                            (path, stat.st_size, stat.st_mtime, None, time.time()))
+        self.to_hash.put((path, stat.st_size, stat.st_mtime))
+
+    def _hash_recorded(self):
+        """
+        Background thread that hashes files after they're recorded
+        """
+        while True:
+            item = self.to_hash.get()
+            if item is None:
+                return
+            path, size, mtime = item
+            try:
+                sha1 = _sha1(path)
+                stat = os.stat(path)
+            except (IOError, OSError):
+                continue
+            if stat.st_size != size or stat.st_mtime != mtime:
+                # changed while we were hashing, so this isn't the hash of what we posted
+                continue
+            with self.lock, self.db:
+                self.db.execute("UPDATE posted SET sha1 = ? WHERE path = ? AND size = ? AND mtime = ?",
+                                (sha1, path, size, mtime))
+
+    def close(self):
+        self.to_hash.put(None)
+        self.hasher.join()
+        with self.lock:
+            self.db.close()
+
+
+def _sha1(path, blocksize=1024*1024):
+    """
+    Return:
+        hex SHA-1 of a file's contents
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            digest.update(block)
+    return digest.hexdigest()